@@ -20,7 +20,8 @@ SOURCE_FILES = [
     'pyhelper.c', 'serialqueue.c', 'stepcompress.c', 'itersolve.c', 'trapq.c',
     'kin_cartesian.c', 'kin_corexy.c', 'kin_corexz.c', 'kin_delta.c',
     'kin_polar.c', 'kin_rotary_delta.c', 'kin_winch.c', 'kin_extruder.c',
-    'kin_shaper.c',
+    'kin_shaper.c', 'kin_bed_mesh.c', 'lookahead.c', 'stepgen.c',
+    'msgparse.c',
 ]
 DEST_LIB = "c_helper.so"
 OTHER_FILES = [
@@ -62,17 +63,49 @@ defs_itersolve = """
     double itersolve_get_commanded_pos(struct stepper_kinematics *sk);
 """
 
+defs_stepgen = """
+    struct stepgen_pool *stepgen_pool_alloc(int num_threads);
+    void stepgen_pool_free(struct stepgen_pool *sp);
+    int32_t stepgen_pool_generate_steps(struct stepgen_pool *sp
+        , struct stepper_kinematics **sk_list, int sk_count
+        , double flush_time);
+"""
+
 defs_trapq = """
     void trapq_append(struct trapq *tq, double print_time
         , double accel_t, double cruise_t, double decel_t
         , double start_pos_x, double start_pos_y, double start_pos_z
         , double axes_r_x, double axes_r_y, double axes_r_z
         , double start_v, double cruise_v, double accel);
+    void trapq_append_batch(struct trapq *tq, double *data, int len);
     struct trapq *trapq_alloc(void);
     void trapq_free(struct trapq *tq);
     void trapq_free_moves(struct trapq *tq, double print_time);
 """
 
+defs_lookahead = """
+    struct lookahead_move {
+        double move_d, accel, max_cruise_v2, delta_v2, smooth_delta_v2;
+        double axes_r_x, axes_r_y, axes_r_z;
+        int is_kinematic_move;
+        double max_start_v2, max_smoothed_v2;
+        double start_v, cruise_v, end_v;
+        double accel_t, cruise_t, decel_t;
+    };
+
+    struct lookahead *lookahead_alloc(void);
+    void lookahead_free(struct lookahead *la);
+    void lookahead_reset(struct lookahead *la);
+    struct lookahead_move *lookahead_get_moves(struct lookahead *la);
+    void lookahead_discard(struct lookahead *la, int count);
+    int lookahead_add_move(struct lookahead *la, double move_d, double accel
+        , double max_cruise_v2, double delta_v2, double smooth_delta_v2
+        , double axes_r_x, double axes_r_y, double axes_r_z
+        , int is_kinematic_move, double junction_deviation
+        , double extruder_v2);
+    int lookahead_flush(struct lookahead *la, int lazy);
+"""
+
 defs_kin_cartesian = """
     struct stepper_kinematics *cartesian_stepper_alloc(char axis);
 """
@@ -132,6 +165,18 @@ defs_kin_shaper = """
     struct stepper_kinematics * input_shaper_alloc(void);
 """
 
+defs_kin_bed_mesh = """
+    int bed_mesh_set_sk(struct stepper_kinematics *sk
+        , struct stepper_kinematics *orig_sk);
+    int bed_mesh_set_mesh(struct stepper_kinematics *sk, double *z_matrix
+        , int x_count, int y_count, double min_x, double min_y
+        , double x_dist, double y_dist);
+    void bed_mesh_set_fade(struct stepper_kinematics *sk, double fade_start
+        , double fade_end, double z_offset);
+    struct stepper_kinematics *bed_mesh_alloc(void);
+    void bed_mesh_free(struct stepper_kinematics *sk);
+"""
+
 defs_serialqueue = """
     #define MESSAGE_MAX 64
     struct pull_queue_message {
@@ -149,8 +194,21 @@ defs_serialqueue = """
     void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
         , uint8_t *msg, int len, uint64_t min_clock, uint64_t req_clock
         , uint64_t notify_id);
+    enum {
+        CE_INT = 0, CE_BUFFER = 1,
+    };
+
+    struct command_encoder *command_encoder_alloc(uint32_t msgid
+        , uint8_t *param_types, int param_count);
+    void command_encoder_free(struct command_encoder *ce);
+    int serialqueue_send_encode(struct serialqueue *sq
+        , struct command_queue *cq, struct command_encoder *ce
+        , int64_t *args, int args_len, uint8_t *buf, int buf_len
+        , uint64_t min_clock, uint64_t req_clock, uint64_t notify_id);
     void serialqueue_pull(struct serialqueue *sq
         , struct pull_queue_message *pqm);
+    int serialqueue_pull_batch(struct serialqueue *sq
+        , struct pull_queue_message *q, int max);
     void serialqueue_set_baud_adjust(struct serialqueue *sq
         , double baud_adjust);
     void serialqueue_set_receive_window(struct serialqueue *sq
@@ -162,6 +220,19 @@ defs_serialqueue = """
         , struct pull_queue_message *q, int max);
 """
 
+defs_msgparse = """
+    enum {
+        MP_UINT = 0, MP_INT = 1, MP_STRING = 2,
+    };
+
+    struct msgparse *msgparse_alloc(void);
+    void msgparse_free(struct msgparse *mp);
+    int msgparse_add_format(struct msgparse *mp, int msgid
+        , uint8_t *param_types, int param_count);
+    int msgparse_parse_batch(struct msgparse *mp
+        , struct pull_queue_message *q, int count, int64_t *args);
+"""
+
 defs_pyhelper = """
     void set_python_logging_callback(void (*func)(const char *));
     double get_monotonic(void);
@@ -169,13 +240,15 @@ defs_pyhelper = """
 
 defs_std = """
     void free(void*);
+    int posix_fadvise(int fd, long offset, long len, int advice);
 """
 
 defs_all = [
-    defs_pyhelper, defs_serialqueue, defs_std, defs_stepcompress,
-    defs_itersolve, defs_trapq, defs_kin_cartesian, defs_kin_corexy,
-    defs_kin_corexz, defs_kin_delta, defs_kin_polar, defs_kin_rotary_delta,
-    defs_kin_winch, defs_kin_extruder, defs_kin_shaper,
+    defs_pyhelper, defs_serialqueue, defs_msgparse, defs_std,
+    defs_stepcompress, defs_itersolve, defs_stepgen, defs_trapq,
+    defs_lookahead, defs_kin_cartesian, defs_kin_corexy, defs_kin_corexz,
+    defs_kin_delta, defs_kin_polar, defs_kin_rotary_delta, defs_kin_winch,
+    defs_kin_extruder, defs_kin_shaper, defs_kin_bed_mesh,
 ]
 
 # Return the list of file modification times
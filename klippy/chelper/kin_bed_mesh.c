@@ -0,0 +1,160 @@
+// Bed mesh z adjustment applied during step generation
+//
+// Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <math.h> // floor
+#include <stddef.h> // offsetof
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "itersolve.h" // struct stepper_kinematics
+#include "trapq.h" // struct move
+
+#define DUMMY_T 500.0
+
+struct bed_mesh {
+    struct stepper_kinematics sk;
+    struct stepper_kinematics *orig_sk;
+    struct move m;
+    // Interpolated mesh stored as y_count rows of x_count points
+    double *z_matrix;
+    int x_count, y_count;
+    double min_x, min_y, x_dist, y_dist;
+    // Fade out of the adjustment (z positions are relative to z_offset)
+    double fade_start, fade_end, z_offset;
+};
+
+
+/****************************************************************
+ * Mesh lookup (mirrors ZMesh.calc_z() in bed_mesh.py)
+ ****************************************************************/
+
+static inline double
+calc_linear_index(double coord, double mesh_min, double mesh_dist, int count
+                  , int *pidx)
+{
+    double pos = floor((coord - mesh_min) / mesh_dist);
+    int idx = pos < 0. ? 0 : (pos > count - 2 ? count - 2 : (int)pos);
+    double t = (coord - (mesh_min + mesh_dist * idx)) / mesh_dist;
+    *pidx = idx;
+    return t < 0. ? 0. : (t > 1. ? 1. : t);
+}
+
+static inline double
+calc_mesh_z(struct bed_mesh *bm, double x, double y)
+{
+    int xidx, yidx;
+    double tx = calc_linear_index(x, bm->min_x, bm->x_dist, bm->x_count
+                                  , &xidx);
+    double ty = calc_linear_index(y, bm->min_y, bm->y_dist, bm->y_count
+                                  , &yidx);
+    double *row0 = &bm->z_matrix[yidx * bm->x_count + xidx];
+    double *row1 = row0 + bm->x_count;
+    double z0 = (1. - tx) * row0[0] + tx * row0[1];
+    double z1 = (1. - tx) * row1[0] + tx * row1[1];
+    return (1. - ty) * z0 + ty * z1;
+}
+
+// Mirrors BedMesh.get_z_factor() in bed_mesh.py
+static inline double
+calc_fade_factor(struct bed_mesh *bm, double z)
+{
+    if (z >= bm->fade_end)
+        return 0.;
+    if (z >= bm->fade_start)
+        return (bm->fade_end - z) / (bm->fade_end - bm->fade_start);
+    return 1.;
+}
+
+
+/****************************************************************
+ * Kinematics wrapper
+ ****************************************************************/
+
+static double
+bed_mesh_calc_position(struct stepper_kinematics *sk, struct move *m
+                       , double move_time)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    if (!bm->z_matrix)
+        return bm->orig_sk->calc_position_cb(bm->orig_sk, m, move_time);
+    struct coord c = move_get_coord(m, move_time);
+    double factor = calc_fade_factor(bm, c.z - bm->z_offset);
+    if (factor)
+        c.z += factor * calc_mesh_z(bm, c.x, c.y);
+    bm->m.start_pos = c;
+    return bm->orig_sk->calc_position_cb(bm->orig_sk, &bm->m, DUMMY_T);
+}
+
+int __visible
+bed_mesh_set_sk(struct stepper_kinematics *sk
+                , struct stepper_kinematics *orig_sk)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    if (!(orig_sk->active_flags & AF_Z))
+        return -1;
+    bm->sk.calc_position_cb = bed_mesh_calc_position;
+    bm->sk.active_flags = orig_sk->active_flags;
+    bm->sk.gen_steps_pre_active = orig_sk->gen_steps_pre_active;
+    bm->sk.gen_steps_post_active = orig_sk->gen_steps_post_active;
+    bm->orig_sk = orig_sk;
+    return 0;
+}
+
+// Load an interpolated mesh (or clear the mesh if 'z_matrix' is NULL)
+int __visible
+bed_mesh_set_mesh(struct stepper_kinematics *sk, double *z_matrix
+                  , int x_count, int y_count, double min_x, double min_y
+                  , double x_dist, double y_dist)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    free(bm->z_matrix);
+    bm->z_matrix = NULL;
+    bm->sk.active_flags = bm->orig_sk->active_flags;
+    if (!z_matrix)
+        return 0;
+    if (x_count < 2 || y_count < 2 || x_dist <= 0. || y_dist <= 0.)
+        return -1;
+    int size = x_count * y_count * sizeof(*z_matrix);
+    bm->z_matrix = malloc(size);
+    memcpy(bm->z_matrix, z_matrix, size);
+    bm->x_count = x_count;
+    bm->y_count = y_count;
+    bm->min_x = min_x;
+    bm->min_y = min_y;
+    bm->x_dist = x_dist;
+    bm->y_dist = y_dist;
+    // The z adjustment depends on the x and y position of every move
+    bm->sk.active_flags |= AF_X | AF_Y;
+    return 0;
+}
+
+void __visible
+bed_mesh_set_fade(struct stepper_kinematics *sk, double fade_start
+                  , double fade_end, double z_offset)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    bm->fade_start = fade_start;
+    bm->fade_end = fade_end;
+    bm->z_offset = z_offset;
+}
+
+struct stepper_kinematics * __visible
+bed_mesh_alloc(void)
+{
+    struct bed_mesh *bm = malloc(sizeof(*bm));
+    memset(bm, 0, sizeof(*bm));
+    bm->m.move_t = 2. * DUMMY_T;
+    bm->fade_start = bm->fade_end = INFINITY;
+    return &bm->sk;
+}
+
+void __visible
+bed_mesh_free(struct stepper_kinematics *sk)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    free(bm->z_matrix);
+    free(bm);
+}
@@ -0,0 +1,248 @@
+// Move "look-ahead" velocity planner
+//
+// Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <math.h> // sqrt
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "pyhelper.h" // errorf
+
+// This code mirrors the MoveQueue and Move.calc_junction() /
+// Move.set_junction() logic in toolhead.py.  Junction speeds are
+// tracked in velocity squared.
+
+struct lookahead_move {
+    // Move parameters
+    double move_d, accel, max_cruise_v2, delta_v2, smooth_delta_v2;
+    double axes_r_x, axes_r_y, axes_r_z;
+    int is_kinematic_move;
+    // Junction limits
+    double max_start_v2, max_smoothed_v2;
+    // Final velocities and times (valid after lookahead_flush())
+    double start_v, cruise_v, end_v;
+    double accel_t, cruise_t, decel_t;
+};
+
+struct delayed_move {
+    int index;
+    double start_v2, end_v2;
+};
+
+struct lookahead {
+    struct lookahead_move *moves;
+    struct delayed_move *delayed;
+    int move_count, move_alloc;
+};
+
+// Allocate a new 'lookahead' object
+struct lookahead * __visible
+lookahead_alloc(void)
+{
+    struct lookahead *la = malloc(sizeof(*la));
+    memset(la, 0, sizeof(*la));
+    return la;
+}
+
+// Free memory associated with a 'lookahead' object
+void __visible
+lookahead_free(struct lookahead *la)
+{
+    free(la->moves);
+    free(la->delayed);
+    free(la);
+}
+
+// Discard all queued moves
+void __visible
+lookahead_reset(struct lookahead *la)
+{
+    la->move_count = 0;
+}
+
+// Return the array of queued moves
+struct lookahead_move * __visible
+lookahead_get_moves(struct lookahead *la)
+{
+    return la->moves;
+}
+
+// Remove the first 'count' moves from the queue
+void __visible
+lookahead_discard(struct lookahead *la, int count)
+{
+    if (count >= la->move_count) {
+        la->move_count = 0;
+        return;
+    }
+    la->move_count -= count;
+    memmove(la->moves, &la->moves[count]
+            , la->move_count * sizeof(la->moves[0]));
+}
+
+// Find the maximum junction velocity between 'prev' and 'm'
+static void
+calc_junction(struct lookahead_move *m, struct lookahead_move *prev
+              , double junction_deviation, double extruder_v2)
+{
+    if (!m->is_kinematic_move || !prev->is_kinematic_move)
+        return;
+    // Find max velocity using "approximated centripetal velocity"
+    double junction_cos_theta = -(m->axes_r_x * prev->axes_r_x
+                                  + m->axes_r_y * prev->axes_r_y
+                                  + m->axes_r_z * prev->axes_r_z);
+    if (junction_cos_theta > 0.999999)
+        return;
+    junction_cos_theta = fmax(junction_cos_theta, -0.999999);
+    double sin_theta_d2 = sqrt(0.5*(1.0-junction_cos_theta));
+    double R = (junction_deviation * sin_theta_d2 / (1. - sin_theta_d2));
+    // Approximated circle must contact moves no further away than mid-move
+    double tan_theta_d2 = sin_theta_d2 / sqrt(0.5*(1.0+junction_cos_theta));
+    double move_centripetal_v2 = .5 * m->move_d * tan_theta_d2 * m->accel;
+    double prev_move_centripetal_v2 = (.5 * prev->move_d * tan_theta_d2
+                                       * prev->accel);
+    // Apply limits
+    double v2 = fmin(R * m->accel, R * prev->accel);
+    v2 = fmin(v2, move_centripetal_v2);
+    v2 = fmin(v2, prev_move_centripetal_v2);
+    v2 = fmin(v2, extruder_v2);
+    v2 = fmin(v2, m->max_cruise_v2);
+    v2 = fmin(v2, prev->max_cruise_v2);
+    m->max_start_v2 = fmin(v2, prev->max_start_v2 + prev->delta_v2);
+    m->max_smoothed_v2 = fmin(
+        m->max_start_v2, prev->max_smoothed_v2 + prev->smooth_delta_v2);
+}
+
+// Add a move to the queue (the caller has already applied all
+// kinematic speed limits).  Returns the number of queued moves.
+int __visible
+lookahead_add_move(struct lookahead *la, double move_d, double accel
+                   , double max_cruise_v2, double delta_v2
+                   , double smooth_delta_v2
+                   , double axes_r_x, double axes_r_y, double axes_r_z
+                   , int is_kinematic_move, double junction_deviation
+                   , double extruder_v2)
+{
+    if (la->move_count >= la->move_alloc) {
+        int new_alloc = la->move_alloc ? la->move_alloc * 2 : 1024;
+        struct lookahead_move *nm = realloc(la->moves
+                                            , new_alloc * sizeof(*nm));
+        struct delayed_move *nd = realloc(la->delayed
+                                          , new_alloc * sizeof(*nd));
+        if (!nm || !nd) {
+            errorf("lookahead: out of memory");
+            if (nm)
+                la->moves = nm;
+            if (nd)
+                la->delayed = nd;
+            return -1;
+        }
+        la->moves = nm;
+        la->delayed = nd;
+        la->move_alloc = new_alloc;
+    }
+    struct lookahead_move *m = &la->moves[la->move_count];
+    memset(m, 0, sizeof(*m));
+    m->move_d = move_d;
+    m->accel = accel;
+    m->max_cruise_v2 = max_cruise_v2;
+    m->delta_v2 = delta_v2;
+    m->smooth_delta_v2 = smooth_delta_v2;
+    m->axes_r_x = axes_r_x;
+    m->axes_r_y = axes_r_y;
+    m->axes_r_z = axes_r_z;
+    m->is_kinematic_move = is_kinematic_move;
+    if (la->move_count)
+        calc_junction(m, m - 1, junction_deviation, extruder_v2);
+    return ++la->move_count;
+}
+
+// Determine accel, cruise, and decel portions of a move
+static void
+set_junction(struct lookahead_move *m, double start_v2, double cruise_v2
+             , double end_v2)
+{
+    double half_inv_accel = .5 / m->accel;
+    double accel_d = (cruise_v2 - start_v2) * half_inv_accel;
+    double decel_d = (cruise_v2 - end_v2) * half_inv_accel;
+    double cruise_d = m->move_d - accel_d - decel_d;
+    // Determine move velocities
+    double start_v = m->start_v = sqrt(start_v2);
+    double cruise_v = m->cruise_v = sqrt(cruise_v2);
+    double end_v = m->end_v = sqrt(end_v2);
+    // Determine time spent in each portion of move (time is the
+    // distance divided by average velocity)
+    m->accel_t = accel_d / ((start_v + cruise_v) * 0.5);
+    m->cruise_t = cruise_d / cruise_v;
+    m->decel_t = decel_d / ((end_v + cruise_v) * 0.5);
+}
+
+// Traverse queue from last to first move and determine maximum
+// junction speed assuming the robot comes to a complete stop after
+// the last move.  Returns the number of moves (from the start of
+// the queue) that have final velocities and may be flushed.
+int __visible
+lookahead_flush(struct lookahead *la, int lazy)
+{
+    struct lookahead_move *moves = la->moves;
+    struct delayed_move *delayed = la->delayed;
+    int update_flush_count = lazy, flush_count = la->move_count;
+    int delayed_count = 0, i;
+    double next_end_v2 = 0., next_smoothed_v2 = 0., peak_cruise_v2 = 0.;
+    for (i = la->move_count - 1; i >= 0; i--) {
+        struct lookahead_move *m = &moves[i];
+        double reachable_start_v2 = next_end_v2 + m->delta_v2;
+        double start_v2 = fmin(m->max_start_v2, reachable_start_v2);
+        double reachable_smoothed_v2 = next_smoothed_v2 + m->smooth_delta_v2;
+        double smoothed_v2 = fmin(m->max_smoothed_v2, reachable_smoothed_v2);
+        if (smoothed_v2 < reachable_smoothed_v2) {
+            // It's possible for this move to accelerate
+            if (smoothed_v2 + m->smooth_delta_v2 > next_smoothed_v2
+                || delayed_count) {
+                // This move can decelerate or this is a full accel
+                // move after a full decel move
+                if (update_flush_count && peak_cruise_v2) {
+                    flush_count = i;
+                    update_flush_count = 0;
+                }
+                peak_cruise_v2 = fmin(m->max_cruise_v2, (
+                    smoothed_v2 + reachable_smoothed_v2) * .5);
+                if (delayed_count) {
+                    // Propagate peak_cruise_v2 to any delayed moves
+                    if (!update_flush_count && i < flush_count) {
+                        double mc_v2 = peak_cruise_v2;
+                        int j;
+                        for (j = delayed_count - 1; j >= 0; j--) {
+                            struct delayed_move *dm = &delayed[j];
+                            mc_v2 = fmin(mc_v2, dm->start_v2);
+                            set_junction(&moves[dm->index]
+                                         , fmin(dm->start_v2, mc_v2), mc_v2
+                                         , fmin(dm->end_v2, mc_v2));
+                        }
+                    }
+                    delayed_count = 0;
+                }
+            }
+            if (!update_flush_count && i < flush_count) {
+                double cruise_v2 = fmin((start_v2 + reachable_start_v2) * .5
+                                        , m->max_cruise_v2);
+                cruise_v2 = fmin(cruise_v2, peak_cruise_v2);
+                set_junction(m, fmin(start_v2, cruise_v2), cruise_v2
+                             , fmin(next_end_v2, cruise_v2));
+            }
+        } else {
+            // Delay calculating this move until peak_cruise_v2 is known
+            struct delayed_move *dm = &delayed[delayed_count++];
+            dm->index = i;
+            dm->start_v2 = start_v2;
+            dm->end_v2 = next_end_v2;
+        }
+        next_end_v2 = start_v2;
+        next_smoothed_v2 = smoothed_v2;
+    }
+    if (update_flush_count)
+        return 0;
+    return flush_count;
+}
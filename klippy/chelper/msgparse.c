@@ -0,0 +1,153 @@
+// Decoding of received messages using the mcu identify dictionary
+//
+// Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <stdint.h> // uint8_t
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "serialqueue.h" // MESSAGE_MAX
+
+// This code mirrors MessageParser.parse() in msgproto.py (which
+// remains the reference implementation).  Any message that this code
+// can not decode results in an error return so that the caller may
+// fall back to the python code.
+
+enum {
+    MP_UINT = 0, MP_INT = 1, MP_STRING = 2,
+};
+
+#define MAX_VLQ_BYTES 5
+
+struct msgparse_format {
+    int param_count;
+    uint8_t param_types[MESSAGE_PAYLOAD_MAX];
+};
+
+struct msgparse {
+    struct msgparse_format *formats[256];
+};
+
+// Allocate a new 'msgparse' object
+struct msgparse * __visible
+msgparse_alloc(void)
+{
+    struct msgparse *mp = malloc(sizeof(*mp));
+    memset(mp, 0, sizeof(*mp));
+    return mp;
+}
+
+// Free memory associated with a 'msgparse' object
+void __visible
+msgparse_free(struct msgparse *mp)
+{
+    if (!mp)
+        return;
+    int i;
+    for (i=0; i<ARRAY_SIZE(mp->formats); i++)
+        free(mp->formats[i]);
+    free(mp);
+}
+
+// Register the parameter types of a message id
+int __visible
+msgparse_add_format(struct msgparse *mp, int msgid, uint8_t *param_types
+                    , int param_count)
+{
+    if (msgid < 0 || msgid >= ARRAY_SIZE(mp->formats)
+        || param_count < 0 || param_count > MESSAGE_PAYLOAD_MAX)
+        return -1;
+    struct msgparse_format *mf = mp->formats[msgid];
+    if (!mf) {
+        mf = mp->formats[msgid] = malloc(sizeof(*mf));
+        memset(mf, 0, sizeof(*mf));
+    }
+    mf->param_count = param_count;
+    memcpy(mf->param_types, param_types, param_count);
+    return 0;
+}
+
+// Decode a variable length quantity integer
+static inline int
+parse_int(uint8_t *msg, int *ppos, int end, int is_signed, int64_t *pv)
+{
+    int pos = *ppos;
+    if (pos >= end)
+        return -1;
+    uint8_t c = msg[pos++];
+    uint64_t v = c & 0x7f;
+    if ((c & 0x60) == 0x60)
+        v |= -0x20;
+    int count = 1;
+    while (c & 0x80) {
+        if (pos >= end || count++ >= MAX_VLQ_BYTES)
+            return -1;
+        c = msg[pos++];
+        v = (v << 7) | (c & 0x7f);
+    }
+    if (!is_signed)
+        v &= 0xffffffff;
+    *pv = (int64_t)v;
+    *ppos = pos;
+    return 0;
+}
+
+// Decode the parameters of a message block containing a single
+// message.  Integer parameters are stored in 'args' and string
+// parameters store the offset of their length byte within 'msg'.
+// Returns the number of parameters or -1 if the message could not be
+// decoded.
+static int
+parse_message(struct msgparse *mp, uint8_t *msg, int len, int64_t *args)
+{
+    if (len <= MESSAGE_MIN || len > MESSAGE_MAX)
+        return -1;
+    int end = len - MESSAGE_TRAILER_SIZE, pos = MESSAGE_HEADER_SIZE;
+    struct msgparse_format *mf = mp->formats[msg[pos++]];
+    if (!mf)
+        return -1;
+    int i;
+    for (i=0; i<mf->param_count; i++) {
+        int type = mf->param_types[i];
+        if (type == MP_STRING) {
+            if (pos >= end)
+                return -1;
+            args[i] = pos;
+            pos += msg[pos] + 1;
+            if (pos > end)
+                return -1;
+            continue;
+        }
+        int ret = parse_int(msg, &pos, end, type == MP_INT, &args[i]);
+        if (ret)
+            return -1;
+    }
+    if (pos != end)
+        return -1;
+    return mf->param_count;
+}
+
+// Decode a batch of messages obtained from serialqueue_pull_batch().
+// For each message the message id (or -1 if the message could not be
+// decoded) is stored in 'args' followed by the message parameters.
+// Returns the number of entries stored in 'args'.
+int __visible
+msgparse_parse_batch(struct msgparse *mp, struct pull_queue_message *q
+                     , int count, int64_t *args)
+{
+    int64_t *start = args;
+    int i;
+    for (i=0; i<count; i++) {
+        struct pull_queue_message *pqm = &q[i];
+        int ret = parse_message(mp, pqm->msg, pqm->len, &args[1]);
+        if (ret < 0) {
+            *args++ = -1;
+            continue;
+        }
+        *args = pqm->msg[MESSAGE_HEADER_SIZE];
+        args += ret + 1;
+    }
+    return args - start;
+}
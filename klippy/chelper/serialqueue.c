@@ -379,6 +379,8 @@ struct serialqueue {
     struct list_head old_sent, old_receive;
     // Stats
     uint32_t bytes_write, bytes_read, bytes_retransmit, bytes_invalid;
+    uint32_t encode_count;
+    double encode_time;
 };
 
 #define SQPF_SERIAL 0
@@ -818,6 +820,10 @@ background_thread(void *data)
     struct serialqueue *sq = data;
     pollreactor_run(&sq->pr);
 
+    if (sq->receive_seq == (uint64_t)-1)
+        // Write out any messages still queued for an output file
+        command_event(sq, get_monotonic());
+
     pthread_mutex_lock(&sq->lock);
     check_wake_receive(sq);
     pthread_mutex_unlock(&sq->lock);
@@ -1003,6 +1009,94 @@ serialqueue_send(struct serialqueue *sq, struct command_queue *cq, uint8_t *msg
     serialqueue_send_batch(sq, cq, &msgs);
 }
 
+enum {
+    CE_INT = 0, CE_BUFFER = 1,
+};
+
+struct command_encoder {
+    uint32_t msgid;
+    int param_count;
+    uint8_t param_types[MESSAGE_PAYLOAD_MAX];
+};
+
+// Allocate an encoder for a command with the given parameter types
+struct command_encoder * __visible
+command_encoder_alloc(uint32_t msgid, uint8_t *param_types, int param_count)
+{
+    if (param_count < 0 || param_count > MESSAGE_PAYLOAD_MAX)
+        return NULL;
+    struct command_encoder *ce = malloc(sizeof(*ce));
+    memset(ce, 0, sizeof(*ce));
+    ce->msgid = msgid;
+    ce->param_count = param_count;
+    memcpy(ce->param_types, param_types, param_count);
+    return ce;
+}
+
+// Free memory associated with a 'command_encoder' object
+void __visible
+command_encoder_free(struct command_encoder *ce)
+{
+    free(ce);
+}
+
+// Encode a command and schedule its transmission.  The 'args' array
+// contains the integer parameters of the command; for buffer
+// parameters it contains the buffer length and the buffer contents
+// are read (in order) from 'buf'.  Returns 0 on success or -1 if the
+// command could not be encoded.
+int __visible
+serialqueue_send_encode(struct serialqueue *sq, struct command_queue *cq
+                        , struct command_encoder *ce, int64_t *args
+                        , int args_len, uint8_t *buf, int buf_len
+                        , uint64_t min_clock, uint64_t req_clock
+                        , uint64_t notify_id)
+{
+    if (args_len < ce->param_count)
+        return -1;
+    double start_time = get_monotonic();
+    struct queue_message *qm = message_alloc();
+    uint8_t *p = qm->msg, *end = &qm->msg[MESSAGE_PAYLOAD_MAX];
+    *p++ = ce->msgid;
+    int i;
+    for (i=0; i<ce->param_count; i++) {
+        if (ce->param_types[i] == CE_BUFFER) {
+            uint32_t len = args[i];
+            if (len > end - p - 1 || len > buf_len)
+                goto fail;
+            buf_len -= len;
+            *p++ = len;
+            memcpy(p, buf, len);
+            p += len;
+            buf += len;
+            continue;
+        }
+        p = encode_int(p, args[i]);
+        if (p > end)
+            goto fail;
+    }
+    qm->len = p - qm->msg;
+    qm->min_clock = min_clock;
+    qm->req_clock = req_clock;
+    qm->notify_id = notify_id;
+    double encode_time = get_monotonic() - start_time;
+
+    pthread_mutex_lock(&sq->lock);
+    sq->encode_count++;
+    sq->encode_time += encode_time;
+    pthread_mutex_unlock(&sq->lock);
+
+    struct list_head msgs;
+    list_init(&msgs);
+    list_add_tail(&qm->node, &msgs);
+    serialqueue_send_batch(sq, cq, &msgs);
+    return 0;
+
+fail:
+    message_free(qm);
+    return -1;
+}
+
 // Return a message read from the serial port (or wait for one if none
 // available)
 void __visible
@@ -1043,6 +1137,49 @@ exit:
     pthread_mutex_unlock(&sq->lock);
 }
 
+// Return all messages read from the serial port (up to 'max') or wait
+// for one if none available.  Returns the number of messages stored in
+// 'q' or -1 if the serialqueue is exiting.
+int __visible
+serialqueue_pull_batch(struct serialqueue *sq, struct pull_queue_message *q
+                       , int max)
+{
+    pthread_mutex_lock(&sq->lock);
+    // Wait for message to be available
+    while (list_empty(&sq->receive_queue)) {
+        if (pollreactor_is_exit(&sq->pr)) {
+            pthread_mutex_unlock(&sq->lock);
+            return -1;
+        }
+        sq->receive_waiting = 1;
+        int ret = pthread_cond_wait(&sq->cond, &sq->lock);
+        if (ret)
+            report_errno("pthread_cond_wait", ret);
+    }
+
+    // Copy out available messages
+    int count = 0;
+    while (count < max && !list_empty(&sq->receive_queue)) {
+        struct queue_message *qm = list_first_entry(
+            &sq->receive_queue, struct queue_message, node);
+        list_del(&qm->node);
+
+        struct pull_queue_message *pqm = &q[count++];
+        memcpy(pqm->msg, qm->msg, qm->len);
+        pqm->len = qm->len;
+        pqm->sent_time = qm->sent_time;
+        pqm->receive_time = qm->receive_time;
+        pqm->notify_id = qm->notify_id;
+        if (qm->len)
+            debug_queue_add(&sq->old_receive, qm);
+        else
+            message_free(qm);
+    }
+
+    pthread_mutex_unlock(&sq->lock);
+    return count;
+}
+
 void __visible
 serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust)
 {
@@ -1086,12 +1223,16 @@ serialqueue_get_stats(struct serialqueue *sq, char *buf, int len)
              " send_seq=%u receive_seq=%u retransmit_seq=%u"
              " srtt=%.3f rttvar=%.3f rto=%.3f"
              " ready_bytes=%u stalled_bytes=%u"
+             " encode_msgs=%u encode_ns=%.1f"
              , stats.bytes_write, stats.bytes_read
              , stats.bytes_retransmit, stats.bytes_invalid
              , (int)stats.send_seq, (int)stats.receive_seq
              , (int)stats.retransmit_seq
              , stats.srtt, stats.rttvar, stats.rto
-             , stats.ready_bytes, stats.stalled_bytes);
+             , stats.ready_bytes, stats.stalled_bytes
+             , stats.encode_count
+             , (stats.encode_count
+                ? stats.encode_time * 1000000000. / stats.encode_count : 0.));
 }
 
 // Extract old messages stored in the debug queues
@@ -58,6 +58,8 @@ void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
                       , uint8_t *msg, int len, uint64_t min_clock
                       , uint64_t req_clock, uint64_t notify_id);
 void serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm);
+int serialqueue_pull_batch(struct serialqueue *sq, struct pull_queue_message *q
+                           , int max);
 void serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust);
 void serialqueue_set_clock_est(struct serialqueue *sq, double est_freq
                                , double last_clock_time, uint64_t last_clock);
@@ -0,0 +1,166 @@
+// Generate steps for several steppers using a pool of worker threads
+//
+// Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <pthread.h> // pthread_create
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "itersolve.h" // itersolve_generate_steps
+#include "pyhelper.h" // report_errno
+#include "trapq.h" // trapq_check_sentinels
+
+// Each stepper has its own stepper_kinematics and stepcompress state,
+// so step generation for different steppers may run concurrently.
+// The only shared state is the trapq, which is only read once its
+// sentinels are up to date.  The queue_step messages produced for
+// each stepper do not depend on which thread generated them.
+
+struct stepgen_pool {
+    pthread_mutex_t lock;
+    pthread_cond_t cond;
+    pthread_t *threads;
+    int num_threads, started_threads, must_exit;
+    // Current batch of work
+    uint64_t batch_id;
+    struct stepper_kinematics **sk_list;
+    int32_t *results;
+    int sk_count, next_sk, active_workers;
+    double flush_time;
+};
+
+// Generate steps for the remaining steppers of the current batch
+static void
+run_batch(struct stepgen_pool *sp)
+{
+    for (;;) {
+        int i = __atomic_fetch_add(&sp->next_sk, 1, __ATOMIC_RELAXED);
+        if (i >= sp->sk_count)
+            break;
+        sp->results[i] = itersolve_generate_steps(sp->sk_list[i]
+                                                  , sp->flush_time);
+    }
+}
+
+// Main code for each worker thread
+static void *
+worker_thread(void *data)
+{
+    struct stepgen_pool *sp = data;
+    uint64_t batch_id = 0;
+    pthread_mutex_lock(&sp->lock);
+    for (;;) {
+        while (!sp->must_exit && sp->batch_id == batch_id)
+            pthread_cond_wait(&sp->cond, &sp->lock);
+        if (sp->must_exit)
+            break;
+        batch_id = sp->batch_id;
+        pthread_mutex_unlock(&sp->lock);
+
+        run_batch(sp);
+
+        pthread_mutex_lock(&sp->lock);
+        if (!--sp->active_workers)
+            pthread_cond_broadcast(&sp->cond);
+    }
+    pthread_mutex_unlock(&sp->lock);
+    return NULL;
+}
+
+// Allocate a pool with 'num_threads' total threads of execution (the
+// calling thread is one of them)
+struct stepgen_pool * __visible
+stepgen_pool_alloc(int num_threads)
+{
+    struct stepgen_pool *sp = malloc(sizeof(*sp));
+    memset(sp, 0, sizeof(*sp));
+    pthread_mutex_init(&sp->lock, NULL);
+    pthread_cond_init(&sp->cond, NULL);
+    if (num_threads < 1)
+        num_threads = 1;
+    sp->num_threads = num_threads - 1;
+    if (!sp->num_threads)
+        return sp;
+    sp->threads = malloc(sp->num_threads * sizeof(sp->threads[0]));
+    int i;
+    for (i = 0; i < sp->num_threads; i++) {
+        int ret = pthread_create(&sp->threads[i], NULL, worker_thread, sp);
+        if (ret) {
+            report_errno("stepgen pthread_create", ret);
+            break;
+        }
+    }
+    sp->started_threads = i;
+    return sp;
+}
+
+// Stop the worker threads and free the pool
+void __visible
+stepgen_pool_free(struct stepgen_pool *sp)
+{
+    pthread_mutex_lock(&sp->lock);
+    sp->must_exit = 1;
+    pthread_cond_broadcast(&sp->cond);
+    pthread_mutex_unlock(&sp->lock);
+    int i;
+    for (i = 0; i < sp->started_threads; i++)
+        pthread_join(sp->threads[i], NULL);
+    pthread_cond_destroy(&sp->cond);
+    pthread_mutex_destroy(&sp->lock);
+    free(sp->threads);
+    free(sp->results);
+    free(sp);
+}
+
+// Generate steps up to 'flush_time' for every stepper in 'sk_list'.
+// Returns zero on success, otherwise the error code of the first
+// stepper (in list order) that failed.
+int32_t __visible
+stepgen_pool_generate_steps(struct stepgen_pool *sp
+                            , struct stepper_kinematics **sk_list
+                            , int sk_count, double flush_time)
+{
+    // Update trapq sentinels before any worker may read the trapq
+    int i;
+    for (i = 0; i < sk_count; i++)
+        if (sk_list[i]->tq)
+            trapq_check_sentinels(sk_list[i]->tq);
+    if (!sp->started_threads || sk_count <= 1) {
+        for (i = 0; i < sk_count; i++) {
+            int32_t ret = itersolve_generate_steps(sk_list[i], flush_time);
+            if (ret)
+                return ret;
+        }
+        return 0;
+    }
+    sp->results = realloc(sp->results, sk_count * sizeof(sp->results[0]));
+    if (!sp->results)
+        return -1;
+
+    // Wake the workers and help them process the batch
+    pthread_mutex_lock(&sp->lock);
+    sp->sk_list = sk_list;
+    sp->sk_count = sk_count;
+    sp->flush_time = flush_time;
+    sp->next_sk = 0;
+    sp->active_workers = sp->started_threads;
+    sp->batch_id++;
+    pthread_cond_broadcast(&sp->cond);
+    pthread_mutex_unlock(&sp->lock);
+
+    run_batch(sp);
+
+    // Wait for all workers to finish
+    pthread_mutex_lock(&sp->lock);
+    while (sp->active_workers)
+        pthread_cond_wait(&sp->cond, &sp->lock);
+    sp->sk_list = NULL;
+    pthread_mutex_unlock(&sp->lock);
+
+    for (i = 0; i < sk_count; i++)
+        if (sp->results[i])
+            return sp->results[i];
+    return 0;
+}
@@ -68,6 +68,19 @@ trapq_append(struct trapq *tq, double print_time
     }
 }
 
+// Append a batch of moves to the trapezoid velocity queue.  The 'data'
+// array contains groups of the thirteen trapq_append() parameters
+// (in the same order) and 'len' is the total number of values.
+void __visible
+trapq_append_batch(struct trapq *tq, double *data, int len)
+{
+    for (; len >= TRAPQ_APPEND_PARAMS; len -= TRAPQ_APPEND_PARAMS
+         , data += TRAPQ_APPEND_PARAMS)
+        trapq_append(tq, data[0], data[1], data[2], data[3], data[4], data[5]
+                     , data[6], data[7], data[8], data[9], data[10], data[11]
+                     , data[12]);
+}
+
 // Return the distance moved given a time in a move
 inline double
 move_get_distance(struct move *m, double move_time)
@@ -24,12 +24,15 @@ struct trapq {
     struct list_head moves;
 };
 
+#define TRAPQ_APPEND_PARAMS 13
+
 struct move *move_alloc(void);
 void trapq_append(struct trapq *tq, double print_time
                   , double accel_t, double cruise_t, double decel_t
                   , double start_pos_x, double start_pos_y, double start_pos_z
                   , double axes_r_x, double axes_r_y, double axes_r_z
                   , double start_v, double cruise_v, double accel);
+void trapq_append_batch(struct trapq *tq, double *data, int len);
 double move_get_distance(struct move *m, double move_time);
 struct coord move_get_coord(struct move *m, double move_time);
 struct trapq *trapq_alloc(void);
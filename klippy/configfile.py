@@ -94,6 +94,7 @@ class PrinterConfig:
         self.printer = printer
         self.autosave = None
         self.status_info = {}
+        self.status_version = 0
         gcode = self.printer.lookup_object('gcode')
         gcode.register_command("SAVE_CONFIG", self.cmd_SAVE_CONFIG,
                                desc=self.cmd_SAVE_CONFIG_help)
@@ -254,12 +255,15 @@ class PrinterConfig:
     # Status reporting
     def _build_status(self, config):
         self.status_info.clear()
+        self.status_version += 1
         for section in config.get_prefix_sections(''):
             self.status_info[section.get_name()] = section_status = {}
             for option in section.get_prefix_options(''):
                 section_status[option] = section.get(option, note_valid=False)
     def get_status(self, eventtime):
         return {'config': self.status_info}
+    def get_status_version(self):
+        return self.status_version
     # Autosave functions
     def set(self, section, option, value):
         if not self.autosave.fileconfig.has_section(section):
@@ -3,9 +3,14 @@
 # Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, time, collections
+import logging, time, collections, array, sys, base64
 from . import bus
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # ADXL345 registers
 REG_DEVID = 0x00
 REG_BW_RATE = 0x2C
@@ -22,17 +27,113 @@ QUERY_RATES = {
 
 SCALE = 0.004 * 9.80665 * 1000. # 4mg/LSB * Earth gravity in mm/s**2
 
+SAMPLES_PER_BLOCK = 8
+BYTES_PER_SAMPLE = 6
+BYTES_PER_BLOCK = SAMPLES_PER_BLOCK * BYTES_PER_SAMPLE
+# Avoid filling up memory with too many samples (~80 minutes at 3200hz)
+MAX_BLOCKS = 2000000
+
+STREAM_INTERVAL = .100
+# Minimum span of received samples before streamed sample times use
+# the clock-synced sample period instead of the nominal one
+STREAM_MIN_ESTIMATE_TIME = 1.
+# Missing blocks further back than this are treated as dropped
+STREAM_MAX_LATE_BLOCKS = 1024
+# Pending data (in bytes) a streaming client may have before batches
+# of samples are dropped for that client
+STREAM_MAX_PENDING = 512 * 1024
+
 Accel_Measurement = collections.namedtuple(
     'Accel_Measurement', ('time', 'accel_x', 'accel_y', 'accel_z'))
 
+# Storage for raw sample blocks (accessed from background thread)
+class ADXL345RawSamples:
+    def __init__(self):
+        # Each block is stored at a fixed position (based on its
+        # sequence) so that missing blocks leave a gap in the buffer
+        self.data = bytearray(BYTES_PER_BLOCK * 1024)
+        self.counts = array.array('B', [0] * 1024)
+        self.last_count = 0
+        self.have_blocks = False
+    def _grow(self, sequence):
+        size = len(self.counts)
+        new_size = min(max(sequence + 1, size * 2), MAX_BLOCKS)
+        self.data.extend(bytearray(BYTES_PER_BLOCK * (new_size - size)))
+        self.counts.extend([0] * (new_size - size))
+    def add_block(self, sequence, data):
+        if sequence >= len(self.counts):
+            if sequence >= MAX_BLOCKS:
+                return
+            self._grow(sequence)
+        count = min(len(data), BYTES_PER_BLOCK) // BYTES_PER_SAMPLE
+        pos = sequence * BYTES_PER_BLOCK
+        self.data[pos:pos + count * BYTES_PER_SAMPLE] = data[
+            :count * BYTES_PER_SAMPLE]
+        self.counts[sequence] = self.last_count = count
+        self.have_blocks = True
+
+# Estimate the time between samples from the mcu times of the first
+# sample and of the end of the last stored block
+def calc_time_per_sample(start_time, end_time, end_sequence, last_count):
+    total_count = (end_sequence - 1) * SAMPLES_PER_BLOCK + last_count
+    return (end_time - start_time) / total_count, total_count
+
+# Decode the samples of consecutive raw blocks ('counts' holds the
+# number of samples in each block).  Returns a list of Accel_Measurement.
+def decode_samples(axes_map, data, counts, start_time, time_per_sample):
+    (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = axes_map
+    seq_to_time = time_per_sample * SAMPLES_PER_BLOCK
+    sdata = array.array('h')
+    sdata.fromstring(bytes(data[:len(counts) * BYTES_PER_BLOCK]))
+    if sys.byteorder != 'little':
+        sdata.byteswap()
+    samples = []
+    for seq in range(len(counts)):
+        seq_time = start_time + seq * seq_to_time
+        pos = seq * SAMPLES_PER_BLOCK * 3
+        for i in range(counts[seq]):
+            samples.append(Accel_Measurement(
+                seq_time + i * time_per_sample, sdata[pos + x_pos] * x_scale,
+                sdata[pos + y_pos] * y_scale, sdata[pos + z_pos] * z_scale))
+            pos += 3
+    return samples
+
+# Vectorized version of decode_samples() - returns an Nx4 numpy array
+def decode_samples_numpy(axes_map, data, counts, start_time,
+                         time_per_sample):
+    block_count = len(counts)
+    sdata = numpy.frombuffer(data, dtype='<i2',
+                             count=block_count * SAMPLES_PER_BLOCK * 3)
+    sdata = sdata.reshape(block_count, SAMPLES_PER_BLOCK, 3)
+    counts = numpy.frombuffer(counts, dtype=numpy.uint8)
+    indexes = numpy.arange(SAMPLES_PER_BLOCK)
+    valid = indexes[numpy.newaxis, :] < counts[:, numpy.newaxis]
+    seq_times = (start_time + numpy.arange(block_count)
+                 * (time_per_sample * SAMPLES_PER_BLOCK))
+    times = seq_times[:, numpy.newaxis] + indexes * time_per_sample
+    sdata = sdata[valid]
+    samples = numpy.empty((len(sdata), 4))
+    samples[:, 0] = times[valid]
+    for i, (pos, scale) in enumerate(axes_map):
+        samples[:, i + 1] = sdata[:, pos] * scale
+    return samples
+
 # Sample results
 class ADXL345Results:
     def __init__(self):
         self.samples = []
+        self.sample_array = None
         self.drops = self.overflows = 0
         self.time_per_sample = self.start_range = self.end_range = 0.
     def get_samples(self):
+        if self.sample_array is not None and not self.samples:
+            self.samples = [Accel_Measurement(*s)
+                            for s in self.sample_array.tolist()]
         return self.samples
+    def get_sample_count(self):
+        if self.sample_array is not None:
+            return len(self.sample_array)
+        return len(self.samples)
     def get_stats(self):
         return ("drops=%d,overflows=%d"
                 ",time_per_sample=%.9f,start_range=%.6f,end_range=%.6f"
@@ -40,33 +141,189 @@ class ADXL345Results:
                    self.time_per_sample, self.start_range, self.end_range))
     def setup_data(self, axes_map, raw_samples, end_sequence, overflows,
                    start1_time, start2_time, end1_time, end2_time):
-        if not raw_samples or not end_sequence:
+        if not raw_samples.have_blocks or not end_sequence:
             return
-        (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = axes_map
         self.overflows = overflows
         self.start_range = start2_time - start1_time
         self.end_range = end2_time - end1_time
-        total_count = (end_sequence - 1) * 8 + len(raw_samples[-1][1]) // 6
-        total_time = end2_time - start2_time
-        self.time_per_sample = time_per_sample = total_time / total_count
-        seq_to_time = time_per_sample * 8.
-        self.samples = samples = [None] * total_count
-        actual_count = 0
-        for seq, data in raw_samples:
-            d = bytearray(data)
-            count = len(data)
-            sdata = [(d[i] | (d[i+1] << 8)) - ((d[i+1] & 0x80) << 9)
-                     for i in range(0, count-1, 2)]
-            seq_time = start2_time + seq * seq_to_time
-            for i in range(count//6):
-                samp_time = seq_time + i * time_per_sample
-                x = sdata[i*3 + x_pos] * x_scale
-                y = sdata[i*3 + y_pos] * y_scale
-                z = sdata[i*3 + z_pos] * z_scale
-                samples[actual_count] = Accel_Measurement(samp_time, x, y, z)
-                actual_count += 1
-        del samples[actual_count:]
-        self.drops = total_count - actual_count
+        time_per_sample, total_count = calc_time_per_sample(
+            start2_time, end2_time, end_sequence, raw_samples.last_count)
+        self.time_per_sample = time_per_sample
+        counts = raw_samples.counts[:end_sequence]
+        if numpy is not None:
+            self.sample_array = decode_samples_numpy(
+                axes_map, raw_samples.data, counts, start2_time,
+                time_per_sample)
+        else:
+            self.samples = decode_samples(
+                axes_map, raw_samples.data, counts, start2_time,
+                time_per_sample)
+        self.drops = total_count - self.get_sample_count()
+    def write_csv(self, f):
+        f.write("##%s\n#time,accel_x,accel_y,accel_z\n" % (self.get_stats(),))
+        for t, accel_x, accel_y, accel_z in self.get_samples():
+            f.write("%.6f,%.6f,%.6f,%.6f\n" % (t, accel_x, accel_y, accel_z))
+    def write_binary(self, f):
+        # Text header followed by little-endian 64bit floats
+        f.write("##%s\n#time,accel_x,accel_y,accel_z float64 count=%d\n" % (
+            self.get_stats(), self.get_sample_count()))
+        if self.sample_array is not None:
+            self.sample_array.astype('<f8').tofile(f)
+            return
+        data = array.array('d', [v for s in self.samples for v in s])
+        if sys.byteorder != 'little':
+            data.byteswap()
+        data.tofile(f)
+
+# Streaming of measurements to webhooks clients
+class ADXL345Streamer:
+    def __init__(self, adxl345):
+        self.adxl345 = adxl345
+        self.reactor = adxl345.printer.get_reactor()
+        self.clients = {}
+        self.stream_timer = None
+        self.next_sequence = 0
+        self.missing_blocks = []
+        self.time_per_sample = 0.
+    def add_client(self, web_request):
+        cconn = web_request.get_client_connection()
+        template = web_request.get_dict('response_template', {})
+        output_format = web_request.get_str('format', 'json')
+        if output_format not in ['json', 'binary']:
+            raise web_request.error("Invalid adxl345 format parameter")
+        self.clients[cconn] = [template, output_format, 0]
+        web_request.send({'header': ['time', 'accel_x', 'accel_y', 'accel_z'],
+                          'format': output_format})
+        if self.adxl345.query_rate:
+            self._start_timer()
+    def _start_timer(self):
+        if self.stream_timer is None:
+            self.stream_timer = self.reactor.register_timer(
+                self._stream_event, self.reactor.NOW)
+    def _stop_timer(self):
+        if self.stream_timer is not None:
+            self.reactor.unregister_timer(self.stream_timer)
+            self.stream_timer = None
+    def start(self, rate):
+        self.next_sequence = 0
+        self.missing_blocks = []
+        # Times are based on the nominal rate until enough samples are
+        # received to estimate the actual rate
+        self.time_per_sample = 1. / rate
+        if self.clients:
+            self._start_timer()
+    def finish(self, end_sequence, raw_samples, res):
+        self._stop_timer()
+        if res.time_per_sample:
+            self.time_per_sample = res.time_per_sample
+        self.flush(end_sequence, raw_samples, {'stats': res.get_stats()})
+    def _update_time_per_sample(self, raw_samples):
+        adxl345 = self.adxl345
+        start_time = adxl345.samples_start2
+        end_time = adxl345.mcu.estimated_print_time(adxl345.last_receive_time)
+        if end_time - start_time < STREAM_MIN_ESTIMATE_TIME:
+            return
+        self.time_per_sample = calc_time_per_sample(
+            start_time, end_time, adxl345.last_sequence + 1,
+            raw_samples.last_count)[0]
+    def _stream_event(self, eventtime):
+        adxl345 = self.adxl345
+        raw_samples = adxl345.raw_samples
+        self._update_time_per_sample(raw_samples)
+        # The most recent block may still be in the process of being stored
+        self.flush(adxl345.last_sequence, raw_samples)
+        if not self.clients:
+            self.stream_timer = None
+            return self.reactor.NEVER
+        return eventtime + STREAM_INTERVAL
+    def _encode(self, samples, output_format):
+        if output_format == 'binary':
+            if numpy is not None:
+                data = samples.astype('<f8').tostring()
+            else:
+                data = array.array('d', [v for s in samples for v in s])
+                if sys.byteorder != 'little':
+                    data.byteswap()
+                data = data.tostring()
+            return base64.b64encode(data)
+        if numpy is not None:
+            samples = samples.tolist()
+        return [[round(t, 6), round(x, 3), round(y, 3), round(z, 3)]
+                for t, x, y, z in samples]
+    def _decode(self, raw_samples, start_sequence, end_sequence):
+        adxl345 = self.adxl345
+        time_per_sample = self.time_per_sample
+        start_time = (adxl345.samples_start2 + start_sequence
+                      * SAMPLES_PER_BLOCK * time_per_sample)
+        counts = raw_samples.counts[start_sequence:end_sequence]
+        data = raw_samples.data[start_sequence * BYTES_PER_BLOCK
+                                :end_sequence * BYTES_PER_BLOCK]
+        if numpy is not None:
+            return decode_samples_numpy(adxl345.axes_map, data, counts,
+                                        start_time, time_per_sample)
+        return decode_samples(adxl345.axes_map, data, counts,
+                              start_time, time_per_sample)
+    def _check_blocks(self, raw_samples, end_sequence):
+        # Returns the ranges of blocks to send - blocks are sent once
+        # they are stored, even if that is after later blocks were sent
+        start_sequence = self.next_sequence
+        end_sequence = max(end_sequence, start_sequence)
+        self.next_sequence = end_sequence
+        counts = raw_samples.counts
+        stored = min(end_sequence, len(counts))
+        late = [seq for seq in self.missing_blocks
+                if seq < stored and counts[seq]]
+        missing = [seq for seq in self.missing_blocks
+                   if (seq >= stored or not counts[seq])
+                   and seq >= end_sequence - STREAM_MAX_LATE_BLOCKS]
+        missing.extend([start_sequence + i for i, count in enumerate(
+            counts[start_sequence:stored]) if not count])
+        missing.extend(range(max(start_sequence, stored), end_sequence))
+        self.missing_blocks = missing
+        return [(seq, seq + 1) for seq in late] + [
+            (start_sequence, end_sequence)]
+    def flush(self, end_sequence, raw_samples, extra_params=None):
+        if not self.clients:
+            self.next_sequence = max(end_sequence, self.next_sequence)
+            self.missing_blocks = []
+            return
+        time_per_sample = self.time_per_sample
+        batches = [self._decode(raw_samples, start, end)
+                   for start, end in self._check_blocks(raw_samples,
+                                                        end_sequence)]
+        if numpy is not None:
+            samples = numpy.concatenate(batches)
+        else:
+            samples = [s for batch in batches for s in batch]
+        count = len(samples)
+        if not count and not extra_params:
+            return
+        encoded = {}
+        for cconn, client in list(self.clients.items()):
+            if cconn.is_closed():
+                del self.clients[cconn]
+                continue
+            template, output_format, dropped = client
+            if cconn.get_pending_bytes() > STREAM_MAX_PENDING:
+                # Client is not keeping up - discard this batch
+                client[2] += count
+                if not extra_params:
+                    continue
+                count_sent = 0
+                data = self._encode(samples[:0], output_format)
+            else:
+                count_sent = count
+                data = encoded.get(output_format)
+                if data is None:
+                    data = encoded[output_format] = self._encode(
+                        samples, output_format)
+            params = {'time_per_sample': time_per_sample, 'count': count_sent,
+                      'dropped': client[2], 'data': data}
+            if extra_params:
+                params.update(extra_params)
+            tmp = dict(template)
+            tmp['params'] = params
+            cconn.send(tmp)
 
 # Printer class that controls measurments
 class ADXL345:
@@ -81,8 +338,9 @@ class ADXL345:
             raise config.error("Invalid adxl345 axes_map parameter")
         self.axes_map = [am[a.strip()] for a in axes_map]
         # Measurement storage (accessed from background thread)
-        self.raw_samples = []
+        self.raw_samples = ADXL345RawSamples()
         self.last_sequence = 0
+        self.last_receive_time = 0.
         self.samples_start1 = self.samples_start2 = 0.
         # Setup mcu sensor_adxl345 bulk query code
         self.spi = bus.MCU_SPI_from_config(config, 3, default_speed=5000000)
@@ -107,6 +365,14 @@ class ADXL345:
         if name == "default":
             gcode.register_mux_command("ACCELEROMETER_MEASURE", "CHIP", None,
                                        self.cmd_ACCELEROMETER_MEASURE)
+        # Register webhooks
+        self.streamer = ADXL345Streamer(self)
+        wh = self.printer.lookup_object('webhooks')
+        wh.register_mux_endpoint("adxl345/dump_adxl345", "sensor", name,
+                                 self._handle_dump_adxl345)
+        if name == "default":
+            wh.register_mux_endpoint("adxl345/dump_adxl345", "sensor", None,
+                                     self._handle_dump_adxl345)
     def _build_config(self):
         self.query_adxl345_cmd = self.mcu.lookup_command(
             "query_adxl345 oid=%c clock=%u rest_ticks=%u",
@@ -127,11 +393,8 @@ class ADXL345:
         if sequence < last_sequence:
             sequence += 0x10000
         self.last_sequence = sequence
-        raw_samples = self.raw_samples
-        if len(raw_samples) >= 200000:
-            # Avoid filling up memory with too many samples
-            return
-        raw_samples.append((sequence, params['data']))
+        self.last_receive_time = params['#receive_time']
+        self.raw_samples.add_block(sequence, params['data'])
     def _convert_sequence(self, sequence):
         sequence = (self.last_sequence & ~0xffff) | sequence
         if sequence < self.last_sequence:
@@ -157,7 +420,7 @@ class ADXL345:
         self.spi.spi_send([REG_FIFO_CTL, 0x80])
         # Setup samples
         print_time = self.printer.lookup_object('toolhead').get_last_move_time()
-        self.raw_samples = []
+        self.raw_samples = ADXL345RawSamples()
         self.last_sequence = 0
         self.samples_start1 = self.samples_start2 = print_time
         # Start bulk reading
@@ -167,6 +430,7 @@ class ADXL345:
         self.query_rate = rate
         self.query_adxl345_cmd.send([self.oid, reqclock, rest_ticks],
                                     reqclock=reqclock)
+        self.streamer.start(rate)
     def finish_measurements(self):
         query_rate = self.query_rate
         if not query_rate:
@@ -179,7 +443,7 @@ class ADXL345:
         self.last_tx_time = print_time
         self.query_rate = 0
         raw_samples = self.raw_samples
-        self.raw_samples = []
+        self.raw_samples = ADXL345RawSamples()
         # Generate results
         end1_time = self._clock_to_print_time(params['end1_time'])
         end2_time = self._clock_to_print_time(params['end2_time'])
@@ -189,19 +453,24 @@ class ADXL345:
         res.setup_data(self.axes_map, raw_samples, end_sequence, overflows,
                        self.samples_start1, self.samples_start2,
                        end1_time, end2_time)
+        self.streamer.finish(end_sequence, raw_samples, res)
         logging.info("ADXL345 finished %d measurements: %s",
-                     len(res.get_samples()), res.get_stats())
+                     res.get_sample_count(), res.get_stats())
         return res
-    def end_query(self, name):
+    def end_query(self, name, output_format='csv'):
         if not self.query_rate:
             return
         res = self.finish_measurements()
         # Write data to file
-        f = open("/tmp/adxl345-%s.csv" % (name,), "w")
-        f.write("##%s\n#time,accel_x,accel_y,accel_z\n" % (res.get_stats(),))
-        for t, accel_x, accel_y, accel_z in res.get_samples():
-            f.write("%.6f,%.6f,%.6f,%.6f\n" % (t, accel_x, accel_y, accel_z))
+        if output_format == 'binary':
+            f = open("/tmp/adxl345-%s.bin" % (name,), "wb")
+            res.write_binary(f)
+        else:
+            f = open("/tmp/adxl345-%s.csv" % (name,), "w")
+            res.write_csv(f)
         f.close()
+    def _handle_dump_adxl345(self, web_request):
+        self.streamer.add_client(web_request)
     cmd_ACCELEROMETER_MEASURE_help = "Start/stop accelerometer"
     def cmd_ACCELEROMETER_MEASURE(self, gcmd):
         rate = gcmd.get_int("RATE", 0)
@@ -209,7 +478,10 @@ class ADXL345:
             name = gcmd.get("NAME", time.strftime("%Y%m%d_%H%M%S"))
             if not name.replace('-', '').replace('_', '').isalnum():
                 raise gcmd.error("Invalid adxl345 NAME parameter")
-            self.end_query(name)
+            output_format = gcmd.get("FORMAT", "csv").lower()
+            if output_format not in ['csv', 'binary']:
+                raise gcmd.error("Invalid adxl345 FORMAT parameter")
+            self.end_query(name, output_format)
             gcmd.respond_info("adxl345 measurements stopped")
         elif self.query_rate:
             raise gcmd.error("adxl345 already running")
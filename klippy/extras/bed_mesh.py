@@ -5,14 +5,22 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, math, json, collections
+import chelper
 from . import probe
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 PROFILE_VERSION = 1
 PROFILE_OPTIONS = {
     'min_x': float, 'max_x': float, 'min_y': float, 'max_y': float,
     'x_count': int, 'y_count': int, 'mesh_x_pps': int, 'mesh_y_pps': int,
     'algo': str, 'tension': float
 }
+# Size (in cells on each axis) of the mesh blocks with a stored z range
+MESH_BLOCK_CELLS = 8
 
 class BedMeshError(Exception):
     pass
@@ -74,6 +82,14 @@ class BedMesh:
         self.fade_target = 0.
         self.gcode = self.printer.lookup_object('gcode')
         self.splitter = MoveSplitter(config, self.gcode)
+        modes = {'split': 'split', 'kinematic': 'kinematic'}
+        mode = config.getchoice('compensation_mode', modes, 'split')
+        self.kin_mesh = None
+        if mode == 'kinematic':
+            self.kin_mesh = KinematicMesh(config)
+            self.in_set_position = False
+            self.printer.register_event_handler("toolhead:set_position",
+                                                self.handle_set_position)
         # setup persistent storage
         self.pmgr = ProfileManager(config, self)
         self.save_profile = self.pmgr.save_profile
@@ -95,6 +111,23 @@ class BedMesh:
         self.bmc.print_generated_points(logging.info)
         self.pmgr.initialize()
     def set_mesh(self, mesh):
+        if self.kin_mesh is None:
+            self._set_mesh(mesh)
+            return
+        # Note the physical toolhead position prior to changing the mesh
+        physical_pos = None
+        if self.toolhead is not None:
+            self.toolhead.flush_step_generation()
+            physical_pos = self._calc_physical_position(
+                self.toolhead.get_position())
+        try:
+            self._set_mesh(mesh)
+        finally:
+            self.kin_mesh.set_mesh(self.z_mesh, self.fade_start,
+                                   self.fade_end, self.fade_target)
+            if physical_pos is not None:
+                self.toolhead.set_position(physical_pos)
+    def _set_mesh(self, mesh):
         if mesh is not None and self.fade_end != self.FADE_DISABLE:
             self.log_fade_complete = True
             if self.base_fade_target is None:
@@ -137,30 +170,53 @@ class BedMesh:
             return (self.fade_end - z_pos) / self.fade_dist
         else:
             return 1.
+    def _calc_physical_position(self, pos):
+        # Position of the nozzle when using the kinematic mesh adjustment
+        x, y, z, e = pos
+        if self.z_mesh is None:
+            return [x, y, z, e]
+        factor = self.get_z_factor(z - self.fade_target)
+        return [x, y, z + factor * self.z_mesh.calc_z(x, y), e]
+    def _remove_z_adjustment(self, pos):
+        # return the position minus the current z-adjustment
+        x, y, z, e = pos
+        z_adj = self.z_mesh.calc_z(x, y)
+        factor = 1.
+        max_adj = z_adj + self.fade_target
+        if min(z, (z - max_adj)) >= self.fade_end:
+            # Fade out is complete, no factor
+            factor = 0.
+        elif max(z, (z - max_adj)) >= self.fade_start:
+            # Likely in the process of fading out adjustment.
+            # Because we don't yet know the gcode z position, use
+            # algebra to calculate the factor from the toolhead pos
+            factor = ((self.fade_end + self.fade_target - z) /
+                      (self.fade_dist - z_adj))
+            factor = constrain(factor, 0., 1.)
+        final_z_adj = factor * z_adj + self.fade_target
+        return [x, y, z - final_z_adj, e]
+    def handle_set_position(self):
+        # The toolhead was set to a physical position (eg, after homing),
+        # so convert it to a position prior to the kinematic z-adjustment
+        if self.z_mesh is None or self.in_set_position:
+            return
+        x, y, z, e = self._remove_z_adjustment(self.toolhead.get_position())
+        self.in_set_position = True
+        try:
+            self.toolhead.set_position([x, y, z + self.fade_target, e])
+        finally:
+            self.in_set_position = False
     def get_position(self):
         # Return last, non-transformed position
-        if self.z_mesh is None:
-            # No mesh calibrated, so send toolhead position
+        if self.z_mesh is None or self.kin_mesh is not None:
+            # No mesh calibrated (or the mesh is applied during step
+            # generation), so send toolhead position
             self.last_position[:] = self.toolhead.get_position()
             self.last_position[2] -= self.fade_target
         else:
             # return current position minus the current z-adjustment
-            x, y, z, e = self.toolhead.get_position()
-            z_adj = self.z_mesh.calc_z(x, y)
-            factor = 1.
-            max_adj = z_adj + self.fade_target
-            if min(z, (z - max_adj)) >= self.fade_end:
-                # Fade out is complete, no factor
-                factor = 0.
-            elif max(z, (z - max_adj)) >= self.fade_start:
-                # Likely in the process of fading out adjustment.
-                # Because we don't yet know the gcode z position, use
-                # algebra to calculate the factor from the toolhead pos
-                factor = ((self.fade_end + self.fade_target - z) /
-                          (self.fade_dist - z_adj))
-                factor = constrain(factor, 0., 1.)
-            final_z_adj = factor * z_adj + self.fade_target
-            self.last_position[:] = [x, y, z - final_z_adj, e]
+            self.last_position[:] = self._remove_z_adjustment(
+                self.toolhead.get_position())
         return list(self.last_position)
     def move(self, newpos, speed):
         factor = self.get_z_factor(newpos[2])
@@ -173,6 +229,10 @@ class BedMesh:
                     "bed_mesh fade complete: Current Z: %.4f fade_target: %.4f "
                     % (z, self.fade_target))
             self.toolhead.move([x, y, z + self.fade_target, e], speed)
+        elif self.kin_mesh is not None:
+            # The z-adjustment is applied during step generation
+            x, y, z, e = newpos
+            self.toolhead.move([x, y, z + self.fade_target, e], speed)
         else:
             self.splitter.build_move(self.last_position, newpos, factor)
             while not self.splitter.traverse_complete:
@@ -553,10 +613,43 @@ class MoveSplitter:
         self.z_factor = factor
         self.z_offset = self._calc_z_offset(prev_pos)
         self.traverse_complete = False
-        self.distance_checked = 0.
         axes_d = [self.next_pos[i] - self.prev_pos[i] for i in range(4)]
         self.total_move_length = math.sqrt(sum([d*d for d in axes_d[:3]]))
         self.axis_move = [not isclose(d, 0., abs_tol=1e-10) for d in axes_d]
+        # Lookup the z-adjustment at all check points along the move
+        self.check_index = 0
+        self.check_distances = dists = []
+        self.check_offsets = []
+        if not (self.axis_move[0] or self.axis_move[1]):
+            return
+        # Skip the lookups if the mesh z range under the move shows
+        # that no check point can reach split_delta_z
+        offset = self.z_mesh.mesh_offset
+        z = (self.z_offset - offset) / factor
+        delta_z = self.split_delta_z / factor
+        if self.z_mesh.check_z_bounds(prev_pos[0], prev_pos[1],
+                                      next_pos[0], next_pos[1],
+                                      z - delta_z, z + delta_z):
+            return
+        check_dist = self.move_check_distance
+        total_length = self.total_move_length
+        dist = 0.
+        while dist + check_dist < total_length:
+            dist += check_dist
+            dists.append(dist)
+        if not dists:
+            return
+        coords = []
+        for i in range(2):
+            start, end = self.prev_pos[i], self.next_pos[i]
+            if self.axis_move[i]:
+                coords.append([lerp(d / total_length, start, end)
+                               for d in dists])
+            else:
+                coords.append([start] * len(dists))
+        calc_z = self.z_mesh.calc_z
+        self.check_offsets = [factor * calc_z(x, y) + offset
+                              for x, y in zip(coords[0], coords[1])]
     def _calc_z_offset(self, pos):
         z = self.z_mesh.calc_z(pos[0], pos[1])
         return self.z_factor * z + self.z_mesh.mesh_offset
@@ -572,18 +665,18 @@ class MoveSplitter:
                     t, self.prev_pos[i], self.next_pos[i])
     def split(self):
         if not self.traverse_complete:
-            if self.axis_move[0] or self.axis_move[1]:
-                # X and/or Y axis move, traverse if necessary
-                while self.distance_checked + self.move_check_distance \
-                        < self.total_move_length:
-                    self.distance_checked += self.move_check_distance
-                    self._set_next_move(self.distance_checked)
-                    next_z = self._calc_z_offset(self.current_pos)
-                    if abs(next_z - self.z_offset) >= self.split_delta_z:
-                        self.z_offset = next_z
-                        return self.current_pos[0], self.current_pos[1], \
-                            self.current_pos[2] + self.z_offset, \
-                            self.current_pos[3]
+            # Traverse the check points of X and/or Y axis moves
+            check_offsets = self.check_offsets
+            while self.check_index < len(check_offsets):
+                next_z = check_offsets[self.check_index]
+                self.check_index += 1
+                if abs(next_z - self.z_offset) >= self.split_delta_z:
+                    self._set_next_move(
+                        self.check_distances[self.check_index - 1])
+                    self.z_offset = next_z
+                    return self.current_pos[0], self.current_pos[1], \
+                        self.current_pos[2] + self.z_offset, \
+                        self.current_pos[3]
             # end of move reached
             self.current_pos[:] = self.next_pos
             self.z_offset = self._calc_z_offset(self.current_pos)
@@ -597,9 +690,56 @@ class MoveSplitter:
             return None
 
 
+# Apply the z-adjustment to the z steppers during step generation
+class KinematicMesh:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.stepper_kinematics = []
+        self.orig_stepper_kinematics = []
+        # Wrap the stepper kinematics prior to klippy:connect so that
+        # other wrappers (eg, input_shaper) are applied on top of it
+        self.printer.register_event_handler("klippy:mcu_identify",
+                                            self._handle_mcu_identify)
+    def _handle_mcu_identify(self):
+        kin = self.printer.lookup_object('toolhead').get_kinematics()
+        ffi_main, ffi_lib = chelper.get_ffi()
+        for s in kin.get_steppers():
+            sk = ffi_main.gc(ffi_lib.bed_mesh_alloc(), ffi_lib.bed_mesh_free)
+            orig_sk = s.set_stepper_kinematics(sk)
+            res = ffi_lib.bed_mesh_set_sk(sk, orig_sk)
+            if res < 0:
+                s.set_stepper_kinematics(orig_sk)
+                continue
+            self.stepper_kinematics.append(sk)
+            self.orig_stepper_kinematics.append(orig_sk)
+        if not self.stepper_kinematics:
+            raise self.printer.config_error(
+                "bed_mesh: No z steppers found for kinematic compensation")
+    def set_mesh(self, mesh, fade_start, fade_end, z_offset):
+        ffi_main, ffi_lib = chelper.get_ffi()
+        z_matrix = ffi_main.NULL
+        x_cnt = y_cnt = 0
+        min_x = min_y = x_dist = y_dist = 0.
+        if mesh is not None and mesh.mesh_matrix is not None:
+            z_matrix = ffi_main.new('double[]', [
+                z for line in mesh.mesh_matrix for z in line])
+            x_cnt, y_cnt = mesh.mesh_x_count, mesh.mesh_y_count
+            min_x, min_y = mesh.mesh_x_min, mesh.mesh_y_min
+            x_dist, y_dist = mesh.mesh_x_dist, mesh.mesh_y_dist
+        for sk in self.stepper_kinematics:
+            ret = ffi_lib.bed_mesh_set_mesh(sk, z_matrix, x_cnt, y_cnt,
+                                            min_x, min_y, x_dist, y_dist)
+            if ret:
+                raise BedMeshError("bed_mesh: Unable to load mesh")
+            ffi_lib.bed_mesh_set_fade(sk, fade_start, fade_end, z_offset)
+
+
 class ZMesh:
     def __init__(self, params):
         self.probed_matrix = self.mesh_matrix = None
+        self.mesh_cells = self.block_ranges = None
+        self.block_x_count = 0
+        self.block_x_dist = self.block_y_dist = 1.
         self.mesh_params = params
         self.avg_z = 0.
         self.mesh_offset = 0.
@@ -620,6 +760,9 @@ class ZMesh:
             'bicubic': self._sample_bicubic,
             'direct': self._sample_direct
         }
+        if numpy is not None:
+            interpolation_algos['lagrange'] = self._sample_lagrange_numpy
+            interpolation_algos['bicubic'] = self._sample_bicubic_numpy
         self._sample = interpolation_algos.get(params['algo'])
         # Number of points to interpolate per segment
         mesh_x_pps = params['mesh_x_pps']
@@ -680,6 +823,7 @@ class ZMesh:
     def build_mesh(self, z_matrix):
         self.probed_matrix = z_matrix
         self._sample(z_matrix)
+        self._build_cells()
         self.avg_z = (sum([sum(x) for x in self.mesh_matrix]) /
                       sum([len(x) for x in self.mesh_matrix]))
         # Round average to the nearest 100th.  This
@@ -693,21 +837,75 @@ class ZMesh:
             for y_line in self.mesh_matrix:
                 for idx, z in enumerate(y_line):
                     y_line[idx] = z - self.mesh_offset
+            self._build_cells()
     def get_x_coordinate(self, index):
         return self.mesh_x_min + self.mesh_x_dist * index
     def get_y_coordinate(self, index):
         return self.mesh_y_min + self.mesh_y_dist * index
+    def _build_cells(self):
+        # Store the bilinear coefficients of each mesh cell (in row
+        # major order) such that z = a + b*tx + c*ty + d*tx*ty
+        tbl = self.mesh_matrix
+        cells = []
+        for yidx in range(self.mesh_y_count - 1):
+            row0, row1 = tbl[yidx], tbl[yidx+1]
+            for xidx in range(self.mesh_x_count - 1):
+                z00, z10 = row0[xidx], row0[xidx+1]
+                z01, z11 = row1[xidx], row1[xidx+1]
+                cells.append((z00, z10 - z00, z01 - z00,
+                              z11 - z10 - z01 + z00))
+        self.mesh_cells = cells
+        # Store the z range of each block of cells (the bilinear
+        # interpolation of a cell stays within its corner values)
+        bsize = MESH_BLOCK_CELLS
+        self.block_x_count = (self.mesh_x_count - 2) // bsize + 1
+        self.block_x_dist = self.mesh_x_dist * bsize
+        self.block_y_dist = self.mesh_y_dist * bsize
+        ranges = []
+        for yidx in range(0, self.mesh_y_count - 1, bsize):
+            rows = tbl[yidx:yidx + bsize + 1]
+            for xidx in range(0, self.mesh_x_count - 1, bsize):
+                zs = [z for row in rows for z in row[xidx:xidx + bsize + 1]]
+                ranges.append((min(zs), max(zs)))
+        self.block_ranges = ranges
     def calc_z(self, x, y):
-        if self.mesh_matrix is not None:
-            tbl = self.mesh_matrix
-            tx, xidx = self._get_linear_index(x, 0)
-            ty, yidx = self._get_linear_index(y, 1)
-            z0 = lerp(tx, tbl[yidx][xidx], tbl[yidx][xidx+1])
-            z1 = lerp(tx, tbl[yidx+1][xidx], tbl[yidx+1][xidx+1])
-            return lerp(ty, z0, z1)
-        else:
+        cells = self.mesh_cells
+        if cells is None:
             # No mesh table generated, no z-adjustment
             return 0.
+        max_xidx = self.mesh_x_count - 2
+        max_yidx = self.mesh_y_count - 2
+        tx = (x - self.mesh_x_min) / self.mesh_x_dist
+        ty = (y - self.mesh_y_min) / self.mesh_y_dist
+        xidx = min(max(int(tx), 0), max_xidx)
+        yidx = min(max(int(ty), 0), max_yidx)
+        tx = min(max(tx - xidx, 0.), 1.)
+        ty = min(max(ty - yidx, 0.), 1.)
+        a, b, c, d = cells[yidx * (max_xidx + 1) + xidx]
+        return a + b * tx + (c + d * tx) * ty
+    def check_z_bounds(self, x0, y0, x1, y1, min_z, max_z):
+        # Check that every calc_z() result in the rectangle with
+        # corners (x0, y0) and (x1, y1) is between min_z and max_z
+        ranges = self.block_ranges
+        if ranges is None:
+            return min_z < 0. < max_z
+        block_x_count = self.block_x_count
+        max_bx = block_x_count - 1
+        max_by = (self.mesh_y_count - 2) // MESH_BLOCK_CELLS
+        bx0 = int((x0 - self.mesh_x_min) / self.block_x_dist)
+        bx1 = int((x1 - self.mesh_x_min) / self.block_x_dist)
+        by0 = int((y0 - self.mesh_y_min) / self.block_y_dist)
+        by1 = int((y1 - self.mesh_y_min) / self.block_y_dist)
+        bx0, bx1 = min(max(min(bx0, bx1), 0), max_bx), \
+            min(max(max(bx0, bx1), 0), max_bx)
+        by0, by1 = min(max(min(by0, by1), 0), max_by), \
+            min(max(max(by0, by1), 0), max_by)
+        for by in range(by0, by1 + 1):
+            row = by * block_x_count
+            for block_min, block_max in ranges[row + bx0:row + bx1 + 1]:
+                if block_min <= min_z or block_max >= max_z:
+                    return False
+        return True
     def get_z_range(self):
         if self.mesh_matrix is not None:
             mesh_min = min([min(x) for x in self.mesh_matrix])
@@ -715,24 +913,6 @@ class ZMesh:
             return mesh_min, mesh_max
         else:
             return 0., 0.
-    def _get_linear_index(self, coord, axis):
-        if axis == 0:
-            # X-axis
-            mesh_min = self.mesh_x_min
-            mesh_cnt = self.mesh_x_count
-            mesh_dist = self.mesh_x_dist
-            cfunc = self.get_x_coordinate
-        else:
-            # Y-axis
-            mesh_min = self.mesh_y_min
-            mesh_cnt = self.mesh_y_count
-            mesh_dist = self.mesh_y_dist
-            cfunc = self.get_y_coordinate
-        t = 0.
-        idx = int(math.floor((coord - mesh_min) / mesh_dist))
-        idx = constrain(idx, 0, mesh_cnt - 2)
-        t = (coord - cfunc(idx)) / mesh_dist
-        return constrain(t, 0., 1.), idx
     def _sample_direct(self, z_matrix):
         self.mesh_matrix = z_matrix
     def _sample_lagrange(self, z_matrix):
@@ -885,6 +1065,66 @@ class ZMesh:
         c = m1 * (t3 - 2*t2 + t)
         d = m2 * (t3 - t2)
         return a + b + c + d
+    # Vectorized versions of the above upsampling algorithms.  These
+    # perform the same calculations as the pure python code, but
+    # interpolate all points of a mesh row (or column) at once.
+    def _sample_lagrange_numpy(self, z_matrix):
+        x_mult = self.x_mult
+        y_mult = self.y_mult
+        xpts, ypts = self._get_lagrange_coords()
+        probed = numpy.array(z_matrix, dtype=float)
+        # Interpolate X coordinates of the probed rows
+        xcoords = self.mesh_x_min + self.mesh_x_dist * numpy.arange(
+            self.mesh_x_count)
+        rows = self._calc_lagrange_numpy(xpts, xcoords, probed)
+        rows[:, ::x_mult] = probed
+        # Interpolate Y coordinates of every column
+        ycoords = self.mesh_y_min + self.mesh_y_dist * numpy.arange(
+            self.mesh_y_count)
+        mesh = self._calc_lagrange_numpy(ypts, ycoords, rows.T).T
+        mesh[::y_mult, :] = rows
+        self.mesh_matrix = mesh.tolist()
+    def _calc_lagrange_numpy(self, lpts, coords, z_rows):
+        pt_cnt = len(lpts)
+        total = numpy.zeros((z_rows.shape[0], len(coords)))
+        for i in range(pt_cnt):
+            n = numpy.ones(len(coords))
+            d = 1.
+            for j in range(pt_cnt):
+                if j == i:
+                    continue
+                n *= (coords - lpts[j])
+                d *= (lpts[i] - lpts[j])
+            total += z_rows[:, i:i+1] * n / d
+        return total
+    def _sample_bicubic_numpy(self, z_matrix):
+        c = self.mesh_params['tension']
+        probed = numpy.array(z_matrix, dtype=float)
+        # Interpolate X values of the probed rows, then the Y values
+        rows = self._cardinal_spline_numpy(probed, self.x_mult, c)
+        mesh = self._cardinal_spline_numpy(rows.T, self.y_mult, c).T
+        self.mesh_matrix = mesh.tolist()
+    def _cardinal_spline_numpy(self, z_rows, mult, tension):
+        pt_cnt = z_rows.shape[1]
+        idx = numpy.arange((pt_cnt - 1) * mult + 1)
+        seg = numpy.minimum(idx // mult, pt_cnt - 2)
+        t = (idx - seg * mult) / float(mult)
+        # Control points (the end points are repeated at the edges)
+        p0 = z_rows[:, numpy.maximum(seg - 1, 0)]
+        p1 = z_rows[:, seg]
+        p2 = z_rows[:, seg + 1]
+        p3 = z_rows[:, numpy.minimum(seg + 2, pt_cnt - 1)]
+        t2 = t*t
+        t3 = t2*t
+        m1 = tension * (p2 - p0)
+        m2 = tension * (p3 - p1)
+        a = p1 * (2*t3 - 3*t2 + 1)
+        b = p2 * (-2*t3 + 3*t2)
+        c = m1 * (t3 - 2*t2 + t)
+        d = m2 * (t3 - t2)
+        res = a + b + c + d
+        res[:, ::mult] = z_rows
+        return res
 
 
 class ProfileManager:
@@ -77,6 +77,29 @@ def measurements_to_distances(measured_params, delta_params):
         for od, fp, sp in zip(outer_dists, first_pos, second_pos)]
     return center_positions + outer_positions
 
+# Return a function that calculates the height and distance errors of
+# a set of delta parameters (for use with mathutil.solve)
+def make_residual_func(orig_delta_params, height_positions, distances,
+                       z_weight=1.):
+    height_weight = math.sqrt(z_weight)
+    def delta_residuals(params):
+        # Build new delta_params for params under test
+        delta_params = orig_delta_params.new_calibration(params)
+        getpos = delta_params.get_position_from_stable
+        # Calculate z height errors
+        residuals = []
+        for z_offset, stable_pos in height_positions:
+            x, y, z = getpos(stable_pos)
+            residuals.append(height_weight * (z - z_offset))
+        # Calculate distance errors
+        for dist, stable_pos1, stable_pos2 in distances:
+            x1, y1, z1 = getpos(stable_pos1)
+            x2, y2, z2 = getpos(stable_pos2)
+            d = math.sqrt((x1-x2)**2 + (y1-y2)**2 + (z1-z2)**2)
+            residuals.append(d - dist)
+        return residuals
+    return delta_residuals
+
 
 ######################################################################
 # Delta Calibrate class
@@ -98,6 +121,8 @@ class DeltaCalibrate:
         self.probe_helper = probe.ProbePointsHelper(
             config, self.probe_finalize, default_points=points)
         self.probe_helper.minimum_points(3)
+        solvers = {name: name for name in mathutil.SOLVERS}
+        self.solver = config.getchoice('solver', solvers, 'coordinate_descent')
         # Restore probe stable positions
         self.last_probe_positions = []
         for i in range(999):
@@ -170,7 +195,7 @@ class DeltaCalibrate:
         self.calculate_params(probe_positions, self.last_distances)
     def calculate_params(self, probe_positions, distances):
         height_positions = self.manual_heights + probe_positions
-        # Setup for coordinate descent analysis
+        # Setup for calibration analysis
         kin = self.printer.lookup_object('toolhead').get_kinematics()
         orig_delta_params = odp = kin.get_calibration()
         adj_params, params = odp.coordinate_descent_params(distances)
@@ -180,29 +205,11 @@ class DeltaCalibrate:
         z_weight = 1.
         if distances:
             z_weight = len(distances) / (MEASURE_WEIGHT * len(probe_positions))
-        # Perform coordinate descent
-        def delta_errorfunc(params):
-            try:
-                # Build new delta_params for params under test
-                delta_params = orig_delta_params.new_calibration(params)
-                getpos = delta_params.get_position_from_stable
-                # Calculate z height errors
-                total_error = 0.
-                for z_offset, stable_pos in height_positions:
-                    x, y, z = getpos(stable_pos)
-                    total_error += (z - z_offset)**2
-                total_error *= z_weight
-                # Calculate distance errors
-                for dist, stable_pos1, stable_pos2 in distances:
-                    x1, y1, z1 = getpos(stable_pos1)
-                    x2, y2, z2 = getpos(stable_pos2)
-                    d = math.sqrt((x1-x2)**2 + (y1-y2)**2 + (z1-z2)**2)
-                    total_error += (d - dist)**2
-                return total_error
-            except ValueError:
-                return 9999999999999.9
-        new_params = mathutil.background_coordinate_descent(
-            self.printer, adj_params, params, delta_errorfunc)
+        # Perform the analysis
+        delta_residuals = make_residual_func(
+            orig_delta_params, height_positions, distances, z_weight)
+        new_params = mathutil.background_solve(
+            self.printer, self.solver, adj_params, params, delta_residuals)
         # Log and report results
         logging.info("Calculated delta_calibrate parameters: %s", new_params)
         new_delta_params = orig_delta_params.new_calibration(new_params)
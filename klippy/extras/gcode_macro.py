@@ -131,6 +131,7 @@ class GCodeMacro:
         self.kwparams = { o[len(prefix):].upper(): config.get(o)
                           for o in config.get_prefix_options(prefix) }
         self.variables = {}
+        self.variables_version = 0
         prefix = 'variable_'
         for option in config.get_prefix_options(prefix):
             try:
@@ -152,6 +153,8 @@ class GCodeMacro:
         return dict(self.variables)
     def get_status(self, eventtime):
         return dict(self.variables)
+    def get_status_version(self):
+        return self.variables_version
     cmd_SET_GCODE_VARIABLE_help = "Set the value of a G-Code macro variable"
     def cmd_SET_GCODE_VARIABLE(self, gcmd):
         variable = gcmd.get('VARIABLE')
@@ -166,6 +169,7 @@ class GCodeMacro:
         except ValueError as e:
             raise gcmd.error("Unable to parse '%s' as a literal" % (value,))
         self.variables[variable] = literal
+        self.variables_version += 1
     cmd_desc = "G-Code macro"
     def cmd(self, gcmd):
         if self.in_script:
@@ -32,6 +32,8 @@ class GCodeMove:
             desc = getattr(self, 'cmd_' + cmd + '_help', None)
             gcode.register_command(cmd, func, False, desc)
         gcode.register_command('G0', self.cmd_G1)
+        for cmd in ['G0', 'G1']:
+            gcode.register_batch_handler(cmd, self.cmd_G1_batch)
         gcode.register_command('M114', self.cmd_M114, True)
         gcode.register_command('GET_POSITION', self.cmd_GET_POSITION, True)
         # G-Code coordinate manipulation
@@ -45,12 +47,14 @@ class GCodeMove:
         # G-Code state
         self.saved_states = {}
         self.move_transform = self.move_with_transform = None
+        self.move_batch_with_transform = None
         self.position_with_transform = (lambda: [0., 0., 0., 0.])
     def _handle_ready(self):
         self.is_printer_ready = True
         if self.move_transform is None:
             toolhead = self.printer.lookup_object('toolhead')
             self.move_with_transform = toolhead.move
+            self.move_batch_with_transform = toolhead.move_batch
             self.position_with_transform = toolhead.get_position
     def _handle_shutdown(self):
         if not self.is_printer_ready:
@@ -76,6 +80,8 @@ class GCodeMove:
             old_transform = self.printer.lookup_object('toolhead', None)
         self.move_transform = transform
         self.move_with_transform = transform.move
+        self.move_batch_with_transform = getattr(transform, 'move_batch',
+                                                 self._move_batch)
         self.position_with_transform = transform.get_position
         return old_transform
     def _get_gcode_position(self):
@@ -102,37 +108,54 @@ class GCodeMove:
         if self.is_printer_ready:
             self.last_position = self.position_with_transform()
     # G-Code movement commands
-    def cmd_G1(self, gcmd):
-        # Move
-        params = gcmd.get_command_parameters()
-        try:
+    def _iter_G1_moves(self, gcmds):
+        # Convert each G1 command to a (position, speed) move
+        for gcmd in gcmds:
+            last_position = self.last_position
+            base_position = self.base_position
+            params = gcmd.get_float_parameters()
+            if params is None:
+                try:
+                    params = { a: float(v)
+                               for a, v in gcmd.get_command_parameters().items()
+                               if a in ('X', 'Y', 'Z', 'E', 'F') }
+                except ValueError as e:
+                    raise gcmd.error("Unable to parse move '%s'"
+                                     % (gcmd.get_commandline(),))
             for pos, axis in enumerate('XYZ'):
                 if axis in params:
-                    v = float(params[axis])
+                    v = params[axis]
                     if not self.absolute_coord:
                         # value relative to position of last move
-                        self.last_position[pos] += v
+                        last_position[pos] += v
                     else:
                         # value relative to base coordinate position
-                        self.last_position[pos] = v + self.base_position[pos]
+                        last_position[pos] = v + base_position[pos]
             if 'E' in params:
-                v = float(params['E']) * self.extrude_factor
+                v = params['E'] * self.extrude_factor
                 if not self.absolute_coord or not self.absolute_extrude:
                     # value relative to position of last move
-                    self.last_position[3] += v
+                    last_position[3] += v
                 else:
                     # value relative to base coordinate position
-                    self.last_position[3] = v + self.base_position[3]
+                    last_position[3] = v + base_position[3]
             if 'F' in params:
-                gcode_speed = float(params['F'])
+                gcode_speed = params['F']
                 if gcode_speed <= 0.:
                     raise gcmd.error("Invalid speed in '%s'"
                                      % (gcmd.get_commandline(),))
                 self.speed = gcode_speed * self.speed_factor
-        except ValueError as e:
-            raise gcmd.error("Unable to parse move '%s'"
-                             % (gcmd.get_commandline(),))
-        self.move_with_transform(self.last_position, self.speed)
+            yield last_position, self.speed
+    def _move_batch(self, moves):
+        for newpos, speed in moves:
+            self.move_with_transform(newpos, speed)
+    def cmd_G1(self, gcmd):
+        # Move
+        for newpos, speed in self._iter_G1_moves([gcmd]):
+            self.move_with_transform(newpos, speed)
+    def cmd_G1_batch(self, gcmds):
+        # Move (a run of G1 commands)
+        self.move_batch_with_transform(self._iter_G1_moves(gcmds))
     def cmd_G28(self, gcmd):
         # Move to origin
         axes = []
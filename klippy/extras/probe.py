@@ -44,6 +44,7 @@ class PrinterProbe:
                                                  minval=0.)
         self.samples_retries = config.getint('samples_tolerance_retries', 0,
                                              minval=0)
+        self.last_variance = 0.
         # Register z_virtual_endstop pin
         self.printer.lookup_object('pins').register_chip('probe', self)
         # Register homing event handlers
@@ -105,6 +106,9 @@ class PrinterProbe:
         return self.lift_speed
     def get_offsets(self):
         return self.x_offset, self.y_offset, self.z_offset
+    def get_last_variance(self):
+        # Variance of the samples of the last run_probe() result
+        return self.last_variance
     def _probe(self, speed):
         toolhead = self.printer.lookup_object('toolhead')
         curtime = self.printer.get_reactor().monotonic()
@@ -133,6 +137,11 @@ class PrinterProbe:
         count = float(len(positions))
         return [sum([pos[i] for pos in positions]) / count
                 for i in range(3)]
+    def _calc_variance(self, positions, z):
+        # Estimate the variance of the z result from the spread of the
+        # samples around it (zero for a single sample)
+        count = len(positions)
+        return sum([(p[2] - z)**2 for p in positions]) / count**2
     def _calc_median(self, positions):
         z_sorted = sorted(positions, key=(lambda p: p[2]))
         middle = len(positions) // 2
@@ -177,8 +186,11 @@ class PrinterProbe:
             self.multi_probe_end()
         # Calculate and return result
         if samples_result == 'median':
-            return self._calc_median(positions)
-        return self._calc_mean(positions)
+            result = self._calc_median(positions)
+        else:
+            result = self._calc_mean(positions)
+        self.last_variance = self._calc_variance(positions, result[2])
+        return result
     cmd_PROBE_help = "Probe Z-height at current XY position"
     def cmd_PROBE(self, gcmd):
         pos = self.run_probe(gcmd)
@@ -338,6 +350,7 @@ class ProbePointsHelper:
         self.lift_speed = self.speed
         self.probe_offsets = (0., 0., 0.)
         self.results = []
+        self.variances = []
     def minimum_points(self,n):
         if len(self.probe_points) < n:
             raise self.printer.config_error(
@@ -349,6 +362,9 @@ class ProbePointsHelper:
         self.use_offsets = use_offsets
     def get_lift_speed(self):
         return self.lift_speed
+    def get_variances(self):
+        # Estimated variance of each probe result (zero if unknown)
+        return list(self.variances)
     def _move_next(self):
         toolhead = self.printer.lookup_object('toolhead')
         # Lift toolhead
@@ -364,6 +380,7 @@ class ProbePointsHelper:
             if res != "retry":
                 return True
             self.results = []
+            self.variances = []
         # Move to next XY probe point
         nextpos = list(self.probe_points[len(self.results)])
         if self.use_offsets:
@@ -377,6 +394,7 @@ class ProbePointsHelper:
         probe = self.printer.lookup_object('probe', None)
         method = gcmd.get('METHOD', 'automatic').lower()
         self.results = []
+        self.variances = []
         if probe is None or method != 'automatic':
             # Manual probe
             self.lift_speed = self.speed
@@ -396,6 +414,7 @@ class ProbePointsHelper:
                 break
             pos = probe.run_probe(gcmd)
             self.results.append(pos)
+            self.variances.append(probe.get_last_variance())
         probe.multi_probe_end()
     def _manual_probe_start(self):
         done = self._move_next()
@@ -407,6 +426,7 @@ class ProbePointsHelper:
         if kin_pos is None:
             return
         self.results.append(kin_pos)
+        self.variances.append(0.)
         self._manual_probe_start()
 
 def load_config(config):
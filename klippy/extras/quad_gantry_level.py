@@ -30,9 +30,12 @@ class QuadGantryLevel:
         self.max_adjust = config.getfloat("max_adjust", 4, above=0)
         self.horizontal_move_z = config.getfloat("horizontal_move_z", 5.0)
         self.probe_helper = probe.ProbePointsHelper(config, self.probe_finalize)
-        if len(self.probe_helper.probe_points) != 4:
+        if len(self.probe_helper.probe_points) < 4:
             raise config.error(
-                "Need exactly 4 probe points for quad_gantry_level")
+                "Need at least 4 probe points for quad_gantry_level")
+        # The gantry height is modeled as z = a + b*x + c*y + d*x*y
+        self.fit_helper = z_tilt.ZFitHelper(
+            config, self.probe_helper, (lambda x, y: [1., x, y, x*y]))
         self.z_helper = z_tilt.ZAdjustHelper(config, 4)
         gantry_corners = config.get('gantry_corners').split('\n')
         try:
@@ -55,6 +58,7 @@ class QuadGantryLevel:
         "Conform a moving, twistable gantry to the shape of a stationary bed")
     def cmd_QUAD_GANTRY_LEVEL(self, gcmd):
         self.retry_helper.start(gcmd)
+        self.fit_helper.start()
         self.probe_helper.start_probe(gcmd)
     def probe_finalize(self, offsets, positions):
         # Mirror our perspective so the adjustments make sense
@@ -64,36 +68,18 @@ class QuadGantryLevel:
             " ".join(["%s: %.6f" % (z_id, z_positions[z_id])
                 for z_id in range(len(z_positions))]))
         self.gcode.respond_info(points_message)
-        # Calculate slope along X axis between probe point 0 and 3
-        ppx0 = [positions[0][0] + offsets[0], z_positions[0]]
-        ppx3 = [positions[3][0] + offsets[0], z_positions[3]]
-        slope_x_pp03 = self.linefit(ppx0, ppx3)
-        # Calculate slope along X axis between probe point 1 and 2
-        ppx1 = [positions[1][0] + offsets[0], z_positions[1]]
-        ppx2 = [positions[2][0] + offsets[0], z_positions[2]]
-        slope_x_pp12 = self.linefit(ppx1, ppx2)
-        logging.info("quad_gantry_level f1: %s, f2: %s"
-                     % (slope_x_pp03, slope_x_pp12))
-        # Calculate gantry slope along Y axis between stepper 0 and 1
-        a1 = [positions[0][1] + offsets[1],
-              self.plot(slope_x_pp03, self.gantry_corners[0][0])]
-        a2 = [positions[1][1] + offsets[1],
-              self.plot(slope_x_pp12, self.gantry_corners[0][0])]
-        slope_y_s01 = self.linefit(a1, a2)
-        # Calculate gantry slope along Y axis between stepper 2 and 3
-        b1 = [positions[0][1] + offsets[1],
-              self.plot(slope_x_pp03, self.gantry_corners[1][0])]
-        b2 = [positions[1][1] + offsets[1],
-              self.plot(slope_x_pp12, self.gantry_corners[1][0])]
-        slope_y_s23 = self.linefit(b1, b2)
-        logging.info("quad_gantry_level af: %s, bf: %s"
-                     % (slope_y_s01, slope_y_s23))
+        # Fit the gantry shape to the probed points
+        coefs, z_positions = self.fit_helper.fit(
+            [(p[0] + offsets[0], p[1] + offsets[1], z)
+             for p, z in zip(positions, z_positions)])
+        logging.info("quad_gantry_level fit: %s" % (coefs,))
         # Calculate z height of each stepper
-        z_height = [0,0,0,0]
-        z_height[0] = self.plot(slope_y_s01, self.gantry_corners[0][1])
-        z_height[1] = self.plot(slope_y_s01, self.gantry_corners[1][1])
-        z_height[2] = self.plot(slope_y_s23, self.gantry_corners[1][1])
-        z_height[3] = self.plot(slope_y_s23, self.gantry_corners[0][1])
+        corners = self.gantry_corners
+        z_height = [self.fit_helper.calc_z(coefs, x, y)
+                    for x, y in [(corners[0][0], corners[0][1]),
+                                 (corners[0][0], corners[1][1]),
+                                 (corners[1][0], corners[1][1]),
+                                 (corners[1][0], corners[0][1])]]
 
         ainfo = zip(["z","z1","z2","z3"], z_height[0:4])
         apos = " ".join(["%s: %06f" % (x) for x in ainfo])
@@ -114,16 +100,10 @@ class QuadGantryLevel:
 
         speed = self.probe_helper.get_lift_speed()
         self.z_helper.adjust_steppers(z_adjust, speed)
-        return self.retry_helper.check_retry(z_positions)
-    def linefit(self,p1,p2):
-        if p1[1] == p2[1]:
-            # Straight line
-            return 0,p1[1]
-        m = (p2[1] - p1[1])/(p2[0] - p1[0])
-        b = p1[1] - m * p1[0]
-        return m,b
-    def plot(self,f,x):
-        return f[0]*x + f[1]
+        res = self.retry_helper.check_retry(z_positions)
+        if res == "retry":
+            self.fit_helper.prepare_retry()
+        return res
 
 def load_config(config):
     return QuadGantryLevel(config)
@@ -24,13 +24,22 @@ def get_os_stats(eventtime):
 class PrinterStats:
     def __init__(self, config):
         self.printer = config.get_printer()
-        reactor = self.printer.get_reactor()
+        self.reactor = reactor = self.printer.get_reactor()
         self.stats_timer = reactor.register_timer(self.generate_stats)
         self.stats_cb = []
         self.printer.register_event_handler("klippy:ready", self.handle_ready)
+        # Reactor instrumentation
+        self.reactor_stats = config.getboolean('reactor_stats', False)
+        reactor.set_instrumentation(self.reactor_stats)
+        self.last_callback_times = {}
+        self.last_reactor_stats_time = reactor.monotonic()
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("reactor/stats", self._handle_reactor_stats)
     def handle_ready(self):
         self.stats_cb = [o.stats for n, o in self.printer.lookup_objects()
                          if hasattr(o, 'stats')]
+        if self.reactor_stats:
+            self.stats_cb.append(self.get_reactor_stats)
         if self.printer.get_start_args().get('debugoutput') is None:
             reactor = self.printer.get_reactor()
             reactor.update_timer(self.stats_timer, reactor.NOW)
@@ -42,5 +51,39 @@ class PrinterStats:
                          ' '.join([s[1] for s in stats]))
         return eventtime + 1.
 
+    def get_reactor_stats(self, eventtime):
+        # Find the callback that used the most time since the last report
+        callback_times = {name: total for name, count, total, max_time, hist
+                          in self.reactor.get_timer_stats()}
+        busy_time = top_time = 0.
+        top_name = None
+        for name, total in callback_times.items():
+            delta = total - self.last_callback_times.get(name, 0.)
+            busy_time += delta
+            if delta > top_time:
+                top_name, top_time = name, delta
+        self.last_callback_times = callback_times
+        interval = max(eventtime - self.last_reactor_stats_time, .001)
+        self.last_reactor_stats_time = eventtime
+        late = self.reactor.get_lateness_stats()
+        gstats = self.reactor.get_greenlet_stats()
+        return (False, "reactor: late_p50=%.6f late_p95=%.6f late_p99=%.6f"
+                " late_max=%.6f late_max_cb=%s busy=%.3f top_cb=%s"
+                " top_cb_time=%.6f pauses=%d dispatch_pauses=%d"
+                " greenlets=%d" % (
+                    late['p50'], late['p95'], late['p99'], late['max'],
+                    late['max_name'], busy_time / interval, top_name,
+                    top_time, gstats['pauses'], gstats['dispatch_pauses'],
+                    gstats['greenlets']))
+    def _handle_reactor_stats(self, web_request):
+        callbacks = [{'name': name, 'count': count, 'total_time': total,
+                      'max_time': max_time, 'histogram': hist}
+                     for name, count, total, max_time, hist
+                     in self.reactor.get_timer_stats()]
+        web_request.send({'instrumentation': self.reactor_stats,
+                          'lateness': self.reactor.get_lateness_stats(),
+                          'greenlets': self.reactor.get_greenlet_stats(),
+                          'callbacks': callbacks})
+
 def load_config(config):
     return PrinterStats(config)
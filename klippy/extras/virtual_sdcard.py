@@ -3,9 +3,208 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging
+import os, re, logging, bisect, json, multiprocessing, traceback
+import chelper, gcode, queuelogger
 
 VALID_GCODE_EXTS = ['gcode', 'g', 'gco']
+POSIX_FADV_SEQUENTIAL = 2
+READ_SIZE = 8192
+BATCH_LINES = 32
+
+
+######################################################################
+# File index
+######################################################################
+
+INDEX_VERSION = 1
+INDEX_FIELDS = ['layer', 'absolute_coordinates', 'absolute_extrude',
+                'x', 'y', 'z', 'e', 'speed', 'extruder_temp', 'bed_temp',
+                'fan_speed']
+
+# Track the state a g-code file leaves the printer in (only traditional
+# commands with numeric parameters are interpreted)
+class FileStateTracker:
+    # Layer start comments (";LAYER:3", ";LAYER_CHANGE", "; layer 3, ...")
+    layer_r = re.compile(r';\s*LAYER(?::|_CHANGE\b|\s+\d)', re.IGNORECASE)
+    def __init__(self, state=None):
+        if state is None:
+            state = [0, True, True, 0., 0., 0., 0., 0., 0., 0., 0.]
+        (self.layer, self.absolute_coord, self.absolute_extrude,
+         x, y, z, e, self.speed, self.extruder_temp, self.bed_temp,
+         self.fan_speed) = state
+        self.position = [x, y, z, e]
+    def get_state(self):
+        return ([self.layer, self.absolute_coord, self.absolute_extrude]
+                + self.position
+                + [self.speed, self.extruder_temp, self.bed_temp,
+                   self.fan_speed])
+    def process_line(self, line):
+        # Returns True if the line starts a new layer
+        line = line.strip()
+        if line.startswith(';'):
+            if self.layer_r.match(line) is None:
+                return False
+            self.layer += 1
+            return True
+        m = gcode.GCodeDispatch.traditional_r.match(line)
+        if m is None:
+            return False
+        words, cmd = m.groups()
+        params = { k: float(v)
+                   for k, v in gcode.GCodeDispatch.word_r.findall(words) }
+        if cmd in ('G0', 'G1'):
+            for pos, axis in enumerate('XYZE'):
+                if axis in params:
+                    if (self.absolute_coord
+                        and (pos < 3 or self.absolute_extrude)):
+                        self.position[pos] = params[axis]
+                    else:
+                        self.position[pos] += params[axis]
+            self.speed = params.get('F', self.speed)
+        elif cmd == 'G92':
+            for pos, axis in enumerate('XYZE'):
+                if axis in params:
+                    self.position[pos] = params[axis]
+        elif cmd in ('G90', 'G91'):
+            self.absolute_coord = cmd == 'G90'
+        elif cmd in ('M82', 'M83'):
+            self.absolute_extrude = cmd == 'M82'
+        elif cmd in ('M104', 'M109'):
+            self.extruder_temp = params.get('S', self.extruder_temp)
+        elif cmd in ('M140', 'M190'):
+            self.bed_temp = params.get('S', self.bed_temp)
+        elif cmd == 'M106':
+            self.fan_speed = params.get('S', 255.)
+        elif cmd == 'M107':
+            self.fan_speed = 0.
+        return False
+
+# Scan a g-code file and note its state every 'interval' lines and at
+# the start of each layer (an entry holds the state prior to the line
+# at its offset)
+def build_file_index(filename, interval):
+    st = os.stat(filename)
+    tracker = FileStateTracker()
+    entries = [[0] + tracker.get_state()]
+    layers = []
+    offset = count = 0
+    f = open(filename, 'rb')
+    for line in f:
+        is_new_layer = tracker.process_line(line)
+        if is_new_layer:
+            layers.append(offset)
+        offset += len(line)
+        count += 1
+        if is_new_layer or count >= interval:
+            entries.append([offset] + tracker.get_state())
+            count = 0
+    f.close()
+    return {'version': INDEX_VERSION, 'size': st.st_size,
+            'mtime': st.st_mtime, 'interval': interval,
+            'fields': INDEX_FIELDS, 'entries': entries, 'layers': layers}
+
+def get_index_filename(filename):
+    dirname, basename = os.path.split(filename)
+    return os.path.join(dirname, '.' + basename + '.index')
+
+# Load the index of a file from its sidecar file (if it is up to date)
+def load_file_index(filename, interval):
+    try:
+        st = os.stat(filename)
+        f = open(get_index_filename(filename), 'rb')
+        data = json.load(f)
+        f.close()
+    except (IOError, OSError, ValueError):
+        return None
+    if (data.get('version') != INDEX_VERSION or data.get('size') != st.st_size
+        or data.get('mtime') != st.st_mtime
+        or data.get('interval') != interval):
+        return None
+    return data
+
+def save_file_index(filename, data):
+    tmpname = get_index_filename(filename) + '.tmp'
+    f = open(tmpname, 'wb')
+    json.dump(data, f, separators=(',', ':'))
+    f.close()
+    os.rename(tmpname, get_index_filename(filename))
+
+# Lookups into the index of a file
+class FileIndex:
+    def __init__(self, data):
+        self.entries = data['entries']
+        self.offsets = [e[0] for e in self.entries]
+        self.layers = data['layers']
+    def get_layer(self, pos):
+        return bisect.bisect_left(self.layers, pos)
+    def get_layer_count(self):
+        return len(self.layers)
+    def get_state(self, pos, f):
+        # Find the last indexed state at or before 'pos' and scan the
+        # lines between it and 'pos'
+        entry = self.entries[bisect.bisect_right(self.offsets, pos) - 1]
+        tracker = FileStateTracker(entry[1:])
+        f.seek(entry[0])
+        data = f.read(pos - entry[0])
+        for line in data.split('\n')[:-1]:
+            tracker.process_line(line)
+        return dict(zip(INDEX_FIELDS, tracker.get_state()))
+
+# Build (or load) the index of a file in a background process
+class FileIndexer:
+    def __init__(self, reactor, filename, interval, callback):
+        self.reactor = reactor
+        self.filename = filename
+        self.callback = callback
+        self.parent_conn, child_conn = multiprocessing.Pipe()
+        def wrapper():
+            queuelogger.clear_bg_logging()
+            try:
+                data = load_file_index(filename, interval)
+                if data is None:
+                    data = build_file_index(filename, interval)
+                    try:
+                        save_file_index(filename, data)
+                    except (IOError, OSError):
+                        logging.warning("Unable to write index of %s",
+                                        filename)
+            except:
+                child_conn.send((True, traceback.format_exc()))
+                child_conn.close()
+                return
+            child_conn.send((False, data))
+            child_conn.close()
+        self.proc = multiprocessing.Process(target=wrapper)
+        self.proc.daemon = True
+        self.proc.start()
+        self.timer = reactor.register_timer(self._check_done, reactor.NOW)
+    def _check_done(self, eventtime):
+        if not self.parent_conn.poll():
+            if self.proc.is_alive():
+                return eventtime + .500
+            is_err, res = True, "Index process exited"
+        else:
+            is_err, res = self.parent_conn.recv()
+        self._cleanup()
+        if is_err:
+            logging.error("Unable to index %s: %s", self.filename, res)
+        else:
+            logging.info("Indexed %s (%d entries, %d layers)", self.filename,
+                         len(res['entries']), len(res['layers']))
+            self.callback(FileIndex(res))
+        return self.reactor.NEVER
+    def _cleanup(self):
+        self.reactor.unregister_timer(self.timer)
+        self.parent_conn.close()
+        self.proc.join()
+    def cancel(self):
+        self.proc.terminate()
+        self._cleanup()
+
+
+######################################################################
+# Virtual sdcard
+######################################################################
 
 class VirtualSD:
     def __init__(self, config):
@@ -14,8 +213,12 @@ class VirtualSD:
         # sdcard state
         sd = config.get('path')
         self.sdcard_dirname = os.path.normpath(os.path.expanduser(sd))
+        self.index_interval = config.getint('index_interval', 0, minval=0)
+        self.file_indexer = self.file_index = None
         self.current_file = None
         self.file_position = self.file_size = 0
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.posix_fadvise = ffi_lib.posix_fadvise
         # Print Stat Tracking
         self.print_stats = printer.load_object(config, 'print_stats')
         # Work timer
@@ -34,6 +237,9 @@ class VirtualSD:
         self.gcode.register_command(
             "SDCARD_PRINT_FILE", self.cmd_SDCARD_PRINT_FILE,
             desc=self.cmd_SDCARD_PRINT_FILE_help)
+        self.gcode.register_command(
+            "SDCARD_FILE_STATE", self.cmd_SDCARD_FILE_STATE,
+            desc=self.cmd_SDCARD_FILE_STATE_help)
     def handle_shutdown(self):
         if self.work_timer is not None:
             self.must_pause_work = True
@@ -82,8 +288,13 @@ class VirtualSD:
         if self.file_size:
             progress = float(self.file_position) / self.file_size
         is_active = self.is_active()
+        layer = layer_count = 0
+        if self.file_index is not None:
+            layer = self.file_index.get_layer(self.file_position)
+            layer_count = self.file_index.get_layer_count()
         return {'progress': progress, 'is_active': is_active,
-                'file_position': self.file_position}
+                'file_position': self.file_position,
+                'layer': layer, 'layer_count': layer_count}
     def is_active(self):
         return self.work_timer is not None
     def do_pause(self):
@@ -97,8 +308,7 @@ class VirtualSD:
     def _reset_file(self):
         if self.current_file is not None:
             self.do_pause()
-            self.current_file.close()
-            self.current_file = None
+            self._close_file()
         self.file_position = self.file_size = 0.
         self.print_stats.reset()
     cmd_SDCARD_RESET_FILE_help = "Clears a loaded SD File. Stops the print "\
@@ -162,6 +372,11 @@ class VirtualSD:
         self.current_file = f
         self.file_position = 0
         self.file_size = fsize
+        self.posix_fadvise(f.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+        if fsize and self.index_interval:
+            self.file_indexer = FileIndexer(
+                self.reactor, fname, self.index_interval,
+                self._handle_file_index)
         self.print_stats.set_current_file(filename)
     def cmd_M24(self, gcmd):
         # Start/resume SD print
@@ -186,49 +401,92 @@ class VirtualSD:
             return
         gcmd.respond_raw("SD printing byte %d/%d"
                          % (self.file_position, self.file_size))
+        if self.file_index is not None:
+            gcmd.respond_raw("SD printing layer %d/%d" % (
+                self.file_index.get_layer(self.file_position),
+                self.file_index.get_layer_count()))
+    def get_file_state(self, pos):
+        # Return the g-code state at a position in the current file (or
+        # None if the file has not been indexed)
+        if self.file_index is None:
+            return None
+        return self.file_index.get_state(min(pos, self.file_size),
+                                         self.current_file)
+    cmd_SDCARD_FILE_STATE_help = "Report the g-code state at a position in" \
+        " the loaded SD file"
+    def cmd_SDCARD_FILE_STATE(self, gcmd):
+        pos = gcmd.get_int('POSITION', self.file_position, minval=0)
+        if self.current_file is None:
+            raise gcmd.error("No SD file loaded")
+        state = self.get_file_state(pos)
+        if state is None:
+            if self.file_indexer is not None:
+                raise gcmd.error("SD file index not yet available")
+            raise gcmd.error("SD file index not enabled")
+        gcmd.respond_info(
+            "File position %d (layer %d/%d): X=%.3f Y=%.3f Z=%.3f E=%.5f\n"
+            "F=%.1f extruder_temp=%.1f bed_temp=%.1f fan_speed=%.1f\n"
+            "absolute_coordinates=%s absolute_extrude=%s" % (
+                pos, state['layer'], self.file_index.get_layer_count(),
+                state['x'], state['y'], state['z'], state['e'],
+                state['speed'], state['extruder_temp'], state['bed_temp'],
+                state['fan_speed'], state['absolute_coordinates'],
+                state['absolute_extrude']))
+    def _handle_file_index(self, file_index):
+        self.file_indexer = None
+        self.file_index = file_index
+    def _close_file(self):
+        if self.file_indexer is not None:
+            self.file_indexer.cancel()
+            self.file_indexer = None
+        self.file_index = None
+        self.current_file.close()
+        self.current_file = None
+    # Runs of lines that may be dispatched together (moves and comments)
+    batch_r = re.compile(r'(?:(?:G[01][ \t]|;)[^\n]*\n|[ \t\r]*\n){1,%d}'
+                         % (BATCH_LINES,))
     # Background work timer
     def work_handler(self, eventtime):
         logging.info("Starting SD card print (position %d)", self.file_position)
         self.reactor.unregister_timer(self.work_timer)
-        try:
-            self.current_file.seek(self.file_position)
-        except:
-            logging.exception("virtual_sdcard seek")
-            self.work_timer = None
-            return self.reactor.NEVER
         self.print_stats.note_start()
         gcode_mutex = self.gcode.get_mutex()
-        partial_input = ""
-        lines = []
+        data = ""
+        pos = 0
         while not self.must_pause_work:
-            if not lines:
+            # Find the next lines to dispatch
+            m = self.batch_r.match(data, pos)
+            if m is not None:
+                end = m.end()
+            else:
+                end = data.find('\n', pos) + 1
+            if not end:
                 # Read more data
                 try:
-                    data = self.current_file.read(8192)
+                    readpos = self.file_position + len(data) - pos
+                    self.current_file.seek(readpos)
+                    newdata = self.current_file.read(READ_SIZE)
                 except:
                     logging.exception("virtual_sdcard read")
                     break
-                if not data:
+                if not newdata:
                     # End of file
-                    self.current_file.close()
-                    self.current_file = None
+                    self._close_file()
                     logging.info("Finished SD card print")
                     self.gcode.respond_raw("Done printing file")
                     break
-                lines = data.split('\n')
-                lines[0] = partial_input + lines[0]
-                partial_input = lines.pop()
-                lines.reverse()
+                data = data[pos:] + newdata
+                pos = 0
                 self.reactor.pause(self.reactor.NOW)
                 continue
             # Pause if any other request is pending in the gcode class
             if gcode_mutex.test():
                 self.reactor.pause(self.reactor.monotonic() + 0.100)
                 continue
-            # Dispatch command
+            # Dispatch commands
             self.cmd_from_sd = True
             try:
-                self.gcode.run_script(lines[-1])
+                self.gcode.run_script(data[pos:end-1])
             except self.gcode.error as e:
                 self.print_stats.note_error(str(e))
                 break
@@ -236,7 +494,8 @@ class VirtualSD:
                 logging.exception("virtual_sdcard dispatch")
                 break
             self.cmd_from_sd = False
-            self.file_position += len(lines.pop()) + 1
+            self.file_position += end - pos
+            pos = end
         logging.info("Exiting SD card print (position %d)", self.file_position)
         self.work_timer = None
         self.cmd_from_sd = False
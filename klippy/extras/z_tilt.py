@@ -108,6 +108,79 @@ class RetryHelper:
             raise self.gcode.error("Too many retries")
         return "retry"
 
+# Helper to fit a model of the bed to the probed points.  Optionally
+# only the points needed to determine the model are probed on retries
+# (the difference between the bed and the model is assumed to not be
+# altered by the z adjustments).
+class ZFitHelper:
+    def __init__(self, config, probe_helper, basis_func):
+        self.gcode = config.get_printer().lookup_object('gcode')
+        self.probe_helper = probe_helper
+        self.basis_func = basis_func
+        self.outlier_sigma = config.getfloat('outlier_sigma', 0., minval=0.)
+        self.retry_minimal_probe = config.getboolean('retry_minimal_probe',
+                                                     False)
+        self.probe_points = probe_helper.probe_points
+        self.center = (0., 0.)
+        self.full_points = self.residuals = self.probe_subset = None
+    def start(self):
+        self.residuals = self.probe_subset = None
+        self.probe_helper.update_probe_points(self.probe_points,
+                                              len(self.probe_points))
+    def _calc_rows(self, points):
+        cx, cy = self.center
+        return [self.basis_func(x - cx, y - cy) for x, y, z in points]
+    def calc_z(self, coefs, x, y):
+        cx, cy = self.center
+        return sum([b * c for b, c in zip(self.basis_func(x - cx, y - cy),
+                                          coefs)])
+    def fit(self, points):
+        # Fit the model to a list of (x, y, z) points.  Returns the
+        # coefficients and the (possibly estimated) z of all points.
+        subset = self.probe_subset
+        if subset is None:
+            count = float(len(points))
+            self.center = (sum([p[0] for p in points]) / count,
+                           sum([p[1] for p in points]) / count)
+            rows = self._calc_rows(points)
+            values = [p[2] for p in points]
+            variances = self.probe_helper.get_variances()
+            if len(variances) != len(points):
+                variances = [0.] * len(points)
+            coefs, active = mathutil.fit_least_squares(
+                rows, values, variances, self.outlier_sigma)
+            self.full_points = points
+            rejected = [i for i in range(len(points)) if i not in active]
+            if rejected:
+                self.gcode.respond_info(
+                    "Rejected probe points: %s" % (
+                        ", ".join(["%d" % (i,) for i in rejected]),))
+            # Use the fitted height of any rejected points
+            heights = [self.calc_z(coefs, p[0], p[1]) for p in points]
+            for i in active:
+                heights[i] = values[i]
+            self.residuals = [h - self.calc_z(coefs, p[0], p[1])
+                              for p, h in zip(points, heights)]
+            return coefs, heights
+        # Only a subset was probed - use the residuals from the last
+        # full probe to estimate the height of the remaining points
+        rows = self._calc_rows(points)
+        values = [p[2] - self.residuals[i] for i, p in zip(subset, points)]
+        coefs = mathutil.linear_least_squares(rows, values)
+        return coefs, [self.calc_z(coefs, p[0], p[1]) + r
+                       for p, r in zip(self.full_points, self.residuals)]
+    def prepare_retry(self):
+        # Determine the points to probe on the next retry
+        if not self.retry_minimal_probe or self.probe_subset is not None:
+            return
+        rows = self._calc_rows(self.full_points)
+        if len(rows) <= len(rows[0]):
+            return
+        self.probe_subset = mathutil.select_rows(rows, len(rows[0]))
+        probe_points = [self.probe_points[i] for i in self.probe_subset]
+        self.probe_helper.update_probe_points(probe_points,
+                                              len(probe_points))
+
 class ZTilt:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -123,6 +196,8 @@ class ZTilt:
         self.retry_helper = RetryHelper(config)
         self.probe_helper = probe.ProbePointsHelper(config, self.probe_finalize)
         self.probe_helper.minimum_points(2)
+        self.fit_helper = ZFitHelper(config, self.probe_helper,
+                                     (lambda x, y: [x, y, 1.]))
         self.z_helper = ZAdjustHelper(config, len(self.z_positions))
         # Register Z_TILT_ADJUST command
         gcode = self.printer.lookup_object('gcode')
@@ -131,35 +206,29 @@ class ZTilt:
     cmd_Z_TILT_ADJUST_help = "Adjust the Z tilt"
     def cmd_Z_TILT_ADJUST(self, gcmd):
         self.retry_helper.start(gcmd)
+        self.fit_helper.start()
         self.probe_helper.start_probe(gcmd)
     def probe_finalize(self, offsets, positions):
-        # Setup for coordinate descent analysis
+        # Fit a plane to the probed points
         z_offset = offsets[2]
         logging.info("Calculating bed tilt with: %s", positions)
-        params = { 'x_adjust': 0., 'y_adjust': 0., 'z_adjust': z_offset }
-        # Perform coordinate descent
-        def adjusted_height(pos, params):
-            x, y, z = pos
-            return (z - x*params['x_adjust'] - y*params['y_adjust']
-                    - params['z_adjust'])
-        def errorfunc(params):
-            total_error = 0.
-            for pos in positions:
-                total_error += adjusted_height(pos, params)**2
-            return total_error
-        new_params = mathutil.coordinate_descent(
-            params.keys(), params, errorfunc)
+        coefs, z_heights = self.fit_helper.fit(positions)
+        x_adjust, y_adjust = coefs[:2]
+        plane_z_adjust = self.fit_helper.calc_z(coefs, 0., 0.)
+        logging.info("Calculated bed tilt parameters: x_adjust: %s"
+                     " y_adjust: %s z_adjust: %s",
+                     x_adjust, y_adjust, plane_z_adjust)
         # Apply results
         speed = self.probe_helper.get_lift_speed()
-        logging.info("Calculated bed tilt parameters: %s", new_params)
-        x_adjust = new_params['x_adjust']
-        y_adjust = new_params['y_adjust']
-        z_adjust = (new_params['z_adjust'] - z_offset
+        z_adjust = (plane_z_adjust - z_offset
                     - x_adjust * offsets[0] - y_adjust * offsets[1])
         adjustments = [x*x_adjust + y*y_adjust + z_adjust
                        for x, y in self.z_positions]
         self.z_helper.adjust_steppers(adjustments, speed)
-        return self.retry_helper.check_retry([p[2] for p in positions])
+        res = self.retry_helper.check_retry(z_heights)
+        if res == "retry":
+            self.fit_helper.prepare_retry()
+        return res
 
 def load_config(config):
     return ZTilt(config)
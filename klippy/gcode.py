@@ -6,12 +6,36 @@
 import os, re, logging, collections, shlex
 import homing
 
+# Split a traditional g-code line into its command and parameters
+args_r = re.compile('([A-Z_]+|[A-Z*/])')
+def parse_traditional(line):
+    # Ignore comments and leading/trailing spaces
+    line = line.strip()
+    cpos = line.find(';')
+    if cpos >= 0:
+        line = line[:cpos]
+    # Break line into parts and determine command
+    parts = args_r.split(line.upper())
+    numparts = len(parts)
+    cmd = ""
+    if numparts >= 3 and parts[1] != 'N':
+        cmd = parts[1] + parts[2].strip()
+    elif numparts >= 5 and parts[1] == 'N':
+        # Skip line number at start of command
+        cmd = parts[3] + parts[4].strip()
+    # Build gcode "params" dictionary
+    params = { parts[i]: parts[i+1].strip()
+               for i in range(1, numparts, 2) }
+    return cmd, params
+
 class GCodeCommand:
     error = homing.CommandError
-    def __init__(self, gcode, command, commandline, params, need_ack):
+    def __init__(self, gcode, command, commandline, params, need_ack,
+                 float_params=None):
         self._command = command
         self._commandline = commandline
         self._params = params
+        self._float_params = float_params
         self._need_ack = need_ack
         # Method wrappers
         self.respond_info = gcode.respond_info
@@ -21,7 +45,15 @@ class GCodeCommand:
     def get_commandline(self):
         return self._commandline
     def get_command_parameters(self):
+        if self._params is None:
+            # Commands from the fast path only build their string
+            # parameters on request
+            self._params = parse_traditional(self._commandline)[1]
         return self._params
+    def get_float_parameters(self):
+        # Returns a dictionary of all parameters as floats (or None if
+        # the command was not parsed by the fast path)
+        return self._float_params
     def ack(self, msg=None):
         if not self._need_ack:
             return False
@@ -35,7 +67,7 @@ class GCodeCommand:
     class sentinel: pass
     def get(self, name, default=sentinel, parser=str, minval=None, maxval=None,
             above=None, below=None):
-        value = self._params.get(name)
+        value = self.get_command_parameters().get(name)
         if value is None:
             if default is self.sentinel:
                 raise self.error("Error on '%s': missing %s"
@@ -46,6 +78,8 @@ class GCodeCommand:
         except:
             raise self.error("Error on '%s': unable to parse %s"
                              % (self._commandline, value))
+        return self._check_range(name, value, minval, maxval, above, below)
+    def _check_range(self, name, value, minval, maxval, above, below):
         if minval is not None and value < minval:
             raise self.error("Error on '%s': %s must have minimum of %s"
                              % (self._commandline, name, minval))
@@ -63,8 +97,17 @@ class GCodeCommand:
         return self.get(name, default, parser=int, minval=minval, maxval=maxval)
     def get_float(self, name, default=sentinel, minval=None, maxval=None,
                   above=None, below=None):
-        return self.get(name, default, parser=float, minval=minval,
-                        maxval=maxval, above=above, below=below)
+        fparams = self._float_params
+        if fparams is None:
+            return self.get(name, default, parser=float, minval=minval,
+                            maxval=maxval, above=above, below=below)
+        value = fparams.get(name)
+        if value is None:
+            if default is self.sentinel:
+                raise self.error("Error on '%s': missing %s"
+                                 % (self._commandline, name))
+            return default
+        return self._check_range(name, value, minval, maxval, above, below)
 
 # Parse and dispatch G-Code commands
 class GCodeDispatch:
@@ -83,6 +126,7 @@ class GCodeDispatch:
         self.base_gcode_handlers = self.gcode_handlers = {}
         self.ready_gcode_handlers = {}
         self.mux_commands = {}
+        self.batch_handlers = {}
         self.gcode_help = {}
         # Register commands needed before config file is loaded
         handlers = ['M110', 'M112', 'M115',
@@ -106,6 +150,8 @@ class GCodeDispatch:
                 del self.ready_gcode_handlers[cmd]
             if cmd in self.base_gcode_handlers:
                 del self.base_gcode_handlers[cmd]
+            if cmd in self.batch_handlers:
+                del self.batch_handlers[cmd]
             return old_cmd
         if cmd in self.ready_gcode_handlers:
             raise self.printer.config_error(
@@ -118,6 +164,14 @@ class GCodeDispatch:
             self.base_gcode_handlers[cmd] = func
         if desc is not None:
             self.gcode_help[cmd] = desc
+    def register_batch_handler(self, cmd, batch_func):
+        # A batch handler may be called (instead of the regular handler)
+        # with an iterator over a run of consecutive commands
+        func = self.ready_gcode_handlers.get(cmd)
+        if func is None or not self.is_traditional_gcode(cmd):
+            raise self.printer.config_error(
+                "batch handler for unknown gcode command %s" % (cmd,))
+        self.batch_handlers[cmd] = (func, batch_func)
     def register_mux_command(self, cmd, key, value, func, desc=None):
         prev = self.mux_commands.get(cmd)
         if prev is None:
@@ -150,27 +204,47 @@ class GCodeDispatch:
         self.gcode_handlers = self.ready_gcode_handlers
         self._respond_state("Ready")
     # Parse input into commands
-    args_r = re.compile('([A-Z_]+|[A-Z*/])')
-    def _process_commands(self, commands, need_ack=True):
-        for line in commands:
-            # Ignore comments and leading/trailing spaces
+    number_r = r'[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)'
+    traditional_r = re.compile(r'(([GM][0-9]+)(?:\s*[A-Z]%s)*)\s*(?:;.*)?$'
+                               % (number_r,))
+    word_r = re.compile(r'([A-Z])(%s)' % (number_r,))
+    def _process_commands(self, commands, need_ack=True, line_callback=None):
+        traditional_r = self.traditional_r
+        word_r = self.word_r
+        batch_handlers = self.batch_handlers
+        batch = []
+        batch_func = None
+        for i, line in enumerate(commands):
+            if line_callback is not None:
+                # The callback runs just before each line (and may
+                # raise an error to stop the script)
+                if batch:
+                    self._process_batch(batch_func, batch, need_ack)
+                    batch = []
+                line_callback(i, len(commands))
             line = origline = line.strip()
-            cpos = line.find(';')
-            if cpos >= 0:
-                line = line[:cpos]
-            # Break line into parts and determine command
-            parts = self.args_r.split(line.upper())
-            numparts = len(parts)
-            cmd = ""
-            if numparts >= 3 and parts[1] != 'N':
-                cmd = parts[1] + parts[2].strip()
-            elif numparts >= 5 and parts[1] == 'N':
-                # Skip line number at start of command
-                cmd = parts[3] + parts[4].strip()
-            # Build gcode "params" dictionary
-            params = { parts[i]: parts[i+1].strip()
-                       for i in range(1, numparts, 2) }
-            gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
+            # Fast path for G/M commands with only numeric parameters
+            m = traditional_r.match(line)
+            if m is not None:
+                words, cmd = m.groups()
+                fparams = { k: float(v) for k, v in word_r.findall(words) }
+                gcmd = GCodeCommand(self, cmd, origline, None, need_ack,
+                                    fparams)
+                # Gather runs of commands that have a batch handler
+                bh = batch_handlers.get(cmd)
+                if bh is not None and bh[0] is self.gcode_handlers.get(cmd):
+                    if batch and bh[1] != batch_func:
+                        self._process_batch(batch_func, batch, need_ack)
+                        batch = []
+                    batch_func = bh[1]
+                    batch.append(gcmd)
+                    continue
+            else:
+                cmd, params = parse_traditional(line)
+                gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
+            if batch:
+                self._process_batch(batch_func, batch, need_ack)
+                batch = []
             # Invoke handler for command
             handler = self.gcode_handlers.get(cmd, self.cmd_default)
             try:
@@ -188,11 +262,51 @@ class GCodeDispatch:
                 if not need_ack:
                     raise
             gcmd.ack()
+        if batch:
+            self._process_batch(batch_func, batch, need_ack)
+    def _process_batch(self, batch_func, gcmds, need_ack):
+        # The batch handler reads the commands from an iterator.  A
+        # command is acknowledged when the handler requests the next
+        # one, so errors are reported on the command that raised them.
+        pos = [0]
+        def iter_commands():
+            while pos[0] < len(gcmds) and self.is_printer_ready:
+                gcmd = gcmds[pos[0]]
+                yield gcmd
+                pos[0] += 1
+                gcmd.ack()
+        while pos[0] < len(gcmds):
+            if not self.is_printer_ready:
+                # Report the remaining commands via the regular handlers
+                self._process_commands([gcmd.get_commandline()
+                                        for gcmd in gcmds[pos[0]:]],
+                                       need_ack)
+                return
+            try:
+                batch_func(iter_commands())
+            except self.error as e:
+                self._respond_error(str(e))
+                self.printer.send_event("gcode:command_error")
+                if not need_ack:
+                    raise
+                gcmds[pos[0]].ack()
+                pos[0] += 1
+            except:
+                gcmd = gcmds[pos[0]]
+                msg = 'Internal error on command:"%s"' % (gcmd.get_command(),)
+                logging.exception(msg)
+                self.printer.invoke_shutdown(msg)
+                self._respond_error(msg)
+                if not need_ack:
+                    raise
+                gcmd.ack()
+                pos[0] += 1
     def run_script_from_command(self, script):
         self._process_commands(script.split('\n'), need_ack=False)
-    def run_script(self, script):
+    def run_script(self, script, line_callback=None):
         with self.mutex:
-            self._process_commands(script.split('\n'), need_ack=False)
+            self._process_commands(script.split('\n'), need_ack=False,
+                                   line_callback=line_callback)
     def get_mutex(self):
         return self.mutex
     def create_gcode_command(self, command, commandline, params):
@@ -231,8 +345,9 @@ class GCodeDispatch:
         try:
             eparams = [earg.split('=', 1) for earg in shlex.split(eargs)]
             eparams = { k.upper(): v for k, v in eparams }
-            gcmd._params.clear()
-            gcmd._params.update(eparams)
+            params = gcmd.get_command_parameters()
+            params.clear()
+            params.update(eparams)
             return gcmd
         except ValueError as e:
             raise self.error("Malformed command '%s'"
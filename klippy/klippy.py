@@ -226,6 +226,17 @@ class Printer:
                 logging.exception("Exception during shutdown handler")
         logging.info("Reactor garbage collection: %s",
                      self.reactor.get_gc_stats())
+        self._log_timer_stats()
+    def _log_timer_stats(self):
+        # Report the timer callbacks that used the most reactor time
+        lines = ["Reactor timer callbacks (count total max histogram):"]
+        for name, count, total, max_time, hist in (
+                self.reactor.get_timer_stats()[:10]):
+            while hist and not hist[-1]:
+                hist.pop()
+            lines.append("%s: %d %.6f %.6f %s" % (
+                name, count, total, max_time, hist))
+        logging.info("\n".join(lines))
     def invoke_async_shutdown(self, msg):
         self.reactor.register_async_callback(
             (lambda e: self.invoke_shutdown(msg)))
@@ -3,7 +3,7 @@
 # Copyright (C) 2018-2019  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, logging, multiprocessing, traceback
+import math, time, logging, multiprocessing, traceback
 import queuelogger
 
 
@@ -13,6 +13,11 @@ import queuelogger
 
 # Helper code that implements coordinate descent
 def coordinate_descent(adj_params, params, error_func):
+    params, best_err, rounds = _coordinate_descent(adj_params, params,
+                                                   error_func)
+    return params
+
+def _coordinate_descent(adj_params, params, error_func):
     # Define potential changes
     params = dict(params)
     dp = {param_name: 1. for param_name in adj_params}
@@ -45,16 +50,129 @@ def coordinate_descent(adj_params, params, error_func):
             dp[param_name] *= 0.9
     logging.info("Coordinate descent best_err: %s  rounds: %d",
                  best_err, rounds)
-    return params
+    return params, best_err, rounds
+
+
+######################################################################
+# Levenberg-Marquardt
+######################################################################
+
+class SolverError(Exception):
+    pass
+
+# Helper code that implements the Levenberg-Marquardt algorithm.  The
+# residual_func must return a list of errors (the sum of their squares
+# is minimized) and may raise ValueError for invalid parameters.
+def _levenberg_marquardt(adj_params, params, residual_func):
+    params = dict(params)
+    try:
+        residuals = residual_func(params)
+    except ValueError as e:
+        raise SolverError("Unable to calculate the error of the initial"
+                          " parameters (%s)" % (e,))
+    best_err = sum([r*r for r in residuals])
+    logging.info("Levenberg-Marquardt initial error: %s", best_err)
+    damping = .001
+    rounds = 0
+    while rounds < 1000:
+        rounds += 1
+        # Estimate the jacobian of the residuals using forward differences
+        jacobian = []
+        for param_name in adj_params:
+            orig = params[param_name]
+            step = 1e-6 * max(abs(orig), 1.)
+            params[param_name] = orig + step
+            try:
+                res = residual_func(params)
+            except ValueError:
+                step = -step
+                params[param_name] = orig + step
+                try:
+                    res = residual_func(params)
+                except ValueError:
+                    # Don't adjust this parameter during this round
+                    res = residuals
+            params[param_name] = orig
+            jacobian.append([(r - r0) / step for r, r0 in zip(res, residuals)])
+        # Calculate the normal equations (J^T*J)*delta = -J^T*r
+        jtj = [[sum([a*b for a, b in zip(col1, col2)]) for col2 in jacobian]
+               for col1 in jacobian]
+        jtr = [-sum([a*r for a, r in zip(col, residuals)])
+               for col in jacobian]
+        diag = [max(jtj[i][i], 1e-12) for i in range(len(jtj))]
+        # Find a damping that reduces the error
+        while 1:
+            matrix = [list(row) for row in jtj]
+            for i in range(len(matrix)):
+                matrix[i][i] += damping * diag[i]
+            new_params = dict(params)
+            try:
+                delta = solve_linear(matrix, jtr)
+                for param_name, d in zip(adj_params, delta):
+                    new_params[param_name] += d
+                new_residuals = residual_func(new_params)
+                err = sum([r*r for r in new_residuals])
+            except (ValueError, ZeroDivisionError):
+                err = best_err
+            if err < best_err:
+                break
+            damping *= 10.
+            if damping > 1e10:
+                # No further improvement possible
+                logging.info("Levenberg-Marquardt best_err: %s  rounds: %d",
+                             best_err, rounds)
+                return params, best_err, rounds
+        improvement = best_err - err
+        params, residuals, best_err = new_params, new_residuals, err
+        damping = max(damping * .1, 1e-9)
+        if improvement <= 1e-12 * best_err or max(map(abs, delta)) < 1e-9:
+            break
+    logging.info("Levenberg-Marquardt best_err: %s  rounds: %d",
+                 best_err, rounds)
+    return params, best_err, rounds
+
+
+######################################################################
+# Calibration solvers
+######################################################################
+
+# Return the sum of the squares of the errors (for coordinate descent)
+def calc_residual_error(residual_func, params):
+    try:
+        return sum([r*r for r in residual_func(params)])
+    except ValueError:
+        return 9999999999999.9
+
+def _solve_coordinate_descent(adj_params, params, residual_func):
+    def error_func(params):
+        return calc_residual_error(residual_func, params)
+    return _coordinate_descent(adj_params, params, error_func)
 
-# Helper to run the coordinate descent function in a background
-# process so that it does not block the main thread.
-def background_coordinate_descent(printer, adj_params, params, error_func):
+# The available solvers (each returns a (params, error, rounds) tuple)
+SOLVERS = {
+    'coordinate_descent': _solve_coordinate_descent,
+    'levenberg_marquardt': _levenberg_marquardt,
+}
+
+# Find the params that minimize the errors returned by residual_func
+def solve(solver, adj_params, params, residual_func):
+    start_time = time.time()
+    params, best_err, rounds = SOLVERS[solver](adj_params, params,
+                                               residual_func)
+    return params, best_err, rounds, time.time() - start_time
+
+# Helper to run a solver in a background process so that it does not
+# block the main thread.
+def background_solve(printer, solver, adj_params, params, residual_func):
     parent_conn, child_conn = multiprocessing.Pipe()
     def wrapper():
         queuelogger.clear_bg_logging()
         try:
-            res = coordinate_descent(adj_params, params, error_func)
+            res = solve(solver, adj_params, params, residual_func)
+        except SolverError as e:
+            child_conn.send((True, e))
+            child_conn.close()
+            return
         except:
             child_conn.send((True, traceback.format_exc()))
             child_conn.close()
@@ -77,10 +195,15 @@ def background_coordinate_descent(printer, adj_params, params, error_func):
     # Return results
     is_err, res = parent_conn.recv()
     if is_err:
-        raise Exception("Error in coordinate descent: %s" % (res,))
+        if isinstance(res, SolverError):
+            raise gcode.error("Error in %s: %s" % (solver, res))
+        raise Exception("Error in %s: %s" % (solver, res))
     calc_proc.join()
     parent_conn.close()
-    return res
+    new_params, best_err, rounds, run_time = res
+    gcode.respond_info("Calibration %s: error=%.9f rounds=%d time=%.3fs" % (
+        solver, best_err, rounds, run_time))
+    return new_params
 
 
 ######################################################################
@@ -135,3 +258,145 @@ def matrix_sub(m1, m2):
 
 def matrix_mul(m1, s):
     return [m1[0]*s, m1[1]*s, m1[2]*s]
+
+
+######################################################################
+# Linear equations
+######################################################################
+
+# Solve matrix*x = vector using gaussian elimination with partial
+# pivoting.  Raises ZeroDivisionError if the matrix is singular.
+def solve_linear(matrix, vector):
+    count = len(vector)
+    rows = [list(row) + [v] for row, v in zip(matrix, vector)]
+    for col in range(count):
+        pivot = max(range(col, count), key=lambda r: abs(rows[r][col]))
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        pivot_row = rows[col]
+        if not pivot_row[col]:
+            raise ZeroDivisionError("Singular matrix")
+        for row in rows[col+1:]:
+            f = row[col] / pivot_row[col]
+            if f:
+                for i in range(col, count + 1):
+                    row[i] -= f * pivot_row[i]
+    res = [0.] * count
+    for col in range(count - 1, -1, -1):
+        row = rows[col]
+        res[col] = (row[count] - sum([row[i] * res[i]
+                                      for i in range(col + 1, count)])
+                    ) / row[col]
+    return res
+
+
+######################################################################
+# Linear least squares
+######################################################################
+
+# Find the coefficients that minimize the weighted sum of the squares
+# of (dot(row, coefs) - value).  A tiny amount of damping keeps under
+# determined fits (eg, two probe points for a plane) well defined.
+def linear_least_squares(rows, values, weights=None):
+    if weights is None:
+        weights = [1.] * len(rows)
+    count = len(rows[0])
+    matrix = [[sum([w * r[i] * r[j] for r, w in zip(rows, weights)])
+               for j in range(count)] for i in range(count)]
+    vector = [sum([w * r[i] * v for r, v, w in zip(rows, values, weights)])
+              for i in range(count)]
+    for i in range(count):
+        matrix[i][i] = matrix[i][i] * (1. + 1e-9) + 1e-12
+    return solve_linear(matrix, vector)
+
+def _calc_residuals(rows, values, coefs):
+    return [v - sum([r * c for r, c in zip(row, coefs)])
+            for row, v in zip(rows, values)]
+
+# Weight each point by the inverse of its expected error - the sum of
+# its measurement variance and the variance of the model fit
+def _weighted_least_squares(rows, values, variances):
+    coefs = linear_least_squares(rows, values)
+    model_var = 0.
+    if len(rows) > len(rows[0]):
+        residuals = _calc_residuals(rows, values, coefs)
+        model_var = (sum([r*r for r in residuals])
+                     / (len(rows) - len(rows[0])))
+    expected = [var + model_var for var in variances]
+    if not max(expected):
+        return coefs, expected
+    expected = [max(e, 1e-12) for e in expected]
+    weights = [1. / e for e in expected]
+    return linear_least_squares(rows, values, weights), expected
+
+# Fit the rows to the measured values (each with an estimated
+# variance).  Points whose error exceeds outlier_sigma standard
+# deviations (of their measurement and of the fit to the remaining
+# points) are rejected.  Returns the coefficients and the indexes of
+# the points used.
+def fit_least_squares(rows, values, variances, outlier_sigma=0.):
+    param_count = len(rows[0])
+    active = list(range(len(rows)))
+    while 1:
+        act_rows = [rows[i] for i in active]
+        act_values = [values[i] for i in active]
+        coefs, expected = _weighted_least_squares(
+            act_rows, act_values, [variances[i] for i in active])
+        # Rejecting a point requires redundant points
+        if not outlier_sigma or len(active) < param_count + 3:
+            return coefs, active
+        residuals = _calc_residuals(act_rows, act_values, coefs)
+        worst = max(range(len(active)),
+                    key=(lambda i: residuals[i]**2 / max(expected[i], 1e-12)))
+        others = active[:worst] + active[worst+1:]
+        # Check the point against a fit of the remaining points
+        other_rows = [rows[i] for i in others]
+        other_values = [values[i] for i in others]
+        other_coefs, other_expected = _weighted_least_squares(
+            other_rows, other_values, [variances[i] for i in others])
+        other_residuals = _calc_residuals(other_rows, other_values,
+                                          other_coefs)
+        model_var = (sum([r*r for r in other_residuals])
+                     / (len(others) - param_count))
+        i = active[worst]
+        err = _calc_residuals([rows[i]], [values[i]], other_coefs)[0]
+        if err**2 <= outlier_sigma**2 * (variances[i] + model_var):
+            return coefs, active
+        active = others
+
+# Choose count rows that best determine the coefficients of a fit
+def select_rows(rows, count):
+    selected = []
+    for n in range(count):
+        best = best_det = None
+        for i, row in enumerate(rows):
+            if i in selected:
+                continue
+            sel_rows = [rows[j] for j in selected] + [row]
+            # Determinant of the gram matrix of the chosen rows
+            gram = [[sum([a*b for a, b in zip(r1, r2)]) for r2 in sel_rows]
+                    for r1 in sel_rows]
+            det = calc_determinant(gram)
+            if best_det is None or det > best_det:
+                best, best_det = i, det
+        selected.append(best)
+    return sorted(selected)
+
+# Calculate the determinant of a matrix using gaussian elimination
+def calc_determinant(matrix):
+    count = len(matrix)
+    rows = [list(row) for row in matrix]
+    det = 1.
+    for col in range(count):
+        pivot = max(range(col, count), key=lambda r: abs(rows[r][col]))
+        if not rows[pivot][col]:
+            return 0.
+        if pivot != col:
+            rows[col], rows[pivot] = rows[pivot], rows[col]
+            det = -det
+        pivot_row = rows[col]
+        det *= pivot_row[col]
+        for row in rows[col+1:]:
+            f = row[col] / pivot_row[col]
+            for i in range(col, count):
+                row[i] -= f * pivot_row[i]
+    return det
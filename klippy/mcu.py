@@ -376,9 +376,26 @@ class CommandWrapper:
         if cmd_queue is None:
             cmd_queue = serial.get_default_command_queue()
         self._cmd_queue = cmd_queue
+        self._encoder = serial.alloc_command_encoder(self._cmd)
+        self._buffer_params = [i for i, (name, t) in enumerate(
+            self._cmd.param_names) if t.is_dynamic_string]
     def send(self, data=(), minclock=0, reqclock=0):
-        cmd = self._cmd.encode(data)
-        self._serial.raw_send(cmd, minclock, reqclock, self._cmd_queue)
+        if self._encoder is None:
+            cmd = self._cmd.encode(data)
+            self._serial.raw_send(cmd, minclock, reqclock, self._cmd_queue)
+            return
+        buf = ''
+        if self._buffer_params:
+            # Buffer contents are passed separately from the integers
+            data = list(data)
+            buf = bytearray()
+            for i in self._buffer_params:
+                b = data[i]
+                buf.extend(b)
+                data[i] = len(b)
+            buf = bytes(buf)
+        self._serial.raw_send_encode(self._encoder, data, buf,
+                                     minclock, reqclock, self._cmd_queue)
 
 class MCU:
     error = error
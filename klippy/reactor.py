@@ -3,17 +3,40 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, gc, select, math, time, logging, Queue as queue
+import os, gc, select, math, time, logging, heapq, bisect, collections
+import Queue as queue
 import greenlet
 import chelper, util
 
 _NOW = 0.
 _NEVER = 9999999999999999.
 
+# Upper limits of the timer callback duration histogram buckets
+# (1us, 2us, 4us, ..., ~0.5s - the last bucket holds longer callbacks)
+TIMER_HIST_LIMITS = [.000001 * 2**i for i in range(20)]
+# Number of recent timer lateness samples used to report percentiles
+LATENESS_SAMPLES = 4096
+
+# Generate a name (for statistics) identifying a callback function
+def _callback_name(callback):
+    func = getattr(callback, 'im_func', callback)
+    name = getattr(func, '__name__', None) or type(callback).__name__
+    obj = getattr(callback, 'im_self', None)
+    if obj is not None:
+        name = "%s.%s" % (obj.__class__.__name__, name)
+    module = getattr(func, '__module__', None)
+    if module:
+        name = "%s:%s" % (module, name)
+    return name
+
 class ReactorTimer:
-    def __init__(self, callback, waketime):
+    def __init__(self, callback, waketime, seq):
         self.callback = callback
         self.waketime = waketime
+        self.seq = seq
+        self.heap_entry = None
+        self.is_registered = True
+        self.name = _callback_name(callback)
 
 class ReactorCompletion:
     class sentinel: pass
@@ -41,6 +64,7 @@ class ReactorCallback:
     def __init__(self, reactor, callback, waketime):
         self.reactor = reactor
         self.timer = reactor.register_timer(self.invoke, waketime)
+        self.timer.name = _callback_name(callback)
         self.callback = callback
         self.completion = ReactorCompletion(reactor)
     def invoke(self, eventtime):
@@ -100,9 +124,21 @@ class SelectReactor:
         # Python garbage collection
         self._check_gc = gc_checking
         self._last_gc_times = [0., 0., 0.]
-        # Timers
-        self._timers = []
+        # Timers (stored in a heap of (waketime, seq, timer) entries -
+        # only the entry a timer last pushed is valid, others are stale)
+        self._timer_heap = []
+        self._timer_count = self._timer_seq = 0
         self._next_timer = self.NEVER
+        self._timer_stats = {}
+        self._cur_timer_name = None
+        self._due_timers = []
+        self._due_pos = 0
+        # Optional instrumentation
+        self._instrument = False
+        self._late_samples = collections.deque(maxlen=LATENESS_SAMPLES)
+        self._late_max = 0.
+        self._late_max_name = None
+        self._fd_names = {}
         # Callbacks
         self._pipe_fds = None
         self._async_queue = queue.Queue()
@@ -112,24 +148,91 @@ class SelectReactor:
         self._g_dispatch = None
         self._greenlets = []
         self._all_greenlets = []
+        self._pause_counts = [0, 0]
     def get_gc_stats(self):
         return tuple(self._last_gc_times)
+    # Instrumentation
+    def set_instrumentation(self, enable):
+        # Enable tracking of timer lateness and fd callback durations
+        self._instrument = enable
+    def get_lateness_stats(self):
+        # Returns percentiles of recent timer lateness along with the
+        # maximum lateness (and the name of that timer's callback)
+        samples = sorted(self._late_samples)
+        res = {'count': len(samples), 'max': self._late_max,
+               'max_name': self._late_max_name}
+        for name, pct in [('p50', .50), ('p95', .95), ('p99', .99)]:
+            res[name] = 0.
+            if samples:
+                res[name] = samples[min(int(len(samples) * pct),
+                                        len(samples) - 1)]
+        return res
+    def get_greenlet_stats(self):
+        # Pauses of a callback greenlet (switch to the dispatch
+        # greenlet) and pauses of the dispatch greenlet (switch to a
+        # new dispatch greenlet)
+        return {'pauses': self._pause_counts[0],
+                'dispatch_pauses': self._pause_counts[1],
+                'greenlets': len(self._all_greenlets),
+                'idle_greenlets': len(self._greenlets)}
+    def get_timer_stats(self):
+        # Returns [(name, count, total_time, max_time, histogram), ...]
+        # sorted by total callback time
+        stats = [(name, st[0], st[1], st[2], list(st[3]))
+                 for name, st in self._timer_stats.items()]
+        stats.sort(key=(lambda s: s[2]), reverse=True)
+        return stats
     # Timers
+    def _add_timer_entry(self, timer_handler, waketime):
+        heap = self._timer_heap
+        entry = (waketime, timer_handler.seq, timer_handler)
+        timer_handler.heap_entry = entry
+        heapq.heappush(heap, entry)
+        if len(heap) > 2 * self._timer_count + 32:
+            # Discard stale entries
+            heap = [e for e in heap if self._is_live_entry(e)]
+            heapq.heapify(heap)
+            self._timer_heap = heap
+    def _is_live_entry(self, entry):
+        t = entry[2]
+        return (t.heap_entry is entry and t.waketime == entry[0]
+                and t.is_registered)
     def update_timer(self, timer_handler, waketime):
+        if timer_handler.waketime == waketime:
+            return
         timer_handler.waketime = waketime
-        self._next_timer = min(self._next_timer, waketime)
+        if timer_handler.is_registered and waketime < self.NEVER:
+            self._add_timer_entry(timer_handler, waketime)
+            self._next_timer = min(self._next_timer, waketime)
     def register_timer(self, callback, waketime=NEVER):
-        timer_handler = ReactorTimer(callback, waketime)
-        timers = list(self._timers)
-        timers.append(timer_handler)
-        self._timers = timers
-        self._next_timer = min(self._next_timer, waketime)
+        self._timer_seq += 1
+        timer_handler = ReactorTimer(callback, waketime, self._timer_seq)
+        self._timer_count += 1
+        if waketime < self.NEVER:
+            self._add_timer_entry(timer_handler, waketime)
+            self._next_timer = min(self._next_timer, waketime)
         return timer_handler
     def unregister_timer(self, timer_handler):
+        if timer_handler.is_registered:
+            timer_handler.is_registered = False
+            self._timer_count -= 1
         timer_handler.waketime = self.NEVER
-        timers = list(self._timers)
-        timers.pop(timers.index(timer_handler))
-        self._timers = timers
+    def _note_timer_time(self, name, duration):
+        st = self._timer_stats.get(name)
+        if st is None:
+            st = self._timer_stats[name] = [
+                0, 0., 0., [0] * (len(TIMER_HIST_LIMITS) + 1)]
+        st[0] += 1
+        st[1] += duration
+        if duration > st[2]:
+            st[2] = duration
+        st[3][bisect.bisect(TIMER_HIST_LIMITS, duration)] += 1
+    def _requeue_due_timers(self):
+        # Return the timers of an interrupted _check_timers() to the heap
+        for entry in self._due_timers[self._due_pos:]:
+            if self._is_live_entry(entry):
+                self._add_timer_entry(entry[2], entry[0])
+        self._due_timers = []
     def _check_timers(self, eventtime, busy):
         if eventtime < self._next_timer:
             if busy:
@@ -147,18 +250,53 @@ class SelectReactor:
                     gc.collect(gc_level)
                     return 0.
             return min(1., max(.001, self._next_timer - eventtime))
-        self._next_timer = self.NEVER
+        # Find all timers that are due (each timer runs at most once here)
+        heap = self._timer_heap
+        due = []
+        while heap and heap[0][0] <= eventtime:
+            entry = heapq.heappop(heap)
+            if self._is_live_entry(entry):
+                due.append(entry)
+        self._due_timers = due
         g_dispatch = self._g_dispatch
-        for t in self._timers:
-            waketime = t.waketime
-            if eventtime >= waketime:
-                t.waketime = self.NEVER
-                t.waketime = waketime = t.callback(eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._next_timer = min(self._next_timer, waketime)
-                    self._end_greenlet(g_dispatch)
-                    return 0.
-            self._next_timer = min(self._next_timer, waketime)
+        monotonic = self.monotonic
+        instrument = self._instrument
+        start_time = monotonic()
+        for i in range(len(due)):
+            entry = due[i]
+            if not self._is_live_entry(entry):
+                # Timer was updated by an earlier callback
+                continue
+            waketime, seq, t = entry
+            if instrument and waketime > self.NOW:
+                late = start_time - waketime
+                self._late_samples.append(late)
+                if late > self._late_max:
+                    self._late_max = late
+                    self._late_max_name = t.name
+            t.waketime = self.NEVER
+            self._cur_timer_name = t.name
+            self._due_pos = i + 1
+            t.waketime = waketime = t.callback(eventtime)
+            if t.is_registered and waketime < self.NEVER:
+                self._add_timer_entry(t, waketime)
+            if g_dispatch is not self._g_dispatch:
+                # This greenlet paused and is no longer the dispatcher
+                # (remaining due timers were requeued by pause())
+                self._next_timer = min(self._next_timer, waketime)
+                self._end_greenlet(g_dispatch)
+                return 0.
+            end_time = monotonic()
+            self._note_timer_time(t.name, end_time - start_time)
+            start_time = end_time
+        self._due_timers = []
+        self._cur_timer_name = None
+        heap = self._timer_heap
+        while heap and not self._is_live_entry(heap[0]):
+            heapq.heappop(heap)
+        self._next_timer = self.NEVER
+        if heap:
+            self._next_timer = heap[0][0]
         return 0.
     # Callbacks and Completions
     def completion(self):
@@ -209,7 +347,9 @@ class SelectReactor:
             if self._g_dispatch is None:
                 return self._sys_pause(waketime)
             # Switch to _check_timers (via g.timer.callback return)
+            self._pause_counts[0] += 1
             return self._g_dispatch.switch(waketime)
+        self._pause_counts[1] += 1
         # Pausing the dispatch greenlet - prepare a new greenlet to do dispatch
         if self._greenlets:
             g_next = self._greenlets.pop()
@@ -217,7 +357,10 @@ class SelectReactor:
             g_next = ReactorGreenlet(run=self._dispatch_loop)
             self._all_greenlets.append(g_next)
         g_next.parent = g.parent
+        self._requeue_due_timers()
         g.timer = self.register_timer(g.switch, waketime)
+        # Attribute the greenlet run time to the code that paused
+        g.timer.name = self._cur_timer_name or "greenlet"
         self._next_timer = self.NOW
         # Switch to _dispatch_loop (via _end_greenlet or direct)
         eventtime = g_next.switch()
@@ -232,6 +375,19 @@ class SelectReactor:
         self._g_dispatch.switch(self.NEVER)
         # This greenlet reactivated from pause() - return to main dispatch loop
         self._g_dispatch = g_old
+    def _timed_fd_callback(self, callback, eventtime):
+        # Cache names by function (to not hold references to objects)
+        func = getattr(callback, 'im_func', callback)
+        name = self._fd_names.get(func)
+        if name is None:
+            name = self._fd_names[func] = _callback_name(callback)
+        self._cur_timer_name = name
+        g_dispatch = self._g_dispatch
+        start_time = self.monotonic()
+        callback(eventtime)
+        if g_dispatch is self._g_dispatch:
+            self._note_timer_time(name, self.monotonic() - start_time)
+        self._cur_timer_name = None
     # Mutexes
     def mutex(self, is_locked=False):
         return ReactorMutex(self, is_locked)
@@ -254,7 +410,10 @@ class SelectReactor:
             eventtime = self.monotonic()
             for fd in res[0]:
                 busy = True
-                fd.callback(eventtime)
+                if self._instrument:
+                    self._timed_fd_callback(fd.callback, eventtime)
+                else:
+                    fd.callback(eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -313,7 +472,10 @@ class PollReactor(SelectReactor):
             eventtime = self.monotonic()
             for fd, event in res:
                 busy = True
-                self._fds[fd](eventtime)
+                if self._instrument:
+                    self._timed_fd_callback(self._fds[fd], eventtime)
+                else:
+                    self._fds[fd](eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -350,7 +512,10 @@ class EPollReactor(SelectReactor):
             eventtime = self.monotonic()
             for fd, event in res:
                 busy = True
-                self._fds[fd](eventtime)
+                if self._instrument:
+                    self._timed_fd_callback(self._fds[fd], eventtime)
+                else:
+                    self._fds[fd](eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -11,6 +11,97 @@ import msgproto, chelper, util
 class error(Exception):
     pass
 
+PULL_BATCH = 32
+
+# Decode received messages in C using the formats of a MessageParser
+class CompiledMessageParser:
+    def __init__(self, msgparser):
+        self.msgparser = msgparser
+        self.ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.cparser = self.ffi_main.gc(self.ffi_lib.msgparse_alloc(),
+                                        self.ffi_lib.msgparse_free)
+        self.args = self.ffi_main.new('int64_t[%d]' % (
+            PULL_BATCH * msgproto.MESSAGE_MAX,))
+        self.formats = {}
+        for msgid, mf in msgparser.messages_by_id.items():
+            self._add_format(msgid, mf)
+    def _add_format(self, msgid, mf):
+        debugformat = None
+        if isinstance(mf, msgproto.OutputFormat):
+            debugformat = mf.debugformat
+            param_types = mf.param_types
+            param_names = [None] * len(param_types)
+        else:
+            param_names = [name for name, t in mf.param_names]
+            param_types = [t for name, t in mf.param_names]
+        ctypes = []
+        fixups = []
+        for i, t in enumerate(param_types):
+            if isinstance(t, msgproto.Enumeration):
+                if t.pt.is_dynamic_string:
+                    return
+                fixups.append((i, t.reverse_enums))
+                t = t.pt
+            if t.is_dynamic_string:
+                ctypes.append(self.ffi_lib.MP_STRING)
+                fixups.append((i, None))
+            elif t.signed:
+                ctypes.append(self.ffi_lib.MP_INT)
+            else:
+                ctypes.append(self.ffi_lib.MP_UINT)
+        ret = self.ffi_lib.msgparse_add_format(self.cparser, msgid,
+                                               ctypes, len(ctypes))
+        if ret:
+            return
+        self.formats[msgid] = (mf.name, param_names, len(ctypes),
+                               fixups, debugformat)
+    def parse_batch(self, responses, count):
+        # Decode the messages in a 'struct pull_queue_message' array
+        if count * msgproto.MESSAGE_MAX > len(self.args):
+            self.args = self.ffi_main.new(
+                'int64_t[%d]' % (count * msgproto.MESSAGE_MAX,))
+        total = self.ffi_lib.msgparse_parse_batch(self.cparser, responses,
+                                                  count, self.args)
+        args = self.ffi_main.unpack(self.args, total)
+        out = []
+        pos = 0
+        for i in range(count):
+            msgid = args[pos]
+            if msgid < 0:
+                pos += 1
+                response = responses[i]
+                if response.notify_id:
+                    out.append(None)
+                    continue
+                # Use the reference python parser (and its error reporting)
+                out.append(self.msgparser.parse(
+                    self.ffi_main.unpack(response.msg, response.len)))
+                continue
+            name, param_names, param_count, fixups, debugformat = (
+                self.formats[msgid])
+            params = args[pos+1:pos+1+param_count]
+            pos += param_count + 1
+            for j, reverse_enums in fixups:
+                v = params[j]
+                if reverse_enums is None:
+                    msg = responses[i].msg
+                    v = self.ffi_main.buffer(msg + v + 1, msg[v])[:]
+                    if debugformat is not None:
+                        v = repr(v)
+                else:
+                    tv = reverse_enums.get(v)
+                    if tv is None:
+                        tv = "?%d" % (v,)
+                    v = tv
+                params[j] = v
+            if debugformat is not None:
+                params = {'#msg': debugformat % tuple(params)}
+            else:
+                params = dict(zip(param_names, params))
+            params['#name'] = name
+            out.append(params)
+        return out
+
 class SerialReader:
     BITS_PER_BYTE = 10.
     def __init__(self, reactor, serialport, baud, rts=True):
@@ -21,6 +112,7 @@ class SerialReader:
         self.ser = None
         self.rts = rts
         self.msgparser = msgproto.MessageParser()
+        self.cmsgparser = CompiledMessageParser(self.msgparser)
         # C interface
         self.ffi_main, self.ffi_lib = chelper.get_ffi()
         self.serialqueue = None
@@ -36,29 +128,54 @@ class SerialReader:
         # Sent message notification tracking
         self.last_notify_id = 0
         self.pending_notifications = {}
+        # Receive statistics (messages, pulls, latency sum, latency max)
+        self.pull_stats = [0, 0, 0., 0.]
+        self.last_pull_stats = (0., 0)
     def _bg_thread(self):
-        response = self.ffi_main.new('struct pull_queue_message *')
+        responses = self.ffi_main.new('struct pull_queue_message[%d]'
+                                      % (PULL_BATCH,))
+        get_monotonic = self.reactor.monotonic
         while 1:
-            self.ffi_lib.serialqueue_pull(self.serialqueue, response)
-            count = response.len
+            count = self.ffi_lib.serialqueue_pull_batch(
+                self.serialqueue, responses, PULL_BATCH)
             if count < 0:
                 break
-            if response.notify_id:
-                params = {'#sent_time': response.sent_time,
-                          '#receive_time': response.receive_time}
-                completion = self.pending_notifications.pop(response.notify_id)
-                self.reactor.async_complete(completion, params)
-                continue
-            params = self.msgparser.parse(response.msg[0:count])
-            params['#sent_time'] = response.sent_time
-            params['#receive_time'] = response.receive_time
-            hdl = (params['#name'], params.get('oid'))
-            try:
-                with self.lock:
-                    hdl = self.handlers.get(hdl, self.handle_default)
-                    hdl(params)
-            except:
-                logging.exception("Exception in serial callback")
+            pull_time = get_monotonic()
+            # Parse the messages outside of the lock
+            batch_params = self.cmsgparser.parse_batch(responses, count)
+            msgs = []
+            latency_sum = latency_max = 0.
+            for i in range(count):
+                response = responses[i]
+                latency = pull_time - response.receive_time
+                latency_sum += latency
+                latency_max = max(latency_max, latency)
+                if response.notify_id:
+                    params = {'#sent_time': response.sent_time,
+                              '#receive_time': response.receive_time}
+                    msgs.append((response.notify_id, params))
+                    continue
+                params = batch_params[i]
+                params['#sent_time'] = response.sent_time
+                params['#receive_time'] = response.receive_time
+                msgs.append((0, params))
+            # Dispatch the messages (in the order they were received)
+            with self.lock:
+                self.pull_stats[0] += count
+                self.pull_stats[1] += 1
+                self.pull_stats[2] += latency_sum
+                self.pull_stats[3] = max(self.pull_stats[3], latency_max)
+                for notify_id, params in msgs:
+                    if notify_id:
+                        completion = self.pending_notifications.pop(notify_id)
+                        self.reactor.async_complete(completion, params)
+                        continue
+                    hdl = (params['#name'], params.get('oid'))
+                    try:
+                        hdl = self.handlers.get(hdl, self.handle_default)
+                        hdl(params)
+                    except:
+                        logging.exception("Exception in serial callback")
     def _get_identify_data(self, eventtime):
         # Query the "data dictionary" from the micro-controller
         identify_data = ""
@@ -113,6 +230,7 @@ class SerialReader:
         msgparser = msgproto.MessageParser()
         msgparser.process_identify(identify_data)
         self.msgparser = msgparser
+        self.cmsgparser = CompiledMessageParser(msgparser)
         self.register_response(self.handle_unknown, '#unknown')
         # Setup baud adjust
         mcu_baud = msgparser.get_constant_float('SERIAL_BAUD', None)
@@ -127,6 +245,7 @@ class SerialReader:
     def connect_file(self, debugoutput, dictionary, pace=False):
         self.ser = debugoutput
         self.msgparser.process_identify(dictionary, decompress=False)
+        self.cmsgparser = CompiledMessageParser(self.msgparser)
         self.serialqueue = self.ffi_main.gc(
             self.ffi_lib.serialqueue_alloc(self.ser.fileno(), 1),
             self.ffi_lib.serialqueue_free)
@@ -145,12 +264,26 @@ class SerialReader:
         for pn in self.pending_notifications.values():
             pn.complete(None)
         self.pending_notifications.clear()
+    def _pull_stats(self, eventtime):
+        with self.lock:
+            msgs, pulls, latency_sum, latency_max = self.pull_stats
+            self.pull_stats[3] = 0.
+        last_time, last_msgs = self.last_pull_stats
+        self.last_pull_stats = (eventtime, msgs)
+        rate = 0.
+        if last_time and eventtime > last_time:
+            rate = (msgs - last_msgs) / (eventtime - last_time)
+        return ("receive_msgs=%d receive_rate=%.1f msgs_per_pull=%.2f"
+                " pull_latency_avg=%.6f pull_latency_max=%.6f" % (
+                    msgs, rate, float(msgs) / max(pulls, 1),
+                    latency_sum / max(msgs, 1), latency_max))
     def stats(self, eventtime):
         if self.serialqueue is None:
             return ""
         self.ffi_lib.serialqueue_get_stats(
             self.serialqueue, self.stats_buf, len(self.stats_buf))
-        return self.ffi_main.string(self.stats_buf)
+        return "%s %s" % (self.ffi_main.string(self.stats_buf),
+                          self._pull_stats(eventtime))
     def get_reactor(self):
         return self.reactor
     def get_msgparser(self):
@@ -168,6 +301,28 @@ class SerialReader:
     def raw_send(self, cmd, minclock, reqclock, cmd_queue):
         self.ffi_lib.serialqueue_send(self.serialqueue, cmd_queue,
                                       cmd, len(cmd), minclock, reqclock, 0)
+    def alloc_command_encoder(self, cmd):
+        # Create a C encoder for a msgproto.MessageFormat (if possible)
+        param_types = []
+        for name, t in cmd.param_names:
+            if isinstance(t, msgproto.Enumeration):
+                return None
+            if t.is_dynamic_string:
+                param_types.append(self.ffi_lib.CE_BUFFER)
+            else:
+                param_types.append(self.ffi_lib.CE_INT)
+        encoder = self.ffi_lib.command_encoder_alloc(
+            cmd.msgid, param_types, len(param_types))
+        if encoder == self.ffi_main.NULL:
+            return None
+        return self.ffi_main.gc(encoder, self.ffi_lib.command_encoder_free)
+    def raw_send_encode(self, encoder, args, buf, minclock, reqclock,
+                        cmd_queue):
+        ret = self.ffi_lib.serialqueue_send_encode(
+            self.serialqueue, cmd_queue, encoder, args, len(args),
+            buf, len(buf), minclock, reqclock, 0)
+        if ret:
+            raise error("Unable to encode command")
     def raw_send_wait_ack(self, cmd, minclock, reqclock, cmd_queue):
         self.last_notify_id += 1
         nid = self.last_notify_id
@@ -154,7 +154,7 @@ class MCU_stepper:
         return old_tq
     def add_active_callback(self, cb):
         self._active_callbacks.append(cb)
-    def generate_steps(self, flush_time):
+    def check_active_callbacks(self, flush_time):
         # Check for activity if necessary
         if self._active_callbacks:
             ret = self._itersolve_check_active(self._stepper_kinematics,
@@ -164,6 +164,10 @@ class MCU_stepper:
                 self._active_callbacks = []
                 for cb in cbs:
                     cb(ret)
+    def get_stepper_kinematics(self):
+        return self._stepper_kinematics
+    def generate_steps(self, flush_time):
+        self.check_active_callbacks(flush_time)
         # Generate steps
         ret = self._itersolve_generate_steps(self._stepper_kinematics,
                                              flush_time)
@@ -173,6 +177,32 @@ class MCU_stepper:
         return self._ffi_lib.itersolve_is_active_axis(
             self._stepper_kinematics, axis)
 
+# Generate steps for several steppers concurrently using C worker threads
+class StepGenerationPool:
+    def __init__(self, num_threads):
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self._pool = ffi_main.gc(ffi_lib.stepgen_pool_alloc(num_threads),
+                                 ffi_lib.stepgen_pool_free)
+        self._pool_generate_steps = ffi_lib.stepgen_pool_generate_steps
+        self._steppers = []
+    def add_step_generator(self, handler):
+        # Only the steps of an MCU_stepper may be generated by the pool
+        stepper = getattr(handler, '__self__', None)
+        if (not isinstance(stepper, MCU_stepper)
+            or handler != stepper.generate_steps):
+            return False
+        self._steppers.append(stepper)
+        return True
+    def generate_steps(self, flush_time):
+        sk_list = []
+        for stepper in self._steppers:
+            stepper.check_active_callbacks(flush_time)
+            sk_list.append(stepper.get_stepper_kinematics())
+        ret = self._pool_generate_steps(self._pool, sk_list, len(sk_list),
+                                        flush_time)
+        if ret:
+            raise error("Internal error in stepcompress")
+
 # Helper code to build a stepper object from a config section
 def PrinterStepper(config, units_in_radians=False):
     printer = config.get_printer()
@@ -4,39 +4,55 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import math, logging, importlib
-import mcu, homing, chelper, kinematics.extruder
+import mcu, homing, stepper, chelper, kinematics.extruder
+
+class error(Exception):
+    pass
 
 # Common suffixes: _d is distance (in mm), _v is velocity (in
 #   mm/second), _v2 is velocity squared (mm^2/s^2), _t is time (in
 #   seconds), _r is ratio (scalar between 0.0 and 1.0)
 
 # Class to track each move request
-class Move:
+class Move(object):
+    # Moves are allocated for every G1 - use slots to keep them compact
+    __slots__ = ('toolhead', 'start_pos', 'end_pos', 'accel',
+                 'timing_callbacks', 'is_kinematic_move', 'axes_d', 'axes_r',
+                 'move_d', 'min_move_t', 'max_start_v2', 'max_cruise_v2',
+                 'delta_v2', 'max_smoothed_v2', 'smooth_delta_v2',
+                 'start_v', 'cruise_v', 'end_v', 'accel_t', 'cruise_t',
+                 'decel_t')
     def __init__(self, toolhead, start_pos, end_pos, speed):
         self.toolhead = toolhead
-        self.start_pos = tuple(start_pos)
-        self.end_pos = tuple(end_pos)
+        self.start_pos = start_pos = tuple(start_pos)
+        self.end_pos = end_pos = tuple(end_pos)
         self.accel = toolhead.max_accel
-        self.timing_callbacks = []
+        self.timing_callbacks = ()
         velocity = min(speed, toolhead.max_velocity)
         self.is_kinematic_move = True
-        self.axes_d = axes_d = [end_pos[i] - start_pos[i] for i in (0, 1, 2, 3)]
-        self.move_d = move_d = math.sqrt(sum([d*d for d in axes_d[:3]]))
+        dx = end_pos[0] - start_pos[0]
+        dy = end_pos[1] - start_pos[1]
+        dz = end_pos[2] - start_pos[2]
+        de = end_pos[3] - start_pos[3]
+        self.move_d = move_d = math.sqrt(dx*dx + dy*dy + dz*dz)
         if move_d < .000000001:
             # Extrude only move
             self.end_pos = (start_pos[0], start_pos[1], start_pos[2],
                             end_pos[3])
-            axes_d[0] = axes_d[1] = axes_d[2] = 0.
-            self.move_d = move_d = abs(axes_d[3])
+            self.axes_d = (0., 0., 0., de)
+            self.move_d = move_d = abs(de)
             inv_move_d = 0.
             if move_d:
                 inv_move_d = 1. / move_d
+            self.axes_r = (0., 0., 0., de * inv_move_d)
             self.accel = 99999999.9
             velocity = speed
             self.is_kinematic_move = False
         else:
+            self.axes_d = (dx, dy, dz, de)
             inv_move_d = 1. / move_d
-        self.axes_r = [d * inv_move_d for d in axes_d]
+            self.axes_r = (dx * inv_move_d, dy * inv_move_d, dz * inv_move_d,
+                           de * inv_move_d)
         self.min_move_t = move_d / velocity
         # Junction speeds are tracked in velocity squared.  The
         # delta_v2 is the maximum amount of this squared-velocity that
@@ -114,6 +130,7 @@ class MoveQueue:
         self.toolhead = toolhead
         self.queue = []
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        self.total_moves = 0
     def reset(self):
         del self.queue[:]
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
@@ -133,8 +150,9 @@ class MoveQueue:
         # after the last move.
         delayed = []
         next_end_v2 = next_smoothed_v2 = peak_cruise_v2 = 0.
-        for i in range(flush_count-1, -1, -1):
-            move = queue[i]
+        i = flush_count
+        for move in reversed(queue):
+            i -= 1
             reachable_start_v2 = next_end_v2 + move.delta_v2
             start_v2 = min(move.max_start_v2, reachable_start_v2)
             reachable_smoothed_v2 = next_smoothed_v2 + move.smooth_delta_v2
@@ -173,18 +191,88 @@ class MoveQueue:
             return
         # Generate step times for all moves ready to be flushed
         self.toolhead._process_moves(queue[:flush_count])
+        self.total_moves += flush_count
+        # Remove processed moves from the queue
+        del queue[:flush_count]
+    def add_move(self, move):
+        queue = self.queue
+        queue.append(move)
+        if len(queue) == 1:
+            return
+        move.calc_junction(queue[-2])
+        self.junction_flush -= move.min_move_t
+        if self.junction_flush <= 0.:
+            # Enough moves have been queued to reach the target flush time.
+            self.flush(lazy=True)
+
+# Look-ahead queue with the junction and velocity planning performed
+# in the C helper code (see chelper/lookahead.c)
+class CMoveQueue(MoveQueue):
+    def __init__(self, toolhead):
+        MoveQueue.__init__(self, toolhead)
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.lookahead = ffi_main.gc(ffi_lib.lookahead_alloc(),
+                                     ffi_lib.lookahead_free)
+        self.lookahead_add_move = ffi_lib.lookahead_add_move
+        self.lookahead_flush = ffi_lib.lookahead_flush
+        self.lookahead_get_moves = ffi_lib.lookahead_get_moves
+        self.lookahead_discard = ffi_lib.lookahead_discard
+        self.lookahead_reset = ffi_lib.lookahead_reset
+    def reset(self):
+        MoveQueue.reset(self)
+        self.lookahead_reset(self.lookahead)
+    def flush(self, lazy=False):
+        self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        flush_count = self.lookahead_flush(self.lookahead, lazy)
+        if not flush_count:
+            return
+        # Copy the final velocities and times to the moves being flushed
+        queue = self.queue
+        moves = queue[:flush_count]
+        la_moves = self.lookahead_get_moves(self.lookahead)
+        for i in range(flush_count):
+            move = moves[i]
+            lm = la_moves[i]
+            move.start_v = lm.start_v
+            move.cruise_v = lm.cruise_v
+            move.end_v = lm.end_v
+            move.accel_t = lm.accel_t
+            move.cruise_t = lm.cruise_t
+            move.decel_t = lm.decel_t
+        # Generate step times for all moves ready to be flushed
+        self.toolhead._process_moves(moves)
+        self.total_moves += flush_count
         # Remove processed moves from the queue
         del queue[:flush_count]
+        self.lookahead_discard(self.lookahead, flush_count)
     def add_move(self, move):
-        self.queue.append(move)
-        if len(self.queue) == 1:
+        queue = self.queue
+        queue.append(move)
+        toolhead = self.toolhead
+        # Allow extruder to calculate its maximum junction
+        extruder_v2 = 0.
+        if len(queue) > 1:
+            prev_move = queue[-2]
+            if move.is_kinematic_move and prev_move.is_kinematic_move:
+                extruder_v2 = toolhead.extruder.calc_junction(prev_move, move)
+        axes_r = move.axes_r
+        ret = self.lookahead_add_move(
+            self.lookahead, move.move_d, move.accel, move.max_cruise_v2,
+            move.delta_v2, move.smooth_delta_v2, axes_r[0], axes_r[1],
+            axes_r[2], move.is_kinematic_move, toolhead.junction_deviation,
+            extruder_v2)
+        if ret < 0:
+            queue.pop()
+            raise error("Internal error in lookahead")
+        if len(queue) == 1:
             return
-        move.calc_junction(self.queue[-2])
         self.junction_flush -= move.min_move_t
         if self.junction_flush <= 0.:
             # Enough moves have been queued to reach the target flush time.
             self.flush(lazy=True)
 
+LOOKAHEAD_PLANNERS = {'c': CMoveQueue, 'python': MoveQueue}
+
 MIN_KIN_TIME = 0.100
 MOVE_BATCH_TIME = 0.500
 SDS_CHECK_TIME = 0.001 # step+dir+step filter in stepcompress.c
@@ -205,7 +293,9 @@ class ToolHead:
         self.can_pause = True
         if self.mcu.is_fileoutput():
             self.can_pause = False
-        self.move_queue = MoveQueue(self)
+        move_queue_class = config.getchoice('lookahead_planner',
+                                            LOOKAHEAD_PLANNERS, 'c')
+        self.move_queue = move_queue_class(self)
         self.commanded_pos = [0., 0., 0., 0.]
         self.printer.register_event_handler("klippy:shutdown",
                                             self._handle_shutdown)
@@ -239,6 +329,7 @@ class ToolHead:
         self.idle_flush_print_time = 0.
         self.print_stall = 0
         self.drip_completion = None
+        self.last_stats_time = self.last_stats_moves = 0.
         # Kinematic step generation scan window time tracking
         self.kin_flush_delay = SDS_CHECK_TIME
         self.kin_flush_times = []
@@ -246,9 +337,15 @@ class ToolHead:
         # Setup iterative solver
         ffi_main, ffi_lib = chelper.get_ffi()
         self.trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
-        self.trapq_append = ffi_lib.trapq_append
+        self.trapq_append_batch = ffi_lib.trapq_append_batch
         self.trapq_free_moves = ffi_lib.trapq_free_moves
         self.step_generators = []
+        self.stepgen_pool = None
+        stepgen_threads = config.getint('step_generation_threads', 1,
+                                        minval=1)
+        if stepgen_threads > 1:
+            self.stepgen_pool = stepper.StepGenerationPool(stepgen_threads)
+            self.step_generators.append(self.stepgen_pool.generate_steps)
         # Create kinematics class
         self.extruder = kinematics.extruder.DummyExtruder(self.printer)
         kin_name = config.get('kinematics')
@@ -315,20 +412,27 @@ class ToolHead:
             self._calc_print_time()
         # Queue moves into trapezoid motion queue (trapq)
         next_move_time = self.print_time
+        trapq_moves = []
+        extruder_moves = []
         for move in moves:
             if move.is_kinematic_move:
-                self.trapq_append(
-                    self.trapq, next_move_time,
-                    move.accel_t, move.cruise_t, move.decel_t,
-                    move.start_pos[0], move.start_pos[1], move.start_pos[2],
-                    move.axes_r[0], move.axes_r[1], move.axes_r[2],
-                    move.start_v, move.cruise_v, move.accel)
+                start_pos = move.start_pos
+                axes_r = move.axes_r
+                trapq_moves.extend((
+                    next_move_time, move.accel_t, move.cruise_t, move.decel_t,
+                    start_pos[0], start_pos[1], start_pos[2],
+                    axes_r[0], axes_r[1], axes_r[2],
+                    move.start_v, move.cruise_v, move.accel))
             if move.axes_d[3]:
-                self.extruder.move(next_move_time, move)
+                extruder_moves.append((next_move_time, move))
             next_move_time = (next_move_time + move.accel_t
                               + move.cruise_t + move.decel_t)
             for cb in move.timing_callbacks:
                 cb(next_move_time)
+        if trapq_moves:
+            self.trapq_append_batch(self.trapq, trapq_moves, len(trapq_moves))
+        if extruder_moves:
+            self.extruder.process_moves(extruder_moves)
         # Generate steps for moves
         if self.special_queuing_state:
             self._update_drip_move_time(next_move_time)
@@ -419,6 +523,23 @@ class ToolHead:
         self.move_queue.add_move(move)
         if self.print_time > self.need_check_stall:
             self._check_stall()
+    def move_batch(self, moves):
+        # Equivalent to calling move() on each (newpos, speed) in 'moves'
+        commanded_pos = self.commanded_pos
+        check_move = self.kin.check_move
+        add_move = self.move_queue.add_move
+        for newpos, speed in moves:
+            move = Move(self, commanded_pos, newpos, speed)
+            if not move.move_d:
+                continue
+            if move.is_kinematic_move:
+                check_move(move)
+            if move.axes_d[3]:
+                self.extruder.check_move(move)
+            commanded_pos[:] = move.end_pos
+            add_move(move)
+            if self.print_time > self.need_check_stall:
+                self._check_stall()
     def manual_move(self, coord, speed):
         curpos = list(self.commanded_pos)
         for i in range(len(coord)):
@@ -489,8 +610,18 @@ class ToolHead:
         is_active = buffer_time > -60. or not self.special_queuing_state
         if self.special_queuing_state == "Drip":
             buffer_time = 0.
-        return is_active, "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
-            self.print_time, max(buffer_time, 0.), self.print_stall)
+        # Report lookahead throughput since the last stats call
+        total_moves = self.move_queue.total_moves
+        move_rate = 0.
+        if eventtime > self.last_stats_time:
+            move_rate = ((total_moves - self.last_stats_moves)
+                         / (eventtime - self.last_stats_time))
+        self.last_stats_time = eventtime
+        self.last_stats_moves = total_moves
+        return is_active, (
+            "print_time=%.3f buffer_time=%.3f print_stall=%d move_rate=%.1f" % (
+                self.print_time, max(buffer_time, 0.), self.print_stall,
+                move_rate))
     def check_busy(self, eventtime):
         est_print_time = self.mcu.estimated_print_time(eventtime)
         lookahead_empty = not self.move_queue.queue
@@ -516,6 +647,9 @@ class ToolHead:
     def get_trapq(self):
         return self.trapq
     def register_step_generator(self, handler):
+        if (self.stepgen_pool is not None
+            and self.stepgen_pool.add_step_generator(handler)):
+            return
         self.step_generators.append(handler)
     def note_step_generation_scan_time(self, delay, old_delay=0.):
         self.flush_step_generation()
@@ -531,7 +665,10 @@ class ToolHead:
         if last_move is None:
             callback(self.get_last_move_time())
             return
-        last_move.timing_callbacks.append(callback)
+        if last_move.timing_callbacks:
+            last_move.timing_callbacks.append(callback)
+        else:
+            last_move.timing_callbacks = [callback]
     def note_kinematic_activity(self, kin_time):
         self.last_kin_move_time = max(self.last_kin_move_time, kin_time)
     def get_max_velocity(self):
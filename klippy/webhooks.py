@@ -9,8 +9,20 @@ import os
 import sys
 import errno
 import json
+import collections
 import homing
 
+# Maximum amount of data to pass to a single socket send() call
+SEND_CHUNK_SIZE = 64 * 1024
+# Status updates to a client are delayed (and merged) while it has
+# more than this amount of unsent data
+STATUS_BACKLOG_SIZE = 64 * 1024
+# Close client connections that have more than this amount of unsent data
+MAX_SEND_BUFFER = 16 * 1024 * 1024
+
+# Reuse a single encoder (with compact separators) for all messages
+json_encoder = json.JSONEncoder(separators=(',', ':'))
+
 # Json decodes strings as unicode types in Python 2.x.  This doesn't
 # play well with some parts of Klipper (particuarly displays), so we
 # need to create an object hook. This solution borrowed from:
@@ -41,9 +53,12 @@ class Sentinel:
 
 class WebRequest:
     error = WebRequestError
-    def __init__(self, client_conn, request):
+    def __init__(self, client_conn, request, job=None):
         self.client_conn = client_conn
-        base_request = json.loads(request, object_hook=byteify)
+        self.job = job
+        base_request = request
+        if type(base_request) != dict:
+            base_request = json.loads(request, object_hook=byteify)
         if type(base_request) != dict:
             raise ValueError("Not a top-level dictionary")
         self.id = base_request.get('id', None)
@@ -57,6 +72,9 @@ class WebRequest:
     def get_client_connection(self):
         return self.client_conn
 
+    def get_job(self):
+        return self.job
+
     def get(self, item, default=Sentinel, types=None):
         value = self.params.get(item, default)
         if value is Sentinel:
@@ -167,7 +185,9 @@ class ClientConnection:
         self.sock = sock
         self.fd_handle = self.reactor.register_fd(
             self.sock.fileno(), self.process_received)
-        self.partial_data = self.send_buffer = ""
+        self.partial_data = ""
+        self.send_queue = collections.deque()
+        self.send_pending = 0
         self.is_sending_data = False
         self.set_client_info("?", "New connection")
 
@@ -192,11 +212,20 @@ class ClientConnection:
             self.sock.close()
         except socket.error:
             pass
+        self.send_queue.clear()
+        self.send_pending = 0
         self.server.pop_client(self.uid)
+        self.printer.send_event("webhooks:client_disconnect", self)
 
     def is_closed(self):
         return self.fd_handle is None
 
+    def get_pending_bytes(self):
+        return self.send_pending
+
+    def is_backlogged(self):
+        return self.send_pending > STATUS_BACKLOG_SIZE
+
     def process_received(self, eventtime):
         try:
             data = self.sock.recv(4096)
@@ -225,34 +254,53 @@ class ClientConnection:
                 lambda e, s=self, wr=web_request: s._process_request(wr))
 
     def _process_request(self, web_request):
-        try:
-            func = self.webhooks.get_callback(web_request.get_method())
-            func(web_request)
-        except self.printer.command_error as e:
-            web_request.set_error(WebRequestError(e.message))
-        except Exception as e:
-            msg = ("Internal Error on WebRequest: %s"
-                   % (web_request.get_method()))
-            logging.exception(msg)
-            web_request.set_error(WebRequestError(e.message))
-            self.printer.invoke_shutdown(msg)
+        self.webhooks.handle_request(web_request)
         result = web_request.finish()
         if result is None:
             return
         self.send(result)
 
     def send(self, data):
-        self.send_buffer += json.dumps(data) + "\x03"
+        if self.is_closed():
+            return
+        msg = json_encoder.encode(data) + "\x03"
+        self.send_queue.append(msg)
+        self.send_pending += len(msg)
+        if self.send_pending > MAX_SEND_BUFFER:
+            logging.info("webhooks: Client not reading data, closing socket")
+            self.close()
+            return
         if not self.is_sending_data:
             self.is_sending_data = True
             self.reactor.register_callback(self._do_send)
 
     def _do_send(self, eventtime):
         retries = 10
-        while self.send_buffer:
+        delay = .001
+        send_data = None
+        while send_data is not None or self.send_queue:
+            if self.is_closed():
+                # Connection closed while paused (the pending data and
+                # its count were discarded by close())
+                break
+            if send_data is None:
+                # Coalesce pending messages into a single write
+                send_queue = self.send_queue
+                chunks = [send_queue.popleft()]
+                size = len(chunks[0])
+                while send_queue and size < SEND_CHUNK_SIZE:
+                    chunks.append(send_queue.popleft())
+                    size += len(chunks[-1])
+                send_data = memoryview("".join(chunks))
             try:
-                sent = self.sock.send(self.send_buffer)
+                sent = self.sock.send(send_data)
             except socket.error as e:
+                if e.errno == errno.EAGAIN or e.errno == errno.EWOULDBLOCK:
+                    # Wait for the client to read (the amount of
+                    # buffered data is limited in send())
+                    self.reactor.pause(self.reactor.monotonic() + delay)
+                    delay = min(delay * 2., .100)
+                    continue
                 if e.errno == errno.EBADF or e.errno == errno.EPIPE \
                         or not retries:
                     sent = 0
@@ -262,8 +310,12 @@ class ClientConnection:
                     self.reactor.pause(waketime)
                     continue
             retries = 10
+            delay = .001
             if sent > 0:
-                self.send_buffer = self.send_buffer[sent:]
+                self.send_pending -= sent
+                send_data = send_data[sent:]
+                if not len(send_data):
+                    send_data = None
             else:
                 logging.info(
                     "webhooks: Error sending server data,  closing socket")
@@ -275,6 +327,7 @@ class WebHooks:
     def __init__(self, printer):
         self.printer = printer
         self._endpoints = {"list_endpoints": self._handle_list_endpoints}
+        self._mux_endpoints = {}
         self.register_endpoint("info", self._handle_info_request)
         self.register_endpoint("emergency_stop", self._handle_estop_request)
         self.sconn = ServerSocket(self, printer)
@@ -284,6 +337,33 @@ class WebHooks:
             raise WebRequestError("Path already registered to an endpoint")
         self._endpoints[path] = callback
 
+    def register_mux_endpoint(self, path, key, value, callback):
+        prev = self._mux_endpoints.get(path)
+        if prev is None:
+            self.register_endpoint(path, self._handle_mux)
+            self._mux_endpoints[path] = prev = (key, {})
+        prev_key, prev_values = prev
+        if prev_key != key:
+            raise self.printer.config_error(
+                "mux endpoint %s %s %s may have only one key (%s)" % (
+                    path, key, value, prev_key))
+        if value in prev_values:
+            raise self.printer.config_error(
+                "mux endpoint %s %s %s already registered (%s)" % (
+                    path, key, value, prev_values))
+        prev_values[value] = callback
+
+    def _handle_mux(self, web_request):
+        key, values = self._mux_endpoints[web_request.get_method()]
+        if None in values:
+            key_param = web_request.get(key, None)
+        else:
+            key_param = web_request.get(key)
+        if key_param not in values:
+            raise web_request.error("The value '%s' is not valid for %s"
+                                    % (key_param, key))
+        values[key_param](web_request)
+
     def _handle_list_endpoints(self, web_request):
         web_request.send({'endpoints': self._endpoints.keys()})
 
@@ -308,6 +388,19 @@ class WebHooks:
     def get_connection(self):
         return self.sconn
 
+    def handle_request(self, web_request):
+        try:
+            func = self.get_callback(web_request.get_method())
+            func(web_request)
+        except self.printer.command_error as e:
+            web_request.set_error(WebRequestError(e.message))
+        except Exception as e:
+            msg = ("Internal Error on WebRequest: %s"
+                   % (web_request.get_method()))
+            logging.exception(msg)
+            web_request.set_error(WebRequestError(e.message))
+            self.printer.invoke_shutdown(msg)
+
     def get_callback(self, path):
         cb = self._endpoints.get(path, None)
         if cb is None:
@@ -339,7 +432,16 @@ class GCodeHelper:
     def _handle_help(self, web_request):
         web_request.send(self.gcode.get_command_help())
     def _handle_script(self, web_request):
-        self.gcode.run_script(web_request.get_str('script'))
+        script = web_request.get_str('script')
+        job = web_request.get_job()
+        if job is None:
+            self.gcode.run_script(script)
+            return
+        # Report progress and check for cancellation between commands
+        def line_callback(line, total_lines):
+            job.check_cancelled()
+            job.set_progress({'line': line, 'total_lines': total_lines})
+        self.gcode.run_script(script, line_callback=line_callback)
     def _handle_restart(self, web_request):
         self.gcode.run_script('restart')
     def _handle_firmware_restart(self, web_request):
@@ -362,6 +464,17 @@ class GCodeHelper:
 
 SUBSCRIPTION_REFRESH_TIME = .25
 
+class StatusSubscription:
+    def __init__(self, cconn, objects, send_func, template, interval=0.):
+        self.cconn = cconn
+        self.objects = objects
+        self.send_func = send_func
+        self.template = template
+        self.interval = interval
+        self.next_send_time = 0.
+        # Fields that have changed since the last update was sent
+        self.pending = {}
+
 class QueryStatusHelper:
     def __init__(self, printer):
         self.printer = printer
@@ -378,6 +491,26 @@ class QueryStatusHelper:
         objects = [n for n, o in self.printer.lookup_objects()
                    if hasattr(o, 'get_status')]
         web_request.send({'objects': objects})
+    def _query_object(self, obj_name, eventtime, last_result):
+        # Returns the object status, the list of fields that changed
+        # since the last query, and the object's status version
+        po = self.printer.lookup_object(obj_name, None)
+        if po is None or not hasattr(po, 'get_status'):
+            return {}, [], None
+        version = None
+        if hasattr(po, 'get_status_version'):
+            version = po.get_status_version()
+            if last_result is not None and version == last_result[2]:
+                # Object reports that its status is unchanged
+                return last_result[0], [], version
+        res = po.get_status(eventtime)
+        lres = {}
+        if last_result is not None:
+            lres = last_result[0]
+        changed = [k for k, v in res.items() if v != lres.get(k)]
+        changed.extend([k for k, v in lres.items()
+                        if v is not None and k not in res])
+        return res, changed, version
     def _do_query(self, eventtime):
         last_query = self.last_query
         query = self.last_query = {}
@@ -385,38 +518,52 @@ class QueryStatusHelper:
         self.pending_queries = []
         msglist.extend(self.clients.values())
         # Generate get_status() info for each client
-        for cconn, subscription, send_func, template in msglist:
-            is_query = cconn is None
-            if not is_query and cconn.is_closed():
-                del self.clients[cconn]
+        for sub in msglist:
+            is_query = sub.cconn is None
+            if not is_query and sub.cconn.is_closed():
+                del self.clients[sub.cconn]
                 continue
-            # Query each requested printer object
+            # Query each requested printer object (the results and
+            # list of changed fields are shared between all clients)
             cquery = {}
-            for obj_name, req_items in subscription.items():
-                res = query.get(obj_name, None)
-                if res is None:
-                    po = self.printer.lookup_object(obj_name, None)
-                    if po is None or not hasattr(po, 'get_status'):
-                        res = query[obj_name] = {}
-                    else:
-                        res = query[obj_name] = po.get_status(eventtime)
+            pending = sub.pending
+            for obj_name, req_items in sub.objects.items():
+                qres = query.get(obj_name, None)
+                if qres is None:
+                    qres = query[obj_name] = self._query_object(
+                        obj_name, eventtime, last_query.get(obj_name))
+                res, changed, version = qres
                 if req_items is None:
                     req_items = list(res.keys())
                     if req_items:
-                        subscription[obj_name] = req_items
-                lres = last_query.get(obj_name, {})
-                cres = {}
-                for ri in req_items:
-                    rd = res.get(ri, None)
-                    if is_query or rd != lres.get(ri):
-                        cres[ri] = rd
-                if cres or is_query:
-                    cquery[obj_name] = cres
+                        sub.objects[obj_name] = req_items
+                if is_query:
+                    cquery[obj_name] = {ri: res.get(ri) for ri in req_items}
+                elif changed:
+                    pending.setdefault(obj_name, set()).update(changed)
+            if not is_query:
+                if (not pending or eventtime < sub.next_send_time
+                    or sub.cconn.is_backlogged()):
+                    # Changes are merged into a later update
+                    continue
+                # Send the current value of each changed field
+                for obj_name, changed in pending.items():
+                    req_items = sub.objects.get(obj_name)
+                    if not req_items or obj_name not in query:
+                        continue
+                    res = query[obj_name][0]
+                    cres = {ri: res.get(ri) for ri in req_items
+                            if ri in changed}
+                    if cres:
+                        cquery[obj_name] = cres
+                pending.clear()
+                sub.next_send_time = eventtime + sub.interval
+                if not cquery:
+                    continue
             # Send data
-            if cquery or is_query:
-                tmp = dict(template)
-                tmp['params'] = {'eventtime': eventtime, 'status': cquery}
-                send_func(tmp)
+            tmp = dict(sub.template)
+            tmp['params'] = {'eventtime': eventtime, 'status': cquery}
+            sub.send_func(tmp)
         if not query:
             # Unregister timer if there are no longer any subscriptions
             reactor = self.printer.get_reactor()
@@ -437,11 +584,13 @@ class QueryStatusHelper:
         # Add to pending queries
         cconn = web_request.get_client_connection()
         template = web_request.get_dict('response_template', {})
+        interval = web_request.get_float('interval', 0.)
         if is_subscribe and cconn in self.clients:
             del self.clients[cconn]
         reactor = self.printer.get_reactor()
         complete = reactor.completion()
-        self.pending_queries.append((None, objects, complete.complete, {}))
+        self.pending_queries.append(StatusSubscription(
+            None, objects, complete.complete, {}))
         # Start timer if needed
         if self.query_timer is None:
             qt = reactor.register_timer(self._do_query, reactor.NOW)
@@ -450,11 +599,148 @@ class QueryStatusHelper:
         msg = complete.wait()
         web_request.send(msg['params'])
         if is_subscribe:
-            self.clients[cconn] = (cconn, objects, cconn.send, template)
+            self.clients[cconn] = StatusSubscription(
+                cconn, objects, cconn.send, template, interval)
     def _handle_subscribe(self, web_request):
         self._handle_query(web_request, is_subscribe=True)
 
+# Maximum number of jobs of a client that may run at the same time
+MAX_CLIENT_JOBS = 2
+# Number of completed jobs that are reported by jobs/list
+MAX_FINISHED_JOBS = 32
+# Minimum time between job progress notifications
+JOB_PROGRESS_TIME = 1.
+
+class WebJob:
+    def __init__(self, helper, job_id, cconn, request, template):
+        self.helper = helper
+        self.job_id = job_id
+        self.cconn = cconn
+        self.template = template
+        self.web_request = WebRequest(cconn, request, job=self)
+        self.state = 'queued'
+        self.progress = None
+        self.cancel_requested = False
+        self.submit_time = helper.reactor.monotonic()
+        self.start_time = self.end_time = None
+        self.last_notify_time = 0.
+    def is_cancelled(self):
+        return self.cancel_requested or self.cconn.is_closed()
+    def check_cancelled(self):
+        if self.is_cancelled():
+            raise self.web_request.error("Job %d cancelled" % (self.job_id,))
+    def set_progress(self, progress):
+        self.progress = progress
+        eventtime = self.helper.reactor.monotonic()
+        if eventtime >= self.last_notify_time + JOB_PROGRESS_TIME:
+            self.notify()
+    def notify(self, result=None):
+        self.last_notify_time = self.helper.reactor.monotonic()
+        params = self.get_info()
+        if result is not None:
+            params.update(result)
+        tmp = dict(self.template)
+        tmp['params'] = params
+        self.cconn.send(tmp)
+    def get_info(self):
+        eventtime = self.helper.reactor.monotonic()
+        info = {'job_id': self.job_id, 'method': self.web_request.get_method(),
+                'client': self.cconn.uid, 'state': self.state,
+                'progress': self.progress, 'queued_time': 0., 'run_time': 0.}
+        if self.start_time is None:
+            end_time = self.end_time or eventtime
+            info['queued_time'] = end_time - self.submit_time
+        else:
+            info['queued_time'] = self.start_time - self.submit_time
+            info['run_time'] = (self.end_time or eventtime) - self.start_time
+        return info
+
+class JobHelper:
+    def __init__(self, printer):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.webhooks = printer.lookup_object('webhooks')
+        self.next_job_id = 1
+        self.jobs = collections.OrderedDict()
+        self.finished_jobs = collections.deque()
+        # Register webhooks
+        self.webhooks.register_endpoint("jobs/submit", self._handle_submit)
+        self.webhooks.register_endpoint("jobs/list", self._handle_list)
+        self.webhooks.register_endpoint("jobs/cancel", self._handle_cancel)
+        printer.register_event_handler("webhooks:client_disconnect",
+                                       self._handle_client_disconnect)
+    def _handle_client_disconnect(self, cconn):
+        for job in list(self.jobs.values()):
+            if job.cconn is cconn and job.state == 'queued':
+                self._finish_job(job, 'cancelled')
+    def _start_jobs(self, cconn):
+        client_jobs = [j for j in self.jobs.values() if j.cconn is cconn]
+        running = len([j for j in client_jobs if j.state == 'running'])
+        for job in client_jobs:
+            if running >= MAX_CLIENT_JOBS:
+                break
+            if job.state != 'queued':
+                continue
+            if job.is_cancelled():
+                self._finish_job(job, 'cancelled')
+                continue
+            job.state = 'running'
+            running += 1
+            self.reactor.register_callback(
+                lambda e, s=self, j=job: s._run_job(j))
+    def _run_job(self, job):
+        job.start_time = self.reactor.monotonic()
+        job.notify()
+        web_request = job.web_request
+        self.webhooks.handle_request(web_request)
+        result = web_request.finish()
+        state = 'complete'
+        if 'error' in result:
+            state = 'error'
+            if job.is_cancelled():
+                state = 'cancelled'
+        self._finish_job(job, state, result)
+        self._start_jobs(job.cconn)
+    def _finish_job(self, job, state, result=None):
+        job.state = state
+        job.end_time = self.reactor.monotonic()
+        if result is not None:
+            del result['id']
+        job.notify(result)
+        del self.jobs[job.job_id]
+        self.finished_jobs.append(job)
+        while len(self.finished_jobs) > MAX_FINISHED_JOBS:
+            self.finished_jobs.popleft()
+    def _handle_submit(self, web_request):
+        cconn = web_request.get_client_connection()
+        method = web_request.get_str('method')
+        params = web_request.get_dict('params', {})
+        template = web_request.get_dict('response_template', {})
+        if method.startswith('jobs/'):
+            raise web_request.error("Invalid job method")
+        self.webhooks.get_callback(method)
+        job_id = self.next_job_id
+        self.next_job_id += 1
+        request = {'id': job_id, 'method': method, 'params': params}
+        job = self.jobs[job_id] = WebJob(self, job_id, cconn, request,
+                                         template)
+        web_request.send(job.get_info())
+        self._start_jobs(cconn)
+    def _handle_list(self, web_request):
+        jobs = list(self.finished_jobs) + list(self.jobs.values())
+        web_request.send({'jobs': [j.get_info() for j in jobs]})
+    def _handle_cancel(self, web_request):
+        job_id = web_request.get_int('job_id')
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise web_request.error("Unknown job %d" % (job_id,))
+        job.cancel_requested = True
+        if job.state == 'queued':
+            self._finish_job(job, 'cancelled')
+        web_request.send(job.get_info())
+
 def add_early_printer_objects(printer):
     printer.add_object('webhooks', WebHooks(printer))
     GCodeHelper(printer)
     QueryStatusHelper(printer)
+    JobHelper(printer)
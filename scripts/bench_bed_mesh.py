@@ -0,0 +1,198 @@
+#!/usr/bin/env python2
+# Benchmark the bed_mesh interpolation and z-adjustment lookups
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, math, random
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+from extras import bed_mesh
+
+
+######################################################################
+# Mesh generation
+######################################################################
+
+class DummyConfig:
+    def __init__(self, options):
+        self.options = options
+    def getfloat(self, option, default, **kw):
+        return self.options.get(option, default)
+
+def make_params(probe_count, pps, algo):
+    return {'min_x': 10., 'max_x': 290., 'min_y': 10., 'max_y': 290.,
+            'x_count': probe_count, 'y_count': probe_count,
+            'mesh_x_pps': pps, 'mesh_y_pps': pps, 'algo': algo,
+            'tension': .2}
+
+# Generate a warped bed with some probe noise
+def make_probed_matrix(probe_count, warp=1.):
+    out = []
+    for j in range(probe_count):
+        y = float(j) / (probe_count - 1)
+        out.append([warp * (.2 * math.sin(3. * x / (probe_count - 1) + 2. * y)
+                            - .1 * y) + random.uniform(-.01, .01)
+                    for x in range(probe_count)])
+    return out
+
+def build_mesh(params, probed_matrix, sample_name=None):
+    z_mesh = bed_mesh.ZMesh(params)
+    if sample_name is not None:
+        z_mesh._sample = getattr(z_mesh, sample_name)
+    z_mesh.build_mesh(probed_matrix)
+    return z_mesh
+
+# The original per point lookup (for comparison with ZMesh.calc_z)
+def reference_calc_z(z_mesh, x, y):
+    tbl = z_mesh.mesh_matrix
+    def get_linear_index(coord, mesh_min, mesh_cnt, mesh_dist):
+        idx = int(math.floor((coord - mesh_min) / mesh_dist))
+        idx = bed_mesh.constrain(idx, 0, mesh_cnt - 2)
+        t = (coord - (mesh_min + mesh_dist * idx)) / mesh_dist
+        return bed_mesh.constrain(t, 0., 1.), idx
+    tx, xidx = get_linear_index(x, z_mesh.mesh_x_min, z_mesh.mesh_x_count,
+                                z_mesh.mesh_x_dist)
+    ty, yidx = get_linear_index(y, z_mesh.mesh_y_min, z_mesh.mesh_y_count,
+                                z_mesh.mesh_y_dist)
+    z0 = bed_mesh.lerp(tx, tbl[yidx][xidx], tbl[yidx][xidx+1])
+    z1 = bed_mesh.lerp(tx, tbl[yidx+1][xidx], tbl[yidx+1][xidx+1])
+    return bed_mesh.lerp(ty, z0, z1)
+
+
+######################################################################
+# Benchmarks
+######################################################################
+
+def best_time(repeat, func, *args):
+    best = None
+    for i in range(repeat):
+        start_time = time.time()
+        res = func(*args)
+        run_time = time.time() - start_time
+        if best is None or run_time < best:
+            best = run_time
+    return best, res
+
+def bench_upsample(options, probed_matrix):
+    errors = 0
+    for algo in ['lagrange', 'bicubic']:
+        params = make_params(options.probe_count, options.pps, algo)
+        samplers = ['_sample_' + algo]
+        if bed_mesh.numpy is not None:
+            samplers.append('_sample_%s_numpy' % (algo,))
+        results = []
+        for name in samplers:
+            run_time, z_mesh = best_time(options.repeat, build_mesh, params,
+                                         probed_matrix, name)
+            results.append(z_mesh.mesh_matrix)
+            sys.stdout.write("upsample %-24s mesh=%dx%d time=%.6fs\n" % (
+                name, z_mesh.mesh_x_count, z_mesh.mesh_y_count, run_time))
+        if results[1:] and results[0] != results[1]:
+            sys.stdout.write("Upsampled %s meshes differ\n" % (algo,))
+            errors += 1
+    return errors
+
+def bench_lookup(options, z_mesh):
+    xs = [random.uniform(0., 300.) for i in range(options.count)]
+    ys = [random.uniform(0., 300.) for i in range(options.count)]
+    points = list(zip(xs, ys))
+    tests = [
+        ('reference', lambda: [reference_calc_z(z_mesh, x, y)
+                               for x, y in points]),
+        ('calc_z', lambda: [z_mesh.calc_z(x, y) for x, y in points]),
+    ]
+    results = []
+    for name, func in tests:
+        run_time, res = best_time(options.repeat, func)
+        results.append(res)
+        sys.stdout.write("lookup   %-24s points=%d time=%.6fs"
+                         " points/sec=%.0f\n" % (
+                             name, len(points), run_time,
+                             len(points) / run_time))
+    max_diff = max([max([abs(a - b) for a, b in zip(results[0], res)])
+                    for res in results[1:]])
+    sys.stdout.write("Maximum lookup difference: %.3g\n" % (max_diff,))
+    return max_diff > 1e-9
+
+def split_moves(splitter, moves):
+    out = []
+    last_pos = moves[0]
+    for pos in moves[1:]:
+        splitter.build_move(last_pos, pos, 1.)
+        while not splitter.traverse_complete:
+            out.append(tuple(splitter.split()))
+        last_pos = pos
+    return out
+
+# Split the moves while counting the mesh lookups
+def count_lookups(splitter, z_mesh, moves):
+    lookups = [0]
+    orig_calc_z = z_mesh.calc_z
+    def calc_z(x, y):
+        lookups[0] += 1
+        return orig_calc_z(x, y)
+    z_mesh.calc_z = calc_z
+    try:
+        return split_moves(splitter, moves), lookups[0]
+    finally:
+        del z_mesh.calc_z
+
+def bench_splitter(options, z_mesh):
+    config = DummyConfig({})
+    splitter = bed_mesh.MoveSplitter(config, None)
+    splitter.initialize(z_mesh)
+    moves = [[random.uniform(10., 290.), random.uniform(10., 290.), .2, 0.]
+             for i in range(options.count // 50)]
+    run_time, res = best_time(options.repeat, split_moves, splitter, moves)
+    res, lookups = count_lookups(splitter, z_mesh, moves)
+    # Check all points (without skipping flat parts of the mesh)
+    z_mesh.check_z_bounds = lambda *args: False
+    ref_res, ref_lookups = count_lookups(splitter, z_mesh, moves)
+    del z_mesh.check_z_bounds
+    sys.stdout.write("splitter moves=%d toolhead_moves=%d lookups=%d"
+                     " (%d without skipping) time=%.6fs moves/sec=%.0f\n" % (
+                         len(moves) - 1, len(res), lookups, ref_lookups,
+                         run_time, (len(moves) - 1) / run_time))
+    if res != ref_res:
+        sys.stdout.write("Split moves differ from checking all points\n")
+        return 1
+    return 0
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-p", "--probe-count", dest="probe_count", type="int",
+                    default=15, help="number of probe points on each axis")
+    opts.add_option("-i", "--pps", dest="pps", type="int", default=6,
+                    help="interpolated points per segment")
+    opts.add_option("-n", "--count", dest="count", type="int",
+                    default=100000, help="number of lookups")
+    opts.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                    help="number of runs of each benchmark")
+    opts.add_option("-s", "--seed", dest="seed", type="int", default=0,
+                    help="random number generator seed")
+    opts.add_option("-w", "--warp", dest="warp", type="float", default=1.,
+                    help="scale of the generated bed warp")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    random.seed(options.seed)
+    if bed_mesh.numpy is None:
+        sys.stdout.write("NumPy not available - using python upsampling\n")
+
+    probed_matrix = make_probed_matrix(options.probe_count, options.warp)
+    errors = bench_upsample(options, probed_matrix)
+    z_mesh = build_mesh(make_params(options.probe_count, options.pps,
+                                    'bicubic'), probed_matrix)
+    errors += bench_lookup(options, z_mesh)
+    errors += bench_splitter(options, z_mesh)
+    if errors:
+        sys.exit(-1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python2
+# Compare the solvers available for delta calibration
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, math, random, logging
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import mathutil
+from kinematics import delta
+from extras import delta_calibrate
+
+
+######################################################################
+# Simulated calibration data
+######################################################################
+
+def make_calibration(radius, angles, arms, endstops):
+    return delta.DeltaCalibration(radius, angles, arms, endstops,
+                                  [.0125] * 3)
+
+# Generate a delta printer with errors in its configured parameters
+def make_printers(options):
+    actual = make_calibration(
+        140. + random.uniform(-1., 1.),
+        [210. + random.uniform(-.5, .5), 330. + random.uniform(-.5, .5),
+         90.], [300. + random.uniform(-.5, .5) for i in range(3)],
+        [300. + random.uniform(-1., 1.) for i in range(3)])
+    configured = make_calibration(140., [210., 330., 90.], [300.] * 3,
+                                  [300.] * 3)
+    return actual, configured
+
+# Generate the probe points of a DELTA_CALIBRATE run (and optionally
+# the measurements of the calibration object for DELTA_ANALYZE)
+def make_measurements(options, actual, configured):
+    radius = 100.
+    points = [(0., 0.)]
+    for i in range(options.points - 1):
+        r = math.radians(90. + 360. * i / (options.points - 1))
+        dist = radius * (.5 + .45 * (i % 2))
+        points.append((math.cos(r) * dist, math.sin(r) * dist))
+    height_positions = [(0., actual.calc_stable_position((x, y, 0.)))
+                        for x, y in points]
+    distances = []
+    if options.extended:
+        # Measure the calibration object as printed by the actual printer
+        measured = delta_calibrate.measurements_to_distances(
+            {'SCALE': [1.], 'CENTER_DISTS': [74.] * 6,
+             'CENTER_PILLAR_WIDTHS': [9.] * 3, 'OUTER_DISTS': [74.] * 6,
+             'OUTER_PILLAR_WIDTHS': [9.] * 6}, configured)
+        getpos = actual.get_position_from_stable
+        for dist, spos1, spos2 in measured:
+            d = math.sqrt(sum([(a - b)**2 for a, b in zip(getpos(spos1),
+                                                          getpos(spos2))]))
+            distances.append((d, spos1, spos2))
+    return height_positions, distances
+
+
+######################################################################
+# Solver comparison
+######################################################################
+
+def compare_solvers(options, actual, configured):
+    height_positions, distances = make_measurements(options, actual,
+                                                    configured)
+    adj_params, params = configured.coordinate_descent_params(
+        options.extended)
+    z_weight = 1.
+    if distances:
+        z_weight = len(distances) / (delta_calibrate.MEASURE_WEIGHT
+                                     * len(height_positions))
+    residual_func = delta_calibrate.make_residual_func(
+        configured, height_positions, distances, z_weight)
+    for solver in sorted(mathutil.SOLVERS):
+        new_params, best_err, rounds, run_time = mathutil.solve(
+            solver, adj_params, params, residual_func)
+        new_delta = configured.new_calibration(new_params)
+        max_height = max([abs(new_delta.get_position_from_stable(spos)[2])
+                          for z, spos in height_positions])
+        sys.stdout.write("%-20s rounds=%-5d time=%.3fs error=%.3g"
+                         " max_height_error=%.6f\n" % (
+                             solver, rounds, run_time, best_err, max_height))
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-p", "--points", dest="points", type="int", default=7,
+                    help="number of probe points")
+    opts.add_option("-e", "--extended", action="store_true",
+                    dest="extended", help="include calibration object"
+                    " measurements (DELTA_ANALYZE)")
+    opts.add_option("-s", "--seed", dest="seed", type="int", default=0,
+                    help="random number generator seed")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(options.seed)
+    actual, configured = make_printers(options)
+    compare_solvers(options, actual, configured)
+
+if __name__ == '__main__':
+    main()
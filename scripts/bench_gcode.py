@@ -0,0 +1,117 @@
+#!/usr/bin/env python2
+# Benchmark the host g-code command parsing and dispatch
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, re
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import reactor, gcode
+
+BATCH_LINES = 20
+
+
+######################################################################
+# Dispatch of g-code without a printer
+######################################################################
+
+class DummyPrinter:
+    def __init__(self):
+        self.reactor = reactor.Reactor()
+    def get_start_args(self):
+        return {}
+    def get_reactor(self):
+        return self.reactor
+    def register_event_handler(self, event, callback):
+        pass
+    def send_event(self, event, *params):
+        pass
+
+# Handlers that read the parameters in the same way as gcode_move.py
+class MoveHandlers:
+    def __init__(self, gcode):
+        self.count = 0
+        for cmd in ['G0', 'G1']:
+            gcode.register_command(cmd, self.cmd_G1)
+        gcode.register_command('G92', self.cmd_G92)
+        gcode.cmd_default = self.cmd_default
+    def cmd_G1(self, gcmd):
+        params = gcmd.get_float_parameters()
+        if params is None:
+            params = gcmd.get_command_parameters()
+        for axis in 'XYZEF':
+            if axis in params:
+                float(params[axis])
+        self.count += 1
+    def cmd_G92(self, gcmd):
+        [gcmd.get_float(a, None) for a in 'XYZE']
+        self.count += 1
+    def cmd_default(self, gcmd):
+        gcmd.get_command()
+        self.count += 1
+
+def dispatch_lines(lines, fast_path):
+    gd = gcode.GCodeDispatch(DummyPrinter())
+    if not fast_path:
+        # Force every line through the original parsing code
+        gd.traditional_r = re.compile('(?!)')
+    handlers = MoveHandlers(gd)
+    gd._handle_ready()
+    start_time = time.time()
+    for i in range(0, len(lines), BATCH_LINES):
+        gd._process_commands(lines[i:i+BATCH_LINES], need_ack=False)
+    return time.time() - start_time, handlers.count
+
+# Verify that both parsers produce the same command and values
+def check_lines(lines):
+    errors = 0
+    gd = gcode.GCodeDispatch(DummyPrinter())
+    for line in lines:
+        line = line.strip()
+        m = gd.traditional_r.match(line)
+        if m is None:
+            continue
+        words, cmd = m.groups()
+        fparams = { k: float(v) for k, v in gd.word_r.findall(words) }
+        orig_cmd, params = gcode.parse_traditional(line)
+        orig_fparams = { k: float(v) for k, v in params.items() }
+        if cmd != orig_cmd or fparams != orig_fparams:
+            sys.stdout.write("Mismatch on '%s'\n" % (line,))
+            errors += 1
+    return errors
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options] <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                    help="number of runs of each parser")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    f = open(args[0], 'rb')
+    lines = f.read().split('\n')
+    f.close()
+
+    gd = gcode.GCodeDispatch(DummyPrinter())
+    fast_lines = len([l for l in lines
+                      if gd.traditional_r.match(l.strip()) is not None])
+    sys.stdout.write("Read %d lines (%.1f%% on fast path)\n" % (
+        len(lines), 100. * fast_lines / max(len(lines), 1)))
+    if check_lines(lines):
+        sys.stdout.write("Fast path results differ from regular parser\n")
+        sys.exit(-1)
+    # Run each parser (report the fastest run)
+    for name, fast_path in [('regular', False), ('fast', True)]:
+        results = [dispatch_lines(lines, fast_path)
+                   for i in range(options.repeat)]
+        run_time, count = min(results)
+        sys.stdout.write("%-8s lines=%d time=%.3fs lines/sec=%.0f\n" % (
+            name, count, run_time, count / run_time))
+
+if __name__ == '__main__':
+    main()
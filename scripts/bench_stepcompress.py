@@ -0,0 +1,71 @@
+#!/usr/bin/env python2
+# Benchmark host step compression on recorded moves
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, logging, tempfile
+import bench_stepgen
+
+
+######################################################################
+# Step compression benchmark
+######################################################################
+
+# Generate and compress the steps of cartesian x, y, and z steppers
+def run_compressor(moves, mp, step_dist, max_error):
+    sk_list = [bench_stepgen.alloc_sk('cartesian_stepper_alloc', a)
+               for a in 'xyz']
+    return bench_stepgen.replay_moves(mp, moves, sk_list, step_dist,
+                                      max_error=max_error)
+
+def report(res):
+    steps = max(res['steps'], 1)
+    sys.stdout.write(
+        "steps=%d queue_step=%d msgs/step=%.5f bytes=%d bytes/step=%.4f"
+        " ns/step=%.1f sync_ns/step=%.1f\n" % (
+            res['steps'], res['msgs'], float(res['msgs']) / steps,
+            res['bytes'], float(res['bytes']) / steps,
+            res['time'] * 1000000000. / steps,
+            res['sync_time'] * 1000000000. / steps))
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options] <config file> <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-d", "--dictionary", dest="dictionary",
+                    help="file to read for mcu protocol dictionary")
+    opts.add_option("-s", "--step-distance", dest="step_dist", type="float",
+                    default=0.0025, help="step distance of replayed steppers")
+    opts.add_option("-e", "--max-error", dest="max_error", type="float",
+                    default=0.000025, help="maximum step time error")
+    opts.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                    help="number of runs (the fastest is reported)")
+    options, args = opts.parse_args()
+    if len(args) != 2 or options.dictionary is None:
+        opts.error("Incorrect number of arguments")
+    logging.basicConfig(level=logging.WARNING)
+
+    # Record the toolhead moves of the G-code file
+    out_fd, out_fname = tempfile.mkstemp(prefix="bench_stepcompress_")
+    os.close(out_fd)
+    moves, extruder_moves = bench_stepgen.record_moves(
+        args[0], args[1], options.dictionary, out_fname)
+    os.unlink(out_fname)
+    if not moves:
+        opts.error("No moves found in G-code file")
+    sys.stdout.write("Recorded %d moves\n" % (
+        len(moves) // bench_stepgen.TRAPQ_APPEND_PARAMS,))
+    mp = bench_stepgen.load_dictionary(options.dictionary)
+
+    # Replay the moves (report the fastest run)
+    results = [run_compressor(moves, mp, options.step_dist, options.max_error)
+               for i in range(options.repeat)]
+    report(min(results, key=(lambda r: r['time'])))
+
+if __name__ == '__main__':
+    main()
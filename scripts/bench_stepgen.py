@@ -0,0 +1,357 @@
+#!/usr/bin/env python2
+# Benchmark host step generation by replaying the moves of a G-code file
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, logging, tempfile, math, array, cPickle
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import chelper, msgproto, reactor, klippy
+
+TRAPQ_APPEND_PARAMS = 13
+FLUSH_TIME = 0.100
+MOVE_COUNT = 500
+MAX_ERROR = 0.000025
+NEVER = 9999999999999999.
+SEGMENT_DELAY = 2.
+
+
+######################################################################
+# Move recording
+######################################################################
+
+# Wrap the trapq_append_batch() helper of a printer object so that all
+# moves added to its trapq are also stored in 'moves'
+def record_trapq(obj, moves):
+    orig_append_batch = obj.trapq_append_batch
+    def trapq_append_batch(tq, data, count):
+        moves.extend(data[:count])
+        orig_append_batch(tq, data, count)
+    obj.trapq_append_batch = trapq_append_batch
+
+# Run a G-code file through klippy (in batch mode) and record the moves
+# of the toolhead and extruder.  Returns the recorded moves and the
+# klippy output (which is written to 'out_fname').
+def record_moves(config_fname, gcode_fname, dict_fname, out_fname):
+    toolhead_moves = array.array('d')
+    extruder_moves = array.array('d')
+    def handle_connect():
+        record_trapq(printer.lookup_object('toolhead'), toolhead_moves)
+        extruder = printer.lookup_object('extruder', None)
+        if extruder is not None:
+            record_trapq(extruder, extruder_moves)
+    gcode_file = open(gcode_fname, 'rb')
+    start_args = {'config_file': config_fname, 'apiserver': None,
+                  'start_reason': 'startup', 'debuginput': gcode_fname,
+                  'gcode_fd': gcode_file.fileno(), 'debugoutput': out_fname,
+                  'dictionary': dict_fname, 'software_version': '?',
+                  'cpu_info': '?'}
+    main_reactor = reactor.Reactor()
+    printer = klippy.Printer(main_reactor, None, start_args)
+    printer.register_event_handler("klippy:connect", handle_connect)
+    res = printer.run()
+    main_reactor.finalize()
+    gcode_file.close()
+    if res != 'exit':
+        raise Exception("Error while recording moves (%s)" % (res,))
+    return toolhead_moves, extruder_moves
+
+# Find the moves where the position was reset (for example, during
+# homing) as the replayed steppers must also be reset.  Returns a list
+# of (move_index, print_time, start_pos) and the end time of the moves.
+def find_position_changes(moves, num_axes=3):
+    positions = []
+    last_pos = None
+    end_time = 0.
+    for i in range(0, len(moves), TRAPQ_APPEND_PARAMS):
+        (print_time, accel_t, cruise_t, decel_t, start_x, start_y, start_z,
+         axes_r_x, axes_r_y, axes_r_z, start_v, cruise_v,
+         accel) = moves[i:i+TRAPQ_APPEND_PARAMS]
+        start_pos = (start_x, start_y, start_z)
+        if last_pos is None or max([abs(p - lp) for p, lp in zip(
+                start_pos[:num_axes], last_pos[:num_axes])]) > .000001:
+            positions.append((i, print_time, start_pos))
+        move_d = (accel_t * (start_v + .5 * accel * accel_t)
+                  + cruise_t * cruise_v
+                  + decel_t * (cruise_v - .5 * accel * decel_t))
+        last_pos = [p + r * move_d
+                    for p, r in zip(start_pos, (axes_r_x, axes_r_y, axes_r_z))]
+        end_time = max(end_time, print_time + accel_t + cruise_t + decel_t)
+    return positions, end_time
+
+# Return the minimum and maximum x and y positions of the moves
+def find_xy_bounds(moves):
+    xs = [moves[i] for i in range(4, len(moves), TRAPQ_APPEND_PARAMS)]
+    ys = [moves[i] for i in range(5, len(moves), TRAPQ_APPEND_PARAMS)]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+######################################################################
+# Step generation replay
+######################################################################
+
+def load_dictionary(dict_fname):
+    f = open(dict_fname, 'rb')
+    mp = msgproto.MessageParser()
+    mp.process_identify(f.read(), decompress=False)
+    f.close()
+    return mp
+
+# Count the queue_step messages (and their steps) in a klippy output file
+def count_messages(mp, data_fname):
+    f = open(data_fname, 'rb')
+    data = f.read()
+    f.close()
+    msgs = steps = 0
+    while data:
+        l = mp.check_packet(data)
+        if l <= 0:
+            break
+        for msg in mp.dump(bytearray(data[:l]))[1:]:
+            if msg.startswith('queue_step '):
+                msgs += 1
+                steps += int(msg.split('count=')[1].split()[0])
+        data = data[l:]
+    if data:
+        logging.warning("Unable to decode %d bytes of output", len(data))
+    return msgs, steps
+
+# Generate and compress the steps of the given stepper kinematics for
+# all the recorded moves.  The queue_step messages are written to a
+# temporary file (as klippy does in batch mode).
+def replay_moves(mp, moves, sk_list, step_dist, num_axes=3,
+                 max_error=MAX_ERROR):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    mcu_freq = mp.get_constant_float('CLOCK_FREQ')
+    step_cmd_id = mp.lookup_command(
+        "queue_step oid=%c interval=%u count=%hu add=%hi").msgid
+    dir_cmd_id = mp.lookup_command("set_next_step_dir oid=%c dir=%c").msgid
+    trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
+    positions, end_time = find_position_changes(moves, num_axes)
+    # Setup step compression
+    sc_list = []
+    for oid, sk in enumerate(sk_list):
+        sc = ffi_main.gc(ffi_lib.stepcompress_alloc(oid),
+                         ffi_lib.stepcompress_free)
+        ffi_lib.stepcompress_fill(sc, int(max_error * mcu_freq), 0,
+                                  step_cmd_id, dir_cmd_id)
+        ffi_lib.itersolve_set_stepcompress(sk, sc, step_dist)
+        ffi_lib.itersolve_set_trapq(sk, trapq)
+        sc_list.append(sc)
+    out_fd, out_fname = tempfile.mkstemp(prefix="bench_stepgen_")
+    sq = ffi_lib.serialqueue_alloc(out_fd, 1)
+    ffi_lib.serialqueue_set_clock_est(sq, 1000000000000.,
+                                      ffi_lib.get_monotonic(), 0)
+    ss = ffi_main.gc(ffi_lib.steppersync_alloc(sq, sc_list, len(sc_list),
+                                               MOVE_COUNT),
+                     ffi_lib.steppersync_free)
+    ffi_lib.steppersync_set_time(ss, 0., mcu_freq)
+    # Generate steps.  The trapq is cleared on each position change (as
+    # is done by toolhead.set_position()) and the moves after it are
+    # delayed so that kinematics that look at the position before or
+    # after a move (such as the input shaper) only see a null move.
+    gen_time = sync_time = 0.
+    flush_time = 0.
+    next_positions = positions[1:] + [(len(moves), end_time, None)]
+    for i, ((index, start_time, pos), (next_index, next_time, p)) in enumerate(
+            zip(positions, next_positions)):
+        delay = (i + 1) * SEGMENT_DELAY
+        segment = list(moves[index:next_index])
+        for j in range(0, len(segment), TRAPQ_APPEND_PARAMS):
+            segment[j] += delay
+        ffi_lib.trapq_free_moves(trapq, NEVER)
+        ffi_lib.trapq_append_batch(trapq, segment, len(segment))
+        for sk in sk_list:
+            ffi_lib.itersolve_set_position(sk, *pos)
+        segment_end_time = next_time + delay + .5 * SEGMENT_DELAY
+        while flush_time < segment_end_time:
+            flush_time = min(flush_time + FLUSH_TIME, segment_end_time)
+            gen_start_time = ffi_lib.get_monotonic()
+            for sk in sk_list:
+                ret = ffi_lib.itersolve_generate_steps(sk, flush_time)
+                if ret:
+                    raise Exception("Internal error in stepcompress")
+            sync_start_time = ffi_lib.get_monotonic()
+            ret = ffi_lib.steppersync_flush(ss, int(flush_time * mcu_freq))
+            if ret:
+                raise Exception("Internal error in stepcompress")
+            sync_end_time = ffi_lib.get_monotonic()
+            gen_time += sync_end_time - gen_start_time
+            sync_time += sync_end_time - sync_start_time
+    for sc in sc_list:
+        ffi_lib.stepcompress_reset(sc, 0)
+    ffi_lib.steppersync_flush(ss, 0xffffffffffffffff)
+    # Collect results
+    ffi_lib.serialqueue_exit(sq)
+    stats = ffi_main.new('char[4096]')
+    ffi_lib.serialqueue_get_stats(sq, stats, len(stats))
+    stats = dict([s.split('=', 1) for s in ffi_main.string(stats).split()])
+    ffi_lib.serialqueue_free(sq)
+    os.close(out_fd)
+    msgs, steps = count_messages(mp, out_fname)
+    os.unlink(out_fname)
+    return {'moves': len(moves) // TRAPQ_APPEND_PARAMS, 'steps': steps,
+            'msgs': msgs, 'bytes': int(stats['bytes_write']),
+            'time': gen_time, 'sync_time': sync_time}
+
+
+######################################################################
+# Benchmark stages
+######################################################################
+
+def alloc_sk(alloc_func, *params):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    return ffi_main.gc(getattr(ffi_lib, alloc_func)(*params), ffi_lib.free)
+
+def stage_cartesian(mp, moves, extruder_moves, options):
+    sk_list = [alloc_sk('cartesian_stepper_alloc', a) for a in 'xyz']
+    return replay_moves(mp, moves, sk_list, options.step_dist)
+
+def stage_corexy(mp, moves, extruder_moves, options):
+    sk_list = [alloc_sk('corexy_stepper_alloc', '+'),
+               alloc_sk('corexy_stepper_alloc', '-'),
+               alloc_sk('cartesian_stepper_alloc', 'z')]
+    return replay_moves(mp, moves, sk_list, options.step_dist)
+
+def stage_delta(mp, moves, extruder_moves, options):
+    # Size the delta towers so that all recorded moves are reachable
+    min_x, min_y, max_x, max_y = find_xy_bounds(moves)
+    center_x, center_y = .5 * (min_x + max_x), .5 * (min_y + max_y)
+    radius = max(.5 * math.hypot(max_x - min_x, max_y - min_y), 10.)
+    arm2 = (3. * radius)**2
+    sk_list = []
+    for angle in [210., 330., 90.]:
+        angle = math.radians(angle)
+        sk_list.append(alloc_sk(
+            'delta_stepper_alloc', arm2,
+            center_x + math.cos(angle) * radius,
+            center_y + math.sin(angle) * radius))
+    return replay_moves(mp, moves, sk_list, options.step_dist)
+
+def stage_shaper(mp, moves, extruder_moves, options):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    orig_sk_list = [alloc_sk('cartesian_stepper_alloc', a) for a in 'xy']
+    sk_list = []
+    for orig_sk in orig_sk_list:
+        sk = alloc_sk('input_shaper_alloc')
+        ffi_lib.input_shaper_set_sk(sk, orig_sk)
+        ffi_lib.input_shaper_set_shaper_params(
+            sk, ffi_lib.INPUT_SHAPER_MZV, ffi_lib.INPUT_SHAPER_MZV,
+            options.shaper_freq, options.shaper_freq, .1, .1)
+        sk_list.append(sk)
+    return replay_moves(mp, moves, sk_list, options.step_dist)
+
+def stage_extruder(mp, moves, extruder_moves, options):
+    if not extruder_moves:
+        return None
+    ffi_main, ffi_lib = chelper.get_ffi()
+    sk = alloc_sk('extruder_stepper_alloc')
+    ffi_lib.extruder_set_smooth_time(sk, .040)
+    return replay_moves(mp, extruder_moves, [sk], options.step_dist,
+                        num_axes=1)
+
+STAGES = [
+    ('cartesian', stage_cartesian), ('corexy', stage_corexy),
+    ('delta', stage_delta), ('shaper', stage_shaper),
+    ('extruder', stage_extruder),
+]
+
+def stage_toolhead(config_fname, gcode_fname, dict_fname):
+    out_fd, out_fname = tempfile.mkstemp(prefix="bench_stepgen_")
+    os.close(out_fd)
+    ffi_main, ffi_lib = chelper.get_ffi()
+    start_time = ffi_lib.get_monotonic()
+    moves, extruder_moves = record_moves(config_fname, gcode_fname,
+                                         dict_fname, out_fname)
+    run_time = ffi_lib.get_monotonic() - start_time
+    msgs, steps = count_messages(load_dictionary(dict_fname), out_fname)
+    res = {'moves': len(moves) // TRAPQ_APPEND_PARAMS, 'steps': steps,
+           'msgs': msgs, 'bytes': os.path.getsize(out_fname),
+           'time': run_time}
+    os.unlink(out_fname)
+    return res, moves.tostring(), extruder_moves.tostring()
+
+# Run a function in a child process (so that the peak memory usage of
+# each stage may be reported) and return its result
+def run_in_child(func, *args):
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(rfd)
+        code = 0
+        try:
+            res = func(*args)
+        except:
+            logging.exception("Error in benchmark stage")
+            res = None
+            code = 1
+        f = os.fdopen(wfd, 'wb')
+        cPickle.dump(res, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        os._exit(code)
+    os.close(wfd)
+    f = os.fdopen(rfd, 'rb')
+    res = cPickle.load(f)
+    f.close()
+    pid, status, rusage = os.wait4(pid, 0)
+    if status:
+        raise Exception("Benchmark stage failed")
+    return res, rusage.ru_maxrss
+
+def report(name, res, peak_rss):
+    if res is None:
+        sys.stdout.write("%-10s (no moves)\n" % (name,))
+        return
+    t = max(res['time'], .000001)
+    sys.stdout.write(
+        "%-10s moves=%d steps=%d queue_step=%d time=%.3fs moves/s=%.0f"
+        " steps/s=%.0f queue_step/s=%.0f peak_rss=%dKiB\n" % (
+            name, res['moves'], res['steps'], res['msgs'], res['time'],
+            res['moves'] / t, res['steps'] / t, res['msgs'] / t, peak_rss))
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options] <config file> <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-d", "--dictionary", dest="dictionary",
+                    help="file to read for mcu protocol dictionary")
+    opts.add_option("-s", "--step-distance", dest="step_dist", type="float",
+                    default=0.0025, help="step distance of replayed steppers")
+    opts.add_option("-f", "--shaper-freq", dest="shaper_freq", type="float",
+                    default=50., help="input shaper frequency")
+    opts.add_option("-k", "--stages", dest="stages",
+                    default=",".join([n for n, f in STAGES]),
+                    help="comma separated list of replay stages to run")
+    options, args = opts.parse_args()
+    if len(args) != 2 or options.dictionary is None:
+        opts.error("Incorrect number of arguments")
+    logging.basicConfig(level=logging.WARNING)
+    stages = dict(STAGES)
+    for name in options.stages.split(','):
+        if name not in stages:
+            opts.error("Unknown stage '%s'" % (name,))
+    # Build the C helper code before running any stage
+    chelper.get_ffi()
+
+    # Run the G-code file through the toolhead (recording its moves)
+    (res, moves, extruder_moves), peak_rss = run_in_child(
+        stage_toolhead, args[0], args[1], options.dictionary)
+    report('toolhead', res, peak_rss)
+    moves = array.array('d', moves)
+    extruder_moves = array.array('d', extruder_moves)
+    if not moves:
+        opts.error("No moves found in G-code file")
+
+    # Replay the moves through each kinematics
+    mp = load_dictionary(options.dictionary)
+    for name in options.stages.split(','):
+        res, peak_rss = run_in_child(stages[name], mp, moves,
+                                     extruder_moves, options)
+        report(name, res, peak_rss)
+
+if __name__ == '__main__':
+    main()
@@ -4,11 +4,24 @@
 # Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import optparse
+import optparse, array, sys
 import matplotlib
 
+# Read a file written with ACCELEROMETER_MEASURE FORMAT=binary
+def parse_binary_log(f):
+    f.readline()
+    header = f.readline().split()
+    count = int(header[-1].split('=')[1])
+    data = array.array('d')
+    data.fromfile(f, count * 4)
+    if sys.byteorder != 'little':
+        data.byteswap()
+    return [data[i:i+4].tolist() for i in range(0, len(data), 4)]
+
 def parse_log(logname):
-    f = open(logname, 'r')
+    f = open(logname, 'rb')
+    if logname.endswith('.bin'):
+        return parse_binary_log(f)
     out = []
     for line in f:
         if line.startswith('#'):
@@ -0,0 +1,109 @@
+#!/usr/bin/env python2
+# Check the virtual_sdcard g-code file index
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, tempfile
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy/extras'))
+import virtual_sdcard
+
+
+######################################################################
+# Layer detection
+######################################################################
+
+# Comment lines and whether they start a new layer
+LAYER_COMMENTS = [
+    (";LAYER_COUNT:2", False), (";LAYER:0", True), (";LAYER:1", True),
+    (";LAYER_CHANGE", True), ("; LAYER_CHANGE", True), (";Z:0.4", False),
+    ("; layer 3, Z = 0.600", True), ("; layer_height = 0.2", False),
+    ("; layerheight", False), (";LAYERS 5", False), (";TYPE:WALL", False),
+]
+
+def check_layers():
+    errors = 0
+    tracker = virtual_sdcard.FileStateTracker()
+    for line, expected in LAYER_COMMENTS:
+        if tracker.process_line(line) != expected:
+            sys.stdout.write("Layer mismatch on %s: expected %s\n" % (
+                repr(line), expected))
+            errors += 1
+    count = len([1 for line, expected in LAYER_COMMENTS if expected])
+    if tracker.get_state()[0] != count:
+        sys.stdout.write("Found %d layers instead of %d\n" % (
+            tracker.get_state()[0], count))
+        errors += 1
+    return errors
+
+
+######################################################################
+# Index lookups
+######################################################################
+
+def check_file(fname, interval):
+    f = open(fname, 'rb')
+    lines = f.readlines()
+    data = virtual_sdcard.build_file_index(fname, interval)
+    index = virtual_sdcard.FileIndex(data)
+    # Compare the state at each line start with a scan of the whole file
+    errors = 0
+    tracker = virtual_sdcard.FileStateTracker()
+    pos = 0
+    for line in lines + [""]:
+        expected = dict(zip(virtual_sdcard.INDEX_FIELDS,
+                            tracker.get_state()))
+        state = index.get_state(pos, f)
+        if state != expected:
+            sys.stdout.write("State mismatch at %s:%d: %s vs %s\n" % (
+                fname, pos, state, expected))
+            errors += 1
+        tracker.process_line(line)
+        pos += len(line)
+    f.close()
+    if index.get_layer_count() != tracker.get_state()[0]:
+        sys.stdout.write("Layer count mismatch on %s: %d vs %d\n" % (
+            fname, index.get_layer_count(), tracker.get_state()[0]))
+        errors += 1
+    return errors
+
+def check_sample(interval):
+    lines = [";LAYER_COUNT:2", "G90", "M82", "M104 S210", ";LAYER:0",
+             "G1 Z0.2 F3000", "G1 X10 Y10 E1", "M106 S128", ";LAYER:1",
+             "G91", "G1 Z0.2", "G1 X-5 E0.5", "G92 E0", "M107", ""]
+    fd, fname = tempfile.mkstemp(suffix='.gcode')
+    os.write(fd, "\n".join(lines))
+    os.close(fd)
+    try:
+        errors = check_file(fname, interval)
+        data = virtual_sdcard.build_file_index(fname, interval)
+        if len(data['layers']) != 2:
+            sys.stdout.write("Sample file has %d layers instead of 2\n" % (
+                len(data['layers']),))
+            errors += 1
+    finally:
+        os.unlink(fname)
+    return errors
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options] [<g-code file> ...]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-i", "--interval", dest="interval", type="int",
+                    default=3, help="number of lines between index entries")
+    options, args = opts.parse_args()
+    errors = check_layers() + check_sample(options.interval)
+    for fname in args:
+        errors += check_file(fname, options.interval)
+        sys.stdout.write("Checked index of %s\n" % (fname,))
+    if errors:
+        sys.stdout.write("Found %d mismatches\n" % (errors,))
+        sys.exit(-1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python2
+# Compare the step output of the C and Python look-ahead planners
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, re, optparse, logging, subprocess
+import test_klippy
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import msgproto
+
+PLANNERS = ['python', 'c']
+TEMP_CONFIG_FILE = "_test_planner_%s.cfg"
+TEMP_OUTPUT_FILE = "_test_lookahead_%s"
+AUTOSAVE_MARKER = "#*# <---------------------- SAVE_CONFIG"
+
+
+######################################################################
+# Output file decoding
+######################################################################
+
+def read_messages(dict_fname, data_fname):
+    f = open(dict_fname, 'rb')
+    dictionary = f.read()
+    f.close()
+    mp = msgproto.MessageParser()
+    mp.process_identify(dictionary, decompress=False)
+    f = open(data_fname, 'rb')
+    data = f.read()
+    f.close()
+    msgs = []
+    while data:
+        l = mp.check_packet(data)
+        if l == 0:
+            break
+        if l < 0:
+            logging.error("Invalid data")
+            data = data[-l:]
+            continue
+        msgs.extend(mp.dump(bytearray(data[:l]))[1:])
+        data = data[l:]
+    # Messages sent without a clock (such as endstop_home) are written
+    # by the serialqueue thread as soon as they are queued, so their
+    # position relative to other objects' messages varies between runs.
+    # Compare each object's messages in order (the sort is stable).
+    msgs.sort(key=get_oid)
+    return msgs
+
+oid_r = re.compile(r'\boid=(\d+)')
+
+def get_oid(msg):
+    m = oid_r.search(msg)
+    if m is None:
+        return -1
+    return int(m.group(1))
+
+
+######################################################################
+# Test cases
+######################################################################
+
+class LookaheadTestCase(test_klippy.TestCase):
+    def run_planner(self, planner, config_fname, dict_fnames, gcode_fname):
+        # Copy the test config and select the look-ahead planner (the
+        # override must be placed before any SAVE_CONFIG block)
+        f = open(config_fname, 'rb')
+        data = f.read()
+        f.close()
+        pos = data.find(AUTOSAVE_MARKER)
+        if pos < 0:
+            pos = len(data)
+        override = "\n[printer]\nlookahead_planner: %s\n" % (planner,)
+        cfg_fname = os.path.join(os.path.dirname(config_fname),
+                                 TEMP_CONFIG_FILE % (planner,))
+        f = open(cfg_fname, 'wb')
+        f.write(data[:pos] + override + data[pos:])
+        f.close()
+        # Call klippy
+        out_fname = self.relpath(TEMP_OUTPUT_FILE % (planner,), 'temp')
+        args = [ sys.executable, './klippy/klippy.py', cfg_fname,
+                 '-i', gcode_fname, '-o', out_fname, '-v',
+                 '-l', test_klippy.TEMP_LOG_FILE ]
+        for df in dict_fnames:
+            args += ['-d', df]
+        res = subprocess.call(args)
+        os.unlink(cfg_fname)
+        if res:
+            self.show_log()
+            raise test_klippy.error("Error during test (planner %s)" % (
+                planner,))
+        os.unlink(test_klippy.TEMP_LOG_FILE)
+        # Decode output
+        msgs = read_messages(dict_fnames[0], out_fname)
+        for df in dict_fnames[1:]:
+            mcu_name, fname = df.split('=', 1)
+            msgs += read_messages(fname, out_fname + "-" + mcu_name)
+        for fname in os.listdir(self.tempdir):
+            if fname.startswith(os.path.basename(out_fname)):
+                os.unlink(os.path.join(self.tempdir, fname))
+        return msgs
+    def launch_test(self, config_fname, dict_fnames, gcode_fname, gcode,
+                    should_fail):
+        if should_fail:
+            return
+        gcode_is_temp = False
+        if gcode_fname is None:
+            gcode_fname = self.relpath(test_klippy.TEMP_GCODE_FILE, 'temp')
+            gcode_is_temp = True
+            f = open(gcode_fname, 'wb')
+            f.write('\n'.join(gcode + ['']))
+            f.close()
+        sys.stderr.write("    Comparing %s (%s)\n" % (
+            self.fname, os.path.basename(config_fname)))
+        results = [self.run_planner(planner, config_fname, dict_fnames,
+                                    gcode_fname)
+                   for planner in PLANNERS]
+        if gcode_is_temp:
+            os.unlink(gcode_fname)
+        if results[0] != results[1]:
+            pos = 0
+            while (pos < min(len(results[0]), len(results[1]))
+                   and results[0][pos] == results[1][pos]):
+                pos += 1
+            for planner, msgs in zip(PLANNERS, results):
+                sys.stderr.write("First mismatched messages (%s):\n  %s\n" % (
+                    planner, "\n  ".join(msgs[pos:pos+10]),))
+            raise test_klippy.error("Output differs between planners")
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    # Parse args
+    usage = "%prog [options] <test cases>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-d", "--dictdir", dest="dictdir", default=".",
+                    help="directory for dictionary files")
+    opts.add_option("-t", "--tempdir", dest="tempdir", default=".",
+                    help="directory for temporary files")
+    options, args = opts.parse_args()
+    if len(args) < 1:
+        opts.error("Incorrect number of arguments")
+    logging.basicConfig(level=logging.DEBUG)
+
+    # Run each test
+    for fname in args:
+        tc = LookaheadTestCase(fname, options.dictdir, options.tempdir,
+                               False, False)
+        res = tc.run()
+        if res != 'success':
+            sys.stderr.write("\n\nTest case %s FAILED (%s)!\n\n" % (fname, res))
+            sys.exit(-1)
+
+    sys.stderr.write("\n    All %d test cases match\n" % (len(args),))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python2
+# Compare the C and python decoding of mcu protocol messages
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, logging, random
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import msgproto, serialhdl
+
+
+######################################################################
+# Message sources
+######################################################################
+
+# Split the message blocks of a captured serial data file into blocks
+# containing a single message each
+def read_captured(mp, data_fname):
+    f = open(data_fname, 'rb')
+    data = f.read()
+    f.close()
+    blocks = []
+    while data:
+        l = mp.check_packet(data)
+        if l == 0:
+            break
+        if l < 0:
+            logging.error("Invalid data")
+            data = data[-l:]
+            continue
+        s = bytearray(data[:l])
+        pos = msgproto.MESSAGE_HEADER_SIZE
+        while pos < l - msgproto.MESSAGE_TRAILER_SIZE:
+            mid = mp.messages_by_id.get(s[pos], mp.unknown)
+            params, newpos = mid.parse(s, pos)
+            blocks.append(mp.encode(len(blocks), str(s[pos:newpos])))
+            pos = newpos
+        data = data[l:]
+    return blocks
+
+# Generate a random valid value for a message parameter type
+def random_value(t, max_string):
+    if isinstance(t, msgproto.Enumeration):
+        choices = list(t.enums.values())
+        if random.random() < .1:
+            choices = [max(choices) + 1]
+        return random.choice(choices)
+    if t.is_dynamic_string:
+        l = random.randint(0, max_string)
+        return bytearray(random.getrandbits(8) for i in range(l))
+    bits = {5: 32, 3: 16, 2: 8}[t.max_length]
+    if t.signed:
+        return random.randint(-(1 << (bits - 1)), (1 << (bits - 1)) - 1)
+    return random.randint(0, (1 << bits) - 1)
+
+# Generate a single message block with random parameters
+def random_message(mp):
+    msgid = random.choice(list(mp.messages_by_id.keys()))
+    mf = mp.messages_by_id[msgid]
+    param_types = getattr(mf, 'param_types', [])
+    max_string = msgproto.MESSAGE_PAYLOAD_MAX // max(len(param_types), 1)
+    out = [msgid]
+    for t in param_types:
+        v = random_value(t, max_string)
+        if isinstance(t, msgproto.Enumeration):
+            t.pt.encode(out, v)
+        else:
+            t.encode(out, v)
+    out = out[:msgproto.MESSAGE_PAYLOAD_MAX]
+    return mp.encode(random.getrandbits(4), str(bytearray(out)))
+
+# Randomly corrupt the payload of a message block
+def mutate_message(block):
+    s = bytearray(block)
+    payload = s[msgproto.MESSAGE_HEADER_SIZE:-msgproto.MESSAGE_TRAILER_SIZE]
+    action = random.randint(0, 2)
+    if action == 0 and payload:
+        payload[random.randrange(len(payload))] = random.getrandbits(8)
+    elif action == 1 and payload:
+        del payload[random.randrange(len(payload)):]
+    elif len(payload) < msgproto.MESSAGE_PAYLOAD_MAX:
+        payload.insert(random.randint(0, len(payload)), random.getrandbits(8))
+    s = s[:msgproto.MESSAGE_HEADER_SIZE] + payload + s[-3:]
+    s[msgproto.MESSAGE_POS_LEN] = len(s)
+    return str(s)
+
+
+######################################################################
+# Parser comparison
+######################################################################
+
+def parse_result(func, *args):
+    try:
+        return func(*args)
+    except Exception as e:
+        return (type(e).__name__, str(e))
+
+def c_parse(cmp, blocks):
+    responses = cmp.ffi_main.new('struct pull_queue_message[%d]' % (
+        len(blocks),))
+    for i, block in enumerate(blocks):
+        responses[i].msg[0:len(block)] = bytearray(block)
+        responses[i].len = len(block)
+    return cmp.parse_batch(responses, len(blocks))
+
+def compare_blocks(mp, cmp, blocks):
+    errors = 0
+    for i in range(0, len(blocks), serialhdl.PULL_BATCH):
+        batch = blocks[i:i+serialhdl.PULL_BATCH]
+        results = parse_result(c_parse, cmp, batch)
+        if type(results) != list:
+            # A message in the batch raised an error - check individually
+            results = [parse_result(c_parse, cmp, [block]) for block in batch]
+            results = [r[0] if type(r) == list else r for r in results]
+        for block, result in zip(batch, results):
+            expected = parse_result(mp.parse, list(bytearray(block)))
+            if result != expected:
+                sys.stdout.write("Mismatch on %s: %s vs %s\n" % (
+                    repr(block), result, expected))
+                errors += 1
+    return errors
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options] <dictionary file> [<captured data file> ...]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", dest="count", type="int", default=10000,
+                    help="number of random messages to check")
+    opts.add_option("-s", "--seed", dest="seed", type="int", default=0,
+                    help="random number generator seed")
+    options, args = opts.parse_args()
+    if len(args) < 1:
+        opts.error("Incorrect number of arguments")
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(options.seed)
+
+    f = open(args[0], 'rb')
+    dictionary = f.read()
+    f.close()
+    mp = msgproto.MessageParser()
+    mp.process_identify(dictionary, decompress=False)
+    cmp = serialhdl.CompiledMessageParser(mp)
+
+    errors = 0
+    for data_fname in args[1:]:
+        blocks = read_captured(mp, data_fname)
+        errors += compare_blocks(mp, cmp, blocks)
+        sys.stdout.write("Checked %d captured messages from %s\n" % (
+            len(blocks), data_fname))
+    blocks = [random_message(mp) for i in range(options.count)]
+    errors += compare_blocks(mp, cmp, blocks)
+    errors += compare_blocks(mp, cmp, [mutate_message(b) for b in blocks])
+    sys.stdout.write("Checked %d random and %d corrupted messages\n" % (
+        len(blocks), len(blocks)))
+    if errors:
+        sys.stdout.write("Found %d mismatches\n" % (errors,))
+        sys.exit(-1)
+
+if __name__ == '__main__':
+    main()
@@ -70,3 +70,15 @@ mkdir -p ${HOSTDIR}
 start_test klippy "Test invoke klippy"
 $PYTHON scripts/test_klippy.py -d ${DICTDIR} test/klippy/*.test
 finish_test klippy "Test invoke klippy"
+
+start_test lookahead "Compare C and Python look-ahead planners"
+$PYTHON scripts/test_lookahead.py -d ${DICTDIR} test/klippy/*.test
+finish_test lookahead "Compare C and Python look-ahead planners"
+
+start_test msgparse "Compare C and Python message parsers"
+$PYTHON scripts/test_msgparse.py ${DICTDIR}/atmega2560.dict
+finish_test msgparse "Compare C and Python message parsers"
+
+start_test file_index "Check the virtual_sdcard file index"
+$PYTHON scripts/test_file_index.py test/klippy/*.gcode
+finish_test file_index "Check the virtual_sdcard file index"